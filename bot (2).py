@@ -1,21 +1,35 @@
-import sqlite3
 import asyncio
 import random
 import time
 import os
+import sys
+import importlib
+import contextvars
 import io
-import subprocess
+import signal
 import json
 import zipfile
 import shutil
 import tempfile
 import base64
 import re
+import hashlib
+import struct
+import zlib
+import bisect
+import fcntl
+import math
+import heapq
+import itertools
+import weakref
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from queue import Empty
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
+import aiosqlite
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.handler import CancelHandler
@@ -23,6 +37,11 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.utils.exceptions import RetryAfter
+from aiogram.utils.executor import Executor
+from aiogram.dispatcher.webhook import WebhookRequestHandler, BOT_DISPATCHER_KEY
+from aiohttp import web, ClientSession
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 if ":" in BOT_TOKEN and len(BOT_TOKEN.split(":")) >= 2:
@@ -40,14 +59,690 @@ START_BALANCE = int(os.getenv("START_BALANCE", "50"))
 DUEL_BASE_XP_WIN = int(os.getenv("DUEL_BASE_XP_WIN", "15"))
 DUEL_BASE_XP_LOSE = int(os.getenv("DUEL_BASE_XP_LOSE", "5"))
 LEVEL_XP = int(os.getenv("LEVEL_XP", "100"))
+COMMIT_WINDOW = float(os.getenv("COMMIT_WINDOW_MS", "5")) / 1000
+COMMIT_MAX_PENDING = int(os.getenv("COMMIT_MAX_PENDING", "500"))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", "30"))
+LEDGER_COMPACT_INTERVAL = int(os.getenv("LEDGER_COMPACT_INTERVAL", "21600"))
+LEDGER_COMPACT_BATCH = int(os.getenv("LEDGER_COMPACT_BATCH", "50000"))
+LEDGER_PAGE_SIZE = 15
+LEADERBOARD_PERSIST_INTERVAL = int(os.getenv("LEADERBOARD_PERSIST_INTERVAL", "60"))
+DEV_MODE = os.getenv("DEV_MODE", "0") == "1"
+QUERY_REGISTRY_LIMIT = int(os.getenv("QUERY_REGISTRY_LIMIT", "500"))
+CODE_SESSION_TTL = int(os.getenv("CODE_SESSION_TTL", "600"))
+GAME_SESSION_TTL = int(os.getenv("GAME_SESSION_TTL", "1800"))
+GAME_SESSION_MAX = int(os.getenv("GAME_SESSION_MAX", "10000"))
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", DB_PATH + ".sessions")
+SESSION_SNAPSHOT_INTERVAL = int(os.getenv("SESSION_SNAPSHOT_INTERVAL", "60"))
+SESSION_SNAPSHOT_MAX_BYTES = int(os.getenv("SESSION_SNAPSHOT_MAX_BYTES", str(8 * 1024 * 1024)))
+CODE_RUN_TIMEOUT = int(os.getenv("CODE_RUN_TIMEOUT", "10"))
+CODE_RUN_WORKERS = int(os.getenv("CODE_RUN_WORKERS", "2"))
+CODE_RUN_USER_QUEUE = int(os.getenv("CODE_RUN_USER_QUEUE", "3"))
+CODE_RUN_MEMORY_MB = int(os.getenv("CODE_RUN_MEMORY_MB", "256"))
+CODE_RUN_OUTPUT_BYTES = int(os.getenv("CODE_RUN_OUTPUT_BYTES", str(1024 * 1024)))
+CODE_RUN_CAPTURE_BYTES = 4096
+PY_POOL_SIZE = int(os.getenv("PY_POOL_SIZE", str(CODE_RUN_WORKERS)))
+PY_WORKER_MAX_RUNS = int(os.getenv("PY_WORKER_MAX_RUNS", "50"))
+APK_LAZY = os.getenv("APK_LAZY", "1") == "1"
+APK_VIEW_LIMIT = 50000
+APK_MAX_UPLOAD_MB = int(os.getenv("APK_MAX_UPLOAD_MB", "20"))
+APK_BLOB_MIN_SIZE = int(os.getenv("APK_BLOB_MIN_SIZE", "16384"))
+APK_INDEX_MAX_TERMS = int(os.getenv("APK_INDEX_MAX_TERMS", "200000"))
+APK_JOB_WORKERS = int(os.getenv("APK_JOB_WORKERS", "2"))
+APK_PROGRESS_INTERVAL = float(os.getenv("APK_PROGRESS_INTERVAL", "1.5"))
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_PER_MIN = float(os.getenv("OUTBOUND_GROUP_PER_MIN", "20"))
+OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+RTP_SIM_ROUNDS = int(os.getenv("RTP_SIM_ROUNDS", "2000000"))
+RTP_SIM_MAX_ROUNDS = int(os.getenv("RTP_SIM_MAX_ROUNDS", "50000000"))
+RTP_PLAYER_STANDS = int(os.getenv("RTP_PLAYER_STANDS", "17"))
+SLOTS_RTP_BAND = tuple(map(float, os.getenv("SLOTS_RTP_BAND", "0.85,1.0").split(",")))
+BLACKJACK_RTP_BAND = tuple(map(float, os.getenv("BLACKJACK_RTP_BAND", "0.85,1.0").split(",")))
 ADMINS = set(map(int, os.getenv("ADMIN_IDS", "7587362459").split(",")))
 
-storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN)
+# Heavy or optional modules are imported on first attribute access, so a
+# restart only pays for what the first commands touch. A failed import is
+# remembered and re-raised as ImportError on every later access.
+class LazyModule:
+    def __init__(self, name, before=None):
+        self._name = name
+        self._before = before
+        self._module = None
+        self._error = None
+
+    def _load(self):
+        if self._module is None:
+            if self._error is not None:
+                raise ImportError(self._error)
+            try:
+                if self._before:
+                    self._before()
+                self._module = importlib.import_module(self._name)
+            except ImportError as e:
+                self._error = str(e)
+                raise
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+lazy_modules = {}
+
+def lazy_import(name, before=None):
+    if name not in lazy_modules:
+        lazy_modules[name] = LazyModule(name, before)
+    return lazy_modules[name]
+
+np = lazy_import("numpy")
+plt = lazy_import("matplotlib.pyplot", before=lambda: importlib.import_module("matplotlib").use('Agg'))
+jsbeautifier = lazy_import("jsbeautifier")
+cssbeautifier = lazy_import("cssbeautifier")
+python_minifier = lazy_import("python_minifier")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+OUTBOUND_INTERACTIVE, OUTBOUND_REPLY, OUTBOUND_BULK = 0, 1, 2
+outbound_priority = contextvars.ContextVar("outbound_priority", default=OUTBOUND_BULK)
+OUTBOUND_EDITS = ("editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia")
+
+class OutboundRequest:
+    __slots__ = ("method", "data", "files", "kwargs", "futures", "priority", "seq", "edit_key", "retries")
+
+    def __init__(self, method, data, files, kwargs, priority, seq):
+        self.method = method
+        self.data = data
+        self.files = files
+        self.kwargs = kwargs
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.priority = priority
+        self.seq = seq
+        self.edit_key = (method, data.get("message_id")) if method in OUTBOUND_EDITS else None
+        self.retries = 0
+
+# Every chat-bound API call goes through one queue. Each chat has its own
+# token bucket and at most one request in flight (so replies keep their
+# order), a global bucket caps the total rate, and ready chats are served by
+# (priority, arrival) so callback answers overtake broadcasts. A pending
+# edit of the same message is replaced by the newer one instead of queueing
+# both, and RetryAfter pauses only the affected chat before a retry.
+class OutboundScheduler:
+    def __init__(self, send):
+        self.send = send
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self.chats = {}
+        self.ready = []
+        self.sleeping = []
+        self.seq = 0
+        self.task = None
+        self.wakeup = None
+        self.inflight = set()
+        self.sent = self.retried = self.coalesced = 0
+
+    def _chat_bucket(self, chat_id):
+        if isinstance(chat_id, str) or chat_id < 0:
+            return TokenBucket(OUTBOUND_GROUP_PER_MIN / 60, OUTBOUND_BURST)
+        return TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_BURST)
+
+    def _schedule(self, chat_id, state, now):
+        if state['busy'] or state['scheduled'] or not state['queue']:
+            return
+        state['scheduled'] = True
+        delay = state['bucket'].delay(now)
+        if delay > 0:
+            heapq.heappush(self.sleeping, (now + delay, chat_id))
+        else:
+            head = state['queue'][0]
+            heapq.heappush(self.ready, (head.priority, head.seq, chat_id))
+        self.wakeup.set()
+
+    def _ensure_task(self):
+        if self.task is None or self.task.done() or self.task.get_loop() is not asyncio.get_running_loop():
+            self._fail_queued(asyncio.CancelledError())
+            self.wakeup = asyncio.Event()
+            self.chats.clear()
+            self.task = asyncio.create_task(self.run())
+
+    def _fail_queued(self, error):
+        for state in self.chats.values():
+            while state['queue']:
+                self._resolve(state['queue'].popleft(), error=error)
+        self.ready.clear()
+        self.sleeping.clear()
+
+    def pending(self):
+        return sum(len(state['queue']) for state in self.chats.values()) + len(self.inflight)
+
+    async def submit(self, method, data, files, kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None or not method.startswith(("send", "edit", "forward", "copy")) or method == "sendChatAction":
+            return await self.send(method, data, files, kwargs)
+        self._ensure_task()
+        self.seq += 1
+        item = OutboundRequest(method, data, files, kwargs, outbound_priority.get(), self.seq)
+        future = item.futures[0]
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = {'queue': deque(), 'bucket': self._chat_bucket(chat_id), 'busy': False, 'scheduled': False}
+        if item.edit_key:
+            for queued in state['queue']:
+                if queued.edit_key == item.edit_key:
+                    queued.data = item.data
+                    queued.files = item.files
+                    queued.futures.append(future)
+                    queued.priority = min(queued.priority, item.priority)
+                    self.coalesced += 1
+                    return await future
+        state['queue'].append(item)
+        self._schedule(chat_id, state, time.monotonic())
+        return await future
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                _, chat_id = heapq.heappop(self.sleeping)
+                state = self.chats[chat_id]
+                state['scheduled'] = False
+                self._schedule(chat_id, state, now)
+            if not self.ready:
+                self.wakeup.clear()
+                timeout = self.sleeping[0][0] - now if self.sleeping else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self.global_bucket.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, chat_id = heapq.heappop(self.ready)
+            state = self.chats[chat_id]
+            state['scheduled'] = False
+            item = state['queue'].popleft()
+            if all(future.done() for future in item.futures):
+                self._schedule(chat_id, state, now)
+                continue
+            state['bucket'].take(now)
+            self.global_bucket.take(now)
+            state['busy'] = True
+            task = asyncio.create_task(self._deliver(chat_id, state, item))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+            self.sent += 1
+            if self.sent % 1000 == 0:
+                for idle_chat in [c for c, st in self.chats.items() if not st['queue'] and not st['busy'] and st['bucket'].idle(now)]:
+                    del self.chats[idle_chat]
+
+    async def _deliver(self, chat_id, state, item):
+        try:
+            for value in (item.files or {}).values():
+                if hasattr(value, "file") and getattr(value.file, "seekable", lambda: False)():
+                    value.file.seek(0)
+            result = await self.send(item.method, item.data, item.files, item.kwargs)
+        except asyncio.CancelledError as e:
+            self._resolve(item, error=e)
+            raise
+        except RetryAfter as e:
+            item.retries += 1
+            if item.retries > OUTBOUND_MAX_RETRIES:
+                self._resolve(item, error=e)
+            else:
+                self.retried += 1
+                state['bucket'].block(time.monotonic(), e.timeout)
+                state['queue'].appendleft(item)
+        except Exception as e:
+            self._resolve(item, error=e)
+        else:
+            self._resolve(item, result=result)
+        finally:
+            state['busy'] = False
+            self.chats.setdefault(chat_id, state)
+            self._schedule(chat_id, state, time.monotonic())
+
+    def _resolve(self, item, result=None, error=None):
+        for future in item.futures:
+            if future.done():
+                continue
+            try:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            except RuntimeError:
+                # The future belongs to an event loop that is already closed.
+                pass
+
+    # Waits up to timeout for queued and in-flight requests; whatever is left
+    # after that fails with CancelledError instead of leaving callers hanging.
+    async def drain(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.task and self.pending() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self._fail_queued(asyncio.CancelledError())
+        inflight = list(self.inflight)
+        for task in inflight:
+            task.cancel()
+        await asyncio.gather(*inflight, return_exceptions=True)
+
+class PacedBot(Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = OutboundScheduler(self._send_now)
+
+    async def _send_now(self, method, data, files, kwargs):
+        return await super().request(method, data, files, **kwargs)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        return await self.outbound.submit(method, data, files, kwargs)
+
+# FSM state lives in fsm_states so flows survive restarts. Every lookup is
+# served from an LRU of records (including "no state", which is what most
+# messages hit); writes go through the group commit. States idle for longer
+# than FSM_STATE_TTL read as empty and are deleted by an ExpiryScheduler.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, ttl, cache_size):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.expiry = None
+
+    async def startup(self):
+        self.expiry = ExpiryScheduler("FSM", self._expire)
+        for chat_id, user_id, updated_at in await db_fetchall("SELECT chat_id, user_id, updated_at FROM fsm_states"):
+            self.expiry.schedule((chat_id, user_id), updated_at + self.ttl)
+        asyncio.create_task(self.expiry.run())
+
+    async def close(self):
+        self.cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _load(self, key):
+        record = self.cache.get(key)
+        if record is None:
+            row = await db_fetchone(
+                "SELECT state, data, bucket, updated_at FROM fsm_states WHERE chat_id = ? AND user_id = ?", key
+            )
+            if row:
+                record = {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2]), 'updated_at': row[3]}
+            else:
+                record = {'state': None, 'data': {}, 'bucket': {}, 'updated_at': 0}
+            self.cache[key] = record
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        if record['updated_at'] and record['updated_at'] + self.ttl <= time.time():
+            record['state'], record['data'], record['bucket'], record['updated_at'] = None, {}, {}, 0
+        return record
+
+    async def _save(self, key, record):
+        if record['state'] is None and not record['data'] and not record['bucket']:
+            record['updated_at'] = 0
+            if self.expiry is not None:
+                self.expiry.cancel(key)
+            await db_execute("DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?", key)
+            return
+        record['updated_at'] = int(time.time())
+        if self.expiry is not None:
+            self.expiry.schedule(key, record['updated_at'] + self.ttl)
+        await db_execute(
+            """INSERT INTO fsm_states(chat_id, user_id, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                   state = excluded.state, data = excluded.data, bucket = excluded.bucket, updated_at = excluded.updated_at""",
+            (*key, record['state'], json.dumps(record['data']), json.dumps(record['bucket']), record['updated_at'])
+        )
+
+    async def _expire(self, keys):
+        cutoff = int(time.time()) - self.ttl
+        async with db_transaction() as tx:
+            await tx.executemany(
+                "DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ? AND updated_at <= ?",
+                [(*key, cutoff) for key in keys]
+            )
+        for key in keys:
+            self.cache.pop(key, None)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return json.loads(json.dumps(record['data']))
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record['state'] = self.resolve_state(state)
+        await self._save(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record['data'] = json.loads(json.dumps(data or {}))
+        await self._save(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record['data'].update(json.loads(json.dumps(data or {})), **json.loads(json.dumps(kwargs)))
+        await self._save(key, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        await self._save(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return json.loads(json.dumps(record['bucket']))
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record['bucket'] = json.loads(json.dumps(bucket or {}))
+        await self._save(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record['bucket'].update(json.loads(json.dumps(bucket or {})), **json.loads(json.dumps(kwargs)))
+        await self._save(key, record)
+
+def make_fsm_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "redis":
+        from urllib.parse import urlparse
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        url = urlparse(REDIS_URL)
+        return RedisStorage2(
+            host=url.hostname or "localhost", port=url.port or 6379, db=int(url.path.lstrip("/") or 0),
+            password=url.password, prefix="ecsp_fsm",
+            state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL, bucket_ttl=FSM_STATE_TTL
+        )
+    return SQLiteStorage(FSM_STATE_TTL, FSM_CACHE_SIZE)
+
+bot = PacedBot(token=BOT_TOKEN)
+storage = make_fsm_storage()
 dp = Dispatcher(bot, storage=storage)
 
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
+db = None
+db_reader = None
+db_write_lock = asyncio.Lock()
+db_in_tx = False
+db_pending_writes = 0
+db_commit_task = None
+db_commit_waiters = []
+db_commit_stats = {"commits": 0, "writes": 0}
+db_query_registry = {}
+
+# Deadline heap shared by everything with a TTL. schedule() replaces a key's
+# deadline (older heap entries are skipped when popped), and all keys due
+# at the same wake-up are handed to the handler as one batch.
+class ExpiryScheduler:
+    def __init__(self, name, handler, retry_delay=60):
+        self.name = name
+        self.handler = handler
+        self.retry_delay = retry_delay
+        self.heap = []
+        self.deadlines = {}
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.fired = 0
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, key))
+        self.wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) == deadline:
+                    del self.deadlines[key]
+                    due.append(key)
+            if due:
+                self.fired += len(due)
+                try:
+                    await self.handler(due)
+                except Exception as e:
+                    print(f"{self.name} expiry error: {e}")
+                    for key in due:
+                        self.schedule(key, now + self.retry_delay)
+                continue
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [item for item in self.heap if self.deadlines.get(item[2]) == item[0]]
+                heapq.heapify(self.heap)
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+# Live game sessions. Each store is LRU-ordered and capped at max_size; any
+# access through get()/[] counts as activity and pushes the idle deadline
+# out by ttl. Sessions that expire or get evicted go to on_expire, which is
+# where escrowed bets are refunded.
+class SessionStore:
+    def __init__(self, name, ttl, max_size, on_expire=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_expire = on_expire
+        self.sessions = OrderedDict()
+        self.expiry = ExpiryScheduler(name, self._expire)
+        self.expired = 0
+        self.evicted = 0
+        session_stores[name] = self
+
+    def __contains__(self, key):
+        return key in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __getitem__(self, key):
+        session = self.sessions[key]
+        self.touch(key)
+        return session
+
+    def __setitem__(self, key, session):
+        self.sessions[key] = session
+        self.touch(key)
+        while len(self.sessions) > self.max_size:
+            old_key, old_session = self.sessions.popitem(last=False)
+            self.expiry.cancel(old_key)
+            self.evicted += 1
+            if self.on_expire:
+                asyncio.create_task(self._release(old_key, old_session))
+
+    def __delitem__(self, key):
+        del self.sessions[key]
+        self.expiry.cancel(key)
+
+    def get(self, key, default=None):
+        if key not in self.sessions:
+            return default
+        return self[key]
+
+    def pop(self, key, default=None):
+        self.expiry.cancel(key)
+        return self.sessions.pop(key, default)
+
+    def items(self):
+        return self.sessions.items()
+
+    def touch(self, key):
+        self.sessions.move_to_end(key)
+        self.expiry.schedule(key, time.time() + self.ttl)
+
+    def restore(self, key, session, deadline):
+        self.sessions[key] = session
+        self.expiry.schedule(key, deadline)
+
+    def deadline(self, key):
+        return self.expiry.deadlines.get(key, time.time() + self.ttl)
+
+    async def _release(self, key, session):
+        try:
+            await self.on_expire(key, session)
+        except Exception as e:
+            print(f"{self.name} session release error: {e}")
+
+    async def _expire(self, keys):
+        for key in keys:
+            session = self.sessions.pop(key, None)
+            if session is not None:
+                self.expired += 1
+                if self.on_expire:
+                    await self._release(key, session)
+
+def _deep_sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(_deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+def session_gauges():
+    gauges = []
+    for name, store in session_stores.items():
+        seen = set()
+        memory = sum(_deep_sizeof(session, seen) for _, session in store.items())
+        gauges.append((name, len(store), store.max_size, store.ttl, memory, store.expired, store.evicted))
+    return gauges
+
+class HangmanSession:
+    __slots__ = ('word', 'guessed', 'attempts', 'max_attempts', 'creator')
+
+    def __init__(self, word, creator, max_attempts=6):
+        self.word = word
+        self.guessed = set()
+        self.attempts = 0
+        self.max_attempts = max_attempts
+        self.creator = creator
+
+class BlackjackSession:
+    __slots__ = ('deck', 'player_hand', 'dealer_hand', 'bet', 'chat_id', 'nonce')
+
+    def __init__(self, deck, player_hand, dealer_hand, bet, chat_id, nonce=None):
+        self.deck = deck
+        self.player_hand = player_hand
+        self.dealer_hand = dealer_hand
+        self.bet = bet
+        self.chat_id = chat_id
+        self.nonce = random.getrandbits(31) if nonce is None else nonce
+
+class QuizSession:
+    __slots__ = ('quiz_id', 'quiz_name', 'questions', 'current', 'score', 'correct_count', 'start_time', 'chat_id', 'reward', 'xp_reward')
+
+    def __init__(self, quiz_id, quiz_name, questions, chat_id, reward, xp_reward):
+        self.quiz_id = quiz_id
+        self.quiz_name = quiz_name
+        self.questions = questions
+        self.current = 0
+        self.score = 0
+        self.correct_count = 0
+        self.start_time = time.time()
+        self.chat_id = chat_id
+        self.reward = reward
+        self.xp_reward = xp_reward
+
+class CodeSession:
+    __slots__ = ('language', 'chat_id')
+
+    def __init__(self, language, chat_id):
+        self.language = language
+        self.chat_id = chat_id
+
+async def refund_blackjack(user_id, game):
+    await escrow_close(user_id, "bj")
+    await settle_game(user_id, "bj_refund", payout=game.bet)
+    try:
+        await bot.send_message(game.chat_id, f"Игра в блэкджек закрыта по таймауту. Ставка {game.bet} EcsCoin возвращена.")
+    except Exception:
+        pass
+
+session_stores = {}
 
 duel_requests = {}
 ongoing_duel = None
@@ -55,22 +750,260 @@ spectator_bets = {}
 tictactoe_games = {}
 guess_number_games = {}
 rps_requests = {}
-quiz_sessions = {}
+quiz_sessions = SessionStore("quiz", GAME_SESSION_TTL, GAME_SESSION_MAX)
 mafia_rooms = {}
 raid_rooms = {}
 boss_raid_rooms = {}
 darkness_rooms_active = {}
-hangman_games = {}
-blackjack_games = {}
+hangman_games = SessionStore("hangman", GAME_SESSION_TTL, GAME_SESSION_MAX)
+blackjack_games = SessionStore("blackjack", GAME_SESSION_TTL, GAME_SESSION_MAX, on_expire=refund_blackjack)
+blackjack_starting = set()
 word_chain_games = {}
 memory_games = {}
-chat_locks = {}
-code_compile_sessions = {}
+chat_locks = weakref.WeakValueDictionary()
+code_compile_sessions = SessionStore("code", CODE_SESSION_TTL, GAME_SESSION_MAX)
+code_run_slots = asyncio.Semaphore(CODE_RUN_WORKERS)
+code_run_locks = {}
+code_run_queued = {}
 
 async def get_chat_lock(chat_id):
-    if chat_id not in chat_locks:
-        chat_locks[chat_id] = asyncio.Lock()
-    return chat_locks[chat_id]
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+# Bets on games that span several updates stay in game_escrow until the game
+# is settled, so a session lost to a crash or a bad snapshot can always be
+# told apart from one that already paid out, and refunded at startup.
+async def escrow_open(user_id, game, amount, chat_id, nonce=0):
+    await db_execute(
+        "INSERT OR REPLACE INTO game_escrow(user_id, game, amount, chat_id, created_at, nonce) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, game, amount, chat_id, int(time.time()), nonce)
+    )
+
+async def escrow_close(user_id, game):
+    await db_execute("DELETE FROM game_escrow WHERE user_id = ? AND game = ?", (user_id, game))
+
+# Session snapshot: MAGIC, then <B version, B clean, d written_at, I length>
+# and a zlib-compressed stream of tagged struct records. Blackjack comes
+# first so it survives the size budget. A clean (shutdown) snapshot restores
+# everything; a periodic one only restores quizzes, which can be validated
+# against the database. Blackjack needs a clean snapshot and an escrow row
+# with the same nonce, otherwise the bet is refunded: an older snapshot could
+# bring back a hand the player has already seen further into.
+SNAPSHOT_MAGIC = b"ECSSNAP"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<BBdI')
+SNAP_HANGMAN, SNAP_BLACKJACK, SNAP_QUIZ, SNAP_CODE = 1, 2, 3, 4
+SNAP_HANGMAN_REC = struct.Struct('<qqBBd')
+SNAP_BLACKJACK_REC_V1 = struct.Struct('<qqqd')
+SNAP_BLACKJACK_REC = struct.Struct('<qqqqd')
+SNAP_QUIZ_REC = struct.Struct('<qqqIIIdqqd')
+SNAP_CODE_REC = struct.Struct('<qqd')
+
+def _snap_str(value):
+    data = value.encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+def _snap_bytes(value):
+    return struct.pack('<B', len(value)) + bytes(value)
+
+class SnapshotReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def struct(self, fmt):
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def str(self):
+        (length,) = struct.unpack_from('<H', self.data, self.pos)
+        self.pos += 2 + length
+        return self.data[self.pos - length:self.pos].decode('utf-8')
+
+    def bytes(self):
+        length = self.data[self.pos]
+        self.pos += 1 + length
+        return self.data[self.pos - length:self.pos]
+
+def encode_session_snapshot(clean):
+    records = []
+    for user_id, game in blackjack_games.items():
+        records.append(
+            bytes([SNAP_BLACKJACK]) + SNAP_BLACKJACK_REC.pack(user_id, game.chat_id, game.bet, game.nonce, blackjack_games.deadline(user_id))
+            + _snap_bytes(game.deck) + _snap_bytes(game.player_hand.cards) + _snap_bytes(game.dealer_hand.cards)
+        )
+    for user_id, session in quiz_sessions.items():
+        records.append(
+            bytes([SNAP_QUIZ]) + SNAP_QUIZ_REC.pack(
+                user_id, session.chat_id, session.quiz_id, session.current, session.score, session.correct_count,
+                session.start_time, session.reward, session.xp_reward, quiz_sessions.deadline(user_id)
+            ) + _snap_str(session.quiz_name)
+        )
+    for chat_id, game in hangman_games.items():
+        records.append(
+            bytes([SNAP_HANGMAN]) + SNAP_HANGMAN_REC.pack(chat_id, game.creator, game.attempts, game.max_attempts, hangman_games.deadline(chat_id))
+            + _snap_str(game.word) + _snap_str(''.join(sorted(game.guessed)))
+        )
+    for user_id, session in code_compile_sessions.items():
+        records.append(
+            bytes([SNAP_CODE]) + SNAP_CODE_REC.pack(user_id, session.chat_id, code_compile_sessions.deadline(user_id))
+            + _snap_str(session.language)
+        )
+    payload = bytearray()
+    kept = 0
+    for record in records:
+        if len(payload) + len(record) > SESSION_SNAPSHOT_MAX_BYTES:
+            break
+        payload += record
+        kept += 1
+    if kept < len(records):
+        print(f"Session snapshot over budget: dropped {len(records) - kept} of {len(records)} sessions")
+    body = zlib.compress(bytes(payload), 6)
+    return SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, int(clean), time.time(), len(body)) + body, kept
+
+def _decode_snapshot(payload, version):
+    reader = SnapshotReader(payload)
+    sessions = []
+    while reader.pos < len(payload):
+        tag = payload[reader.pos]
+        reader.pos += 1
+        if tag == SNAP_BLACKJACK:
+            if version == 1:
+                # v1 records carry no nonce and can never be matched to an escrow row.
+                user_id, chat_id, bet, deadline = reader.struct(SNAP_BLACKJACK_REC_V1)
+                nonce = -1
+            else:
+                user_id, chat_id, bet, nonce, deadline = reader.struct(SNAP_BLACKJACK_REC)
+            deck = bytearray(reader.bytes())
+            player_hand, dealer_hand = BlackjackHand(reader.bytes()), BlackjackHand(reader.bytes())
+            sessions.append((tag, user_id, BlackjackSession(deck, player_hand, dealer_hand, bet, chat_id, nonce), deadline))
+        elif tag == SNAP_QUIZ:
+            user_id, chat_id, quiz_id, current, score, correct_count, start_time, reward, xp_reward, deadline = reader.struct(SNAP_QUIZ_REC)
+            session = QuizSession(quiz_id, reader.str(), None, chat_id, reward, xp_reward)
+            session.current, session.score, session.correct_count, session.start_time = current, score, correct_count, start_time
+            sessions.append((tag, user_id, session, deadline))
+        elif tag == SNAP_HANGMAN:
+            chat_id, creator, attempts, max_attempts, deadline = reader.struct(SNAP_HANGMAN_REC)
+            game = HangmanSession(reader.str(), creator, max_attempts)
+            game.attempts = attempts
+            game.guessed = set(reader.str())
+            sessions.append((tag, chat_id, game, deadline))
+        elif tag == SNAP_CODE:
+            user_id, chat_id, deadline = reader.struct(SNAP_CODE_REC)
+            sessions.append((tag, user_id, CodeSession(reader.str(), chat_id), deadline))
+        else:
+            raise ValueError(f"unknown record tag {tag}")
+    return sessions
+
+SNAPSHOT_DECODERS = {
+    1: lambda payload: _decode_snapshot(payload, 1),
+    2: lambda payload: _decode_snapshot(payload, 2),
+}
+
+def decode_session_snapshot(data):
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("not a session snapshot")
+    version, clean, written_at, length = SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+    decoder = SNAPSHOT_DECODERS.get(version)
+    if decoder is None:
+        raise ValueError(f"unsupported snapshot version {version}")
+    body = data[len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size:]
+    if len(body) != length:
+        raise ValueError("truncated snapshot")
+    return bool(clean), written_at, decoder(zlib.decompress(body))
+
+# Every write gets its own temp file and a sequence number taken when the
+# snapshot is encoded; an older write that finishes late never replaces a
+# newer one, so a periodic write still in its thread cannot clobber the
+# clean shutdown snapshot.
+snapshot_seq = itertools.count(1)
+snapshot_file_lock = threading.Lock()
+snapshot_written_seq = 0
+session_snapshot_task = None
+
+def _write_snapshot_file(path, data, seq):
+    global snapshot_written_seq
+    tmp_path = f"{path}.{seq}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    with snapshot_file_lock:
+        if seq > snapshot_written_seq:
+            os.replace(tmp_path, path)
+            snapshot_written_seq = seq
+            return
+    os.remove(tmp_path)
+
+async def write_session_snapshot(clean=False):
+    data, kept = encode_session_snapshot(clean)
+    await asyncio.to_thread(_write_snapshot_file, SESSION_SNAPSHOT_PATH, data, next(snapshot_seq))
+    return kept, len(data)
+
+async def restore_session_snapshot():
+    restored = 0
+    sessions = []
+    clean = False
+    if os.path.exists(SESSION_SNAPSHOT_PATH):
+        try:
+            with open(SESSION_SNAPSHOT_PATH, 'rb') as f:
+                clean, written_at, sessions = decode_session_snapshot(f.read())
+        except Exception as e:
+            print(f"Session snapshot ignored: {e}")
+        os.remove(SESSION_SNAPSHOT_PATH)
+    escrow = {
+        (user_id, game): (amount, chat_id, nonce)
+        for user_id, game, amount, chat_id, nonce in await db_fetchall("SELECT user_id, game, amount, chat_id, nonce FROM game_escrow")
+    }
+    for tag, key, session, deadline in sessions:
+        if tag == SNAP_BLACKJACK:
+            held = escrow.get((key, "bj"))
+            if not clean or held is None or (held[0], held[2]) != (session.bet, session.nonce):
+                continue
+            del escrow[(key, "bj")]
+            blackjack_games.restore(key, session, deadline)
+        elif tag == SNAP_QUIZ:
+            session.questions = await db_fetchall(
+                "SELECT question_id, question_text, option_a, option_b, option_c, option_d, correct_option FROM quiz_questions WHERE quiz_id = ?",
+                (session.quiz_id,)
+            )
+            finished = await db_fetchone(
+                "SELECT 1 FROM quiz_scores WHERE quiz_id = ? AND user_id = ? AND completed_at >= ?",
+                (session.quiz_id, key, int(session.start_time))
+            )
+            if finished or session.current >= len(session.questions):
+                continue
+            quiz_sessions.restore(key, session, deadline)
+        elif not clean:
+            continue
+        elif tag == SNAP_HANGMAN:
+            hangman_games.restore(key, session, deadline)
+        elif tag == SNAP_CODE:
+            code_compile_sessions.restore(key, session, deadline)
+        restored += 1
+    for (user_id, game), (amount, chat_id, _) in escrow.items():
+        await escrow_close(user_id, game)
+        await settle_game(user_id, f"{game}_refund", payout=amount)
+        try:
+            await bot.send_message(chat_id, f"Игра прервана перезапуском бота. Ставка {amount} EcsCoin возвращена.")
+        except Exception:
+            pass
+    if sessions or escrow:
+        print(f"Sessions restored: {restored} of {len(sessions)}, refunded bets: {len(escrow)}")
+    return restored
+
+async def session_snapshot_loop():
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+        if shutting_down:
+            break
+        try:
+            await write_session_snapshot()
+        except Exception as e:
+            print(f"Session snapshot error: {e}")
 
 class QuizCreation(StatesGroup):
     waiting_for_name = State()
@@ -83,8 +1016,183 @@ class CodeExecution(StatesGroup):
     waiting_for_code = State()
     waiting_for_language = State()
 
-def init_db():
-    cursor.execute("""
+async def db_configure(connection):
+    await connection.execute("PRAGMA journal_mode=WAL")
+    await connection.execute("PRAGMA synchronous=NORMAL")
+    await connection.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    await connection.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    await connection.execute("PRAGMA temp_store=MEMORY")
+    await connection.execute("PRAGMA busy_timeout=5000")
+    if DEV_MODE:
+        await connection.set_trace_callback(_db_trace)
+
+# Dev mode only: every statement SQLite runs is recorded under a literal-free
+# shape so explain_registered_queries() can replay its plan and flag scans.
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+def _db_trace(statement):
+    verb = statement.split(None, 1)[0].upper() if statement.strip() else ""
+    if verb not in ("SELECT", "UPDATE", "DELETE", "WITH"):
+        return
+    shape = " ".join(_SQL_LITERAL_RE.sub("?", statement).split())
+    if shape not in db_query_registry and len(db_query_registry) < QUERY_REGISTRY_LIMIT:
+        db_query_registry[shape] = statement
+
+async def explain_registered_queries():
+    findings = []
+    for shape, sample in list(db_query_registry.items()):
+        try:
+            plan = await db_report(f"EXPLAIN QUERY PLAN {sample}")
+        except Exception as e:
+            findings.append((shape, [f"error: {e}"]))
+            continue
+        scans = [row[3] for row in plan if row[3].startswith("SCAN ") and " USING " not in row[3] and row[3] != "SCAN CONSTANT ROW"]
+        if scans:
+            findings.append((shape, scans))
+    return findings
+
+async def db_connect():
+    global db
+    db = await aiosqlite.connect(DB_PATH, isolation_level=None)
+    await db_configure(db)
+
+async def db_connect_reader():
+    global db_reader
+    db_reader = await aiosqlite.connect(DB_PATH, isolation_level=None)
+    await db_configure(db_reader)
+    await db_reader.execute("PRAGMA query_only=ON")
+
+async def db_close():
+    if db_reader is not None:
+        await db_reader.close()
+    if db is not None:
+        await db_flush()
+        await db.close()
+
+async def db_fetchone(query, params=()):
+    async with db.execute(query, params) as cur:
+        return await cur.fetchone()
+
+async def db_fetchall(query, params=()):
+    async with db.execute(query, params) as cur:
+        return await cur.fetchall()
+
+async def db_report(query, params=()):
+    async with db_reader.execute(query, params) as cur:
+        return await cur.fetchall()
+
+# Group commit: writes are visible to every handler as soon as they run,
+# become durable at the next batch COMMIT (at most COMMIT_WINDOW after the
+# first pending write) and always before CommitMiddleware lets the update
+# finish. db_flush() forces the batch out and is called on shutdown.
+# Only writes followed by a successful db_sync() are guaranteed durable: if
+# a background COMMIT fails, the whole batch is rolled back and the error is
+# only logged, so anything already acknowledged to a user is lost.
+async def _db_begin():
+    global db_in_tx
+    if not db_in_tx:
+        await db.execute("BEGIN")
+        db_in_tx = True
+
+def _db_schedule_commit():
+    global db_pending_writes, db_commit_task
+    db_pending_writes += 1
+    db_commit_stats["writes"] += 1
+    if db_pending_writes >= COMMIT_MAX_PENDING and db_commit_task is not None and not db_commit_task.done():
+        db_commit_task.cancel()
+        db_commit_task = None
+    if db_commit_task is None or db_commit_task.done():
+        delay = 0 if db_pending_writes >= COMMIT_MAX_PENDING else COMMIT_WINDOW
+        db_commit_task = asyncio.create_task(_db_commit_later(delay))
+
+async def _db_commit_later(delay):
+    global db_commit_task
+    await asyncio.sleep(delay)
+    db_commit_task = None
+    try:
+        await db_flush()
+    except Exception as e:
+        # db_sync() waiters already got the error; nobody else will see it.
+        print(f"Background commit failed, batch rolled back: {e}")
+
+# A failed batch rolls back every write in it, including ones the user
+# cache and the leaderboard already reflect (and reads on the writer
+# connection may have cached uncommitted values), so both are rebuilt
+# from what the database actually holds.
+def _db_rolled_back():
+    user_cache.clear()
+    asyncio.create_task(load_leaderboard())
+
+async def db_flush():
+    global db_in_tx, db_pending_writes, db_commit_task
+    async with db_write_lock:
+        waiters = db_commit_waiters[:]
+        db_commit_waiters.clear()
+        try:
+            if db_in_tx:
+                try:
+                    await db.execute("COMMIT")
+                    db_commit_stats["commits"] += 1
+                except Exception:
+                    await db.execute("ROLLBACK")
+                    _db_rolled_back()
+                    raise
+                finally:
+                    db_in_tx = False
+                    db_pending_writes = 0
+        except Exception as e:
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_exception(e)
+            raise
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+    if db_commit_waiters and (db_commit_task is None or db_commit_task.done()):
+        db_commit_task = asyncio.create_task(_db_commit_later(0))
+
+async def db_sync():
+    global db_commit_task
+    if not db_in_tx:
+        return
+    fut = asyncio.get_running_loop().create_future()
+    db_commit_waiters.append(fut)
+    if db_commit_task is None or db_commit_task.done():
+        db_commit_task = asyncio.create_task(_db_commit_later(COMMIT_WINDOW))
+    await fut
+
+async def db_execute(query, params=()):
+    async with db_write_lock:
+        await _db_begin()
+        cur = await db.execute(query, params)
+        _db_schedule_commit()
+        return cur
+
+@asynccontextmanager
+async def db_transaction():
+    async with db_write_lock:
+        await _db_begin()
+        await db.execute("SAVEPOINT tx")
+        try:
+            yield db
+        except BaseException:
+            # Cancellation too: a savepoint left open would swallow the next
+            # one and the half-done work would be committed with the batch.
+            await db.execute("ROLLBACK TO tx")
+            await db.execute("RELEASE tx")
+            raise
+        await db.execute("RELEASE tx")
+        _db_schedule_commit()
+
+async def _migration_initial_schema(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version(
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at INTEGER NOT NULL
+    )""")
+
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS users(
         user_id INTEGER PRIMARY KEY,
         username TEXT,
@@ -97,7 +1205,7 @@ def init_db():
         last_daily INTEGER DEFAULT 0
     )""")
 
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS items(
         item_id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT,
@@ -106,7 +1214,7 @@ def init_db():
         price INTEGER
     )""")
 
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS inventory(
         user_id INTEGER,
         item_id INTEGER,
@@ -116,7 +1224,7 @@ def init_db():
         FOREIGN KEY(item_id) REFERENCES items(item_id)
     )""")
 
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS loans(
         loan_id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
@@ -125,7 +1233,7 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS raids(
         raid_id INTEGER PRIMARY KEY,
         target_user_id INTEGER,
@@ -137,7 +1245,7 @@ def init_db():
         FOREIGN KEY(target_user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS raid_participants(
         raid_id INTEGER,
         user_id INTEGER,
@@ -147,7 +1255,7 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS bosses(
         boss_id INTEGER PRIMARY KEY,
         name TEXT,
@@ -161,7 +1269,7 @@ def init_db():
         status TEXT DEFAULT 'alive'
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS boss_raids(
         boss_raid_id INTEGER PRIMARY KEY AUTOINCREMENT,
         boss_id INTEGER,
@@ -172,7 +1280,7 @@ def init_db():
         FOREIGN KEY(boss_id) REFERENCES bosses(boss_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS boss_raid_participants(
         boss_raid_id INTEGER,
         user_id INTEGER,
@@ -182,7 +1290,7 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS boss_drops(
         drop_id INTEGER PRIMARY KEY AUTOINCREMENT,
         boss_id INTEGER,
@@ -192,7 +1300,7 @@ def init_db():
         FOREIGN KEY(item_id) REFERENCES items(item_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS loot_boxes(
         box_id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT,
@@ -201,7 +1309,7 @@ def init_db():
         created_at INTEGER
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS loot_box_items(
         box_id INTEGER,
         item_id INTEGER,
@@ -211,7 +1319,7 @@ def init_db():
         FOREIGN KEY(item_id) REFERENCES items(item_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS clans(
         clan_id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT UNIQUE NOT NULL,
@@ -221,7 +1329,7 @@ def init_db():
         FOREIGN KEY(owner_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS clan_members(
         clan_id INTEGER,
         user_id INTEGER,
@@ -231,7 +1339,7 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS clan_join_requests(
         request_id INTEGER PRIMARY KEY AUTOINCREMENT,
         clan_id INTEGER NOT NULL,
@@ -241,7 +1349,7 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS apk_uploads(
         upload_id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -254,14 +1362,14 @@ def init_db():
         status TEXT DEFAULT 'uploaded'
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS word_list(
         word_id INTEGER PRIMARY KEY AUTOINCREMENT,
         word TEXT UNIQUE NOT NULL,
         language TEXT DEFAULT 'ru'
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS quizzes(
         quiz_id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL,
@@ -276,7 +1384,7 @@ def init_db():
         FOREIGN KEY(creator_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS quiz_questions(
         question_id INTEGER PRIMARY KEY AUTOINCREMENT,
         quiz_id INTEGER NOT NULL,
@@ -291,7 +1399,7 @@ def init_db():
         FOREIGN KEY(quiz_id) REFERENCES quizzes(quiz_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS quiz_scores(
         score_id INTEGER PRIMARY KEY AUTOINCREMENT,
         quiz_id INTEGER NOT NULL,
@@ -305,7 +1413,7 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
     
-    cursor.execute("""
+    await tx.execute("""
     CREATE TABLE IF NOT EXISTS code_executions(
         execution_id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -317,22 +1425,23 @@ def init_db():
         executed_at INTEGER NOT NULL,
         FOREIGN KEY(user_id) REFERENCES users(user_id)
     )""")
-    
-    cursor.execute("PRAGMA table_info(users)")
-    columns = [col[1] for col in cursor.fetchall()]
+
+async def _migration_users_stats_columns(tx):
+    async with tx.execute("PRAGMA table_info(users)") as cur:
+        columns = [col[1] for col in await cur.fetchall()]
     if 'wins' not in columns:
-        cursor.execute("ALTER TABLE users ADD COLUMN wins INTEGER DEFAULT 0")
+        await tx.execute("ALTER TABLE users ADD COLUMN wins INTEGER DEFAULT 0")
     if 'losses' not in columns:
-        cursor.execute("ALTER TABLE users ADD COLUMN losses INTEGER DEFAULT 0")
+        await tx.execute("ALTER TABLE users ADD COLUMN losses INTEGER DEFAULT 0")
     if 'games_played' not in columns:
-        cursor.execute("ALTER TABLE users ADD COLUMN games_played INTEGER DEFAULT 0")
+        await tx.execute("ALTER TABLE users ADD COLUMN games_played INTEGER DEFAULT 0")
     if 'last_daily' not in columns:
-        cursor.execute("ALTER TABLE users ADD COLUMN last_daily INTEGER DEFAULT 0")
-    
-    conn.commit()
+        await tx.execute("ALTER TABLE users ADD COLUMN last_daily INTEGER DEFAULT 0")
 
-    cursor.execute("SELECT COUNT(*) FROM items")
-    if cursor.fetchone()[0] == 0:
+async def _migration_seed_data(tx):
+    async with tx.execute("SELECT COUNT(*) FROM items") as cur:
+        items_count = (await cur.fetchone())[0]
+    if items_count == 0:
         seed_items = [
             ("Деревянный меч", "weapon", 3, 30),
             ("Ржавый меч", "weapon", 5, 50),
@@ -349,11 +1458,11 @@ def init_db():
             ("Большое зелье", "potion", 100, 100),
             ("Эликсир жизни", "potion", 200, 200),
         ]
-        cursor.executemany("INSERT INTO items(name,type,power,price) VALUES (?, ?, ?, ?)", seed_items)
-        conn.commit()
+        await tx.executemany("INSERT INTO items(name,type,power,price) VALUES (?, ?, ?, ?)", seed_items)
     
-    cursor.execute("SELECT COUNT(*) FROM word_list")
-    if cursor.fetchone()[0] == 0:
+    async with tx.execute("SELECT COUNT(*) FROM word_list") as cur:
+        words_count = (await cur.fetchone())[0]
+    if words_count == 0:
         seed_words = [
             "программа", "компьютер", "интернет", "телефон", "игра", "музыка",
             "фильм", "книга", "школа", "университет", "работа", "семья",
@@ -364,10 +1473,289 @@ def init_db():
             "кухня", "ванная", "спальня", "гостиная", "окно", "дверь",
             "стол", "стул", "кровать", "диван", "телевизор", "холодильник"
         ]
-        cursor.executemany("INSERT INTO word_list(word, language) VALUES (?, 'ru')", [(w,) for w in seed_words])
-        conn.commit()
+        await tx.executemany("INSERT INTO word_list(word, language) VALUES (?, 'ru')", [(w,) for w in seed_words])
+
+async def _migration_ledger(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS ledger(
+        entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    )""")
+    
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id, entry_id)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_ledger_created ON ledger(created_at)")
+    
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS ledger_snapshots(
+        user_id INTEGER PRIMARY KEY,
+        balance_delta INTEGER NOT NULL DEFAULT 0,
+        entries INTEGER NOT NULL DEFAULT 0,
+        last_entry_id INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL
+    )""")
+
+async def _migration_leaderboard(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS quiz_totals(
+        user_id INTEGER PRIMARY KEY,
+        score INTEGER NOT NULL DEFAULT 0,
+        games INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0
+    )""")
+    
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS leaderboard_state(
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )""")
+    
+    await tx.execute("""
+    INSERT OR REPLACE INTO quiz_totals(user_id, score, games, correct, total)
+    SELECT user_id, SUM(score), COUNT(*), SUM(correct_answers), SUM(total_questions)
+    FROM quiz_scores
+    GROUP BY user_id""")
+    
+    await tx.execute("""
+    INSERT OR REPLACE INTO leaderboard_state(key, value)
+    SELECT 'quiz_last_score_id', COALESCE(MAX(score_id), 0) FROM quiz_scores""")
+
+async def _migration_secondary_indexes(tx):
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_loans_user ON loans(user_id)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_apk_uploads_expires ON apk_uploads(expires_at)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_apk_uploads_user ON apk_uploads(user_id, uploaded_at)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_quiz_questions_quiz ON quiz_questions(quiz_id)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_quiz_scores_quiz ON quiz_scores(quiz_id)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_quizzes_creator ON quizzes(creator_id)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_quizzes_public ON quizzes(is_public, times_played)")
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_word_list_language ON word_list(language)")
+    await tx.execute("ANALYZE")
+
+async def _migration_apk_jobs(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS apk_jobs(
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        upload_id INTEGER,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        started_at INTEGER,
+        finished_at INTEGER,
+        error TEXT
+    )""")
+    
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_apk_jobs_status ON apk_jobs(status)")
+
+async def _migration_apk_entries(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS apk_entries(
+        upload_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        file_size INTEGER NOT NULL,
+        compress_size INTEGER NOT NULL,
+        crc INTEGER NOT NULL,
+        header_offset INTEGER NOT NULL,
+        compress_type INTEGER NOT NULL,
+        PRIMARY KEY(upload_id, name)
+    ) WITHOUT ROWID""")
+    
+    await tx.execute("ALTER TABLE apk_uploads ADD COLUMN indexed_at INTEGER")
+
+async def _migration_apk_search(tx):
+    await tx.execute("ALTER TABLE apk_entries ADD COLUMN kind TEXT")
+    await tx.execute("""
+    UPDATE apk_entries SET kind = CASE
+        WHEN name GLOB '*.dex' THEN 'dex'
+        WHEN name = 'AndroidManifest.xml' THEN 'manifest'
+        WHEN name = 'resources.arsc' THEN 'arsc'
+        WHEN name GLOB 'res/*' THEN 'res'
+        WHEN name GLOB 'assets/*' THEN 'assets'
+        WHEN name GLOB 'lib/*' THEN 'lib'
+        WHEN name GLOB 'META-INF/*' THEN 'meta'
+        ELSE 'other'
+    END""")
+    
+    await tx.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS apk_search USING fts5(
+        source UNINDEXED,
+        text,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )""")
+    
+    await tx.execute("ALTER TABLE apk_uploads ADD COLUMN summary TEXT")
+    await tx.execute("ALTER TABLE apk_uploads ADD COLUMN search_first INTEGER")
+    await tx.execute("ALTER TABLE apk_uploads ADD COLUMN search_last INTEGER")
+    await tx.execute("ALTER TABLE apk_uploads ADD COLUMN content_indexed_at INTEGER")
+
+async def _migration_apk_extraction_manifest(tx):
+    await tx.execute("ALTER TABLE apk_entries ADD COLUMN extracted_mtime INTEGER")
+    await tx.execute("ALTER TABLE apk_entries ADD COLUMN extracted_size INTEGER")
+
+async def _migration_apk_blobs(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS apk_blobs(
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL
+    ) WITHOUT ROWID""")
+    
+    await tx.execute("CREATE INDEX IF NOT EXISTS idx_apk_blobs_unreferenced ON apk_blobs(refcount) WHERE refcount <= 0")
+    await tx.execute("ALTER TABLE apk_uploads ADD COLUMN blob_sha256 TEXT")
+    await tx.execute("ALTER TABLE apk_entries ADD COLUMN blob_sha256 TEXT")
+
+async def _migration_fsm_states(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_states(
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        bucket TEXT NOT NULL DEFAULT '{}',
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY(chat_id, user_id)
+    ) WITHOUT ROWID""")
+
+async def _migration_game_escrow(tx):
+    await tx.execute("""
+    CREATE TABLE IF NOT EXISTS game_escrow(
+        user_id INTEGER NOT NULL,
+        game TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY(user_id, game)
+    ) WITHOUT ROWID""")
+
+async def _migration_game_escrow_nonce(tx):
+    await tx.execute("ALTER TABLE game_escrow ADD COLUMN nonce INTEGER NOT NULL DEFAULT 0")
+
+MIGRATIONS = [
+    (1, "initial schema", _migration_initial_schema),
+    (2, "users stats columns", _migration_users_stats_columns),
+    (3, "seed items and words", _migration_seed_data),
+    (4, "transaction ledger", _migration_ledger),
+    (5, "materialized leaderboards", _migration_leaderboard),
+    (6, "secondary indexes", _migration_secondary_indexes),
+    (7, "apk jobs", _migration_apk_jobs),
+    (8, "apk central directory index", _migration_apk_entries),
+    (9, "apk content search", _migration_apk_search),
+    (10, "apk extraction manifest", _migration_apk_extraction_manifest),
+    (11, "apk blob store", _migration_apk_blobs),
+    (12, "fsm states", _migration_fsm_states),
+    (13, "game escrow", _migration_game_escrow),
+    (14, "game escrow nonce", _migration_game_escrow_nonce),
+]
+
+async def get_schema_version():
+    try:
+        row = await db_fetchone("SELECT MAX(version) FROM schema_version")
+    except aiosqlite.OperationalError:
+        return 0
+    return row[0] or 0
+
+async def migrate_db():
+    current = await get_schema_version()
+    for version, name, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        async with db_transaction() as tx:
+            await migration(tx)
+            await tx.execute(
+                "INSERT INTO schema_version(version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, int(time.time()))
+            )
+        await db_flush()
+        print(f"DB migrated to v{version}: {name}")
+
+async def init_db():
+    await db_connect()
+    await migrate_db()
+    await db_connect_reader()
+    await load_leaderboard()
+
+async def load_leaderboard():
+    leaderboard.load_players(await db_fetchall("SELECT user_id, username, level, xp, balance, wins FROM users"))
+    row = await db_fetchone("SELECT value FROM leaderboard_state WHERE key = 'quiz_last_score_id'")
+    last_score_id = row[0] if row else 0
+    leaderboard.load_quiz(await db_fetchall("SELECT user_id, score, games, correct, total FROM quiz_totals"), last_score_id)
+    missed = await db_fetchall(
+        "SELECT score_id, user_id, score, correct_answers, total_questions FROM quiz_scores WHERE score_id > ? ORDER BY score_id",
+        (last_score_id,)
+    )
+    for score_id, user_id, score, correct, total in missed:
+        leaderboard.add_quiz_result(score_id, user_id, score, correct, total)
+
+async def persist_leaderboard():
+    if not leaderboard.quiz_dirty:
+        return
+    dirty = list(leaderboard.quiz_dirty)
+    leaderboard.quiz_dirty.clear()
+    async with db_transaction() as tx:
+        await tx.executemany(
+            "INSERT OR REPLACE INTO quiz_totals(user_id, score, games, correct, total) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, *leaderboard.quiz[user_id]) for user_id in dirty if user_id in leaderboard.quiz]
+        )
+        await tx.execute(
+            "INSERT OR REPLACE INTO leaderboard_state(key, value) VALUES ('quiz_last_score_id', ?)",
+            (leaderboard.quiz_last_score_id,)
+        )
+
+# The board is reloaded inside the same write-locked transaction, and
+# finish_quiz adds a result inside the transaction that inserts it, so a
+# score is either part of the rebuilt totals or added after the reload,
+# never both or neither.
+async def rebuild_quiz_leaderboard():
+    async with db_transaction() as tx:
+        await tx.execute("DELETE FROM quiz_totals")
+        await tx.execute("DELETE FROM leaderboard_state WHERE key = 'quiz_last_score_id'")
+        await _migration_leaderboard(tx)
+        async with tx.execute("SELECT value FROM leaderboard_state WHERE key = 'quiz_last_score_id'") as cur:
+            row = await cur.fetchone()
+        async with tx.execute("SELECT user_id, score, games, correct, total FROM quiz_totals") as cur:
+            leaderboard.load_quiz(await cur.fetchall(), row[0] if row else 0)
+    await db_sync()
+
+async def leaderboard_persist_loop():
+    while True:
+        await asyncio.sleep(LEADERBOARD_PERSIST_INTERVAL)
+        try:
+            await persist_leaderboard()
+        except Exception as e:
+            print(f"Leaderboard persist error: {e}")
+
+handler_tasks = set()
+shutting_down = False
+
+class InflightMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        handler_tasks.add(asyncio.current_task())
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        handler_tasks.discard(asyncio.current_task())
+
+async def drain_handlers(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+    global shutting_down
+    shutting_down = True
+    dp.stop_polling()
+    pending = handler_tasks - {asyncio.current_task()}
+    if pending:
+        print(f"Waiting for {len(pending)} running handlers...")
+        done, pending = await asyncio.wait(pending, timeout=timeout)
+        if pending:
+            print(f"Shutdown: {len(pending)} handlers still running after {timeout:.0f}s")
+
+class OutboundPriorityMiddleware(BaseMiddleware):
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        outbound_priority.set(OUTBOUND_REPLY)
 
-init_db()
+    async def on_pre_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        outbound_priority.set(OUTBOUND_INTERACTIVE)
 
 class BanMiddleware(BaseMiddleware):
     async def on_pre_process_message(self, message: types.Message, data: dict):
@@ -375,136 +1763,375 @@ class BanMiddleware(BaseMiddleware):
             await message.reply("Ты в бане и не можешь использовать бота.")
             raise CancelHandler()
 
+class CommitMiddleware(BaseMiddleware):
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        await db_sync()
+
+    async def on_post_process_callback_query(self, callback: types.CallbackQuery, results, data: dict):
+        await db_sync()
+
+dp.middleware.setup(InflightMiddleware())
+dp.middleware.setup(OutboundPriorityMiddleware())
 dp.middleware.setup(BanMiddleware())
+dp.middleware.setup(CommitMiddleware())
+
+class UserCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self.entries[user_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(user)
+
+    def put(self, user_id, user):
+        self.entries[user_id] = (time.monotonic() + self.ttl, dict(user))
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def begin_load(self, user_id):
+        pending, dirty = self.loading.get(user_id, (0, False))
+        self.loading[user_id] = (pending + 1, dirty)
+
+    def end_load(self, user_id, user):
+        pending, dirty = self.loading.pop(user_id)
+        if pending > 1:
+            self.loading[user_id] = (pending - 1, dirty)
+        if user is not None and not dirty:
+            self.put(user_id, user)
+
+    def _mark_dirty(self, user_id):
+        if user_id in self.loading:
+            pending, _ = self.loading[user_id]
+            self.loading[user_id] = (pending, True)
+
+    def update(self, user_id, **fields):
+        self._mark_dirty(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def adjust(self, user_id, **deltas):
+        self._mark_dirty(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            for field, delta in deltas.items():
+                entry[1][field] += delta
+
+    def add_xp(self, user_id, xp_gain):
+        self._mark_dirty(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            user = entry[1]
+            total = user['xp'] + xp_gain
+            user['xp'] = total % LEVEL_XP
+            user['level'] += total // LEVEL_XP
+
+    def invalidate(self, user_id):
+        self._mark_dirty(user_id)
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        for user_id in self.loading:
+            self._mark_dirty(user_id)
+        self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+class Leaderboard:
+    def __init__(self):
+        self.players = {}
+        self.player_order = []
+        self.quiz = {}
+        self.quiz_order = []
+        self.quiz_dirty = set()
+        self.quiz_last_score_id = 0
+
+    def load_players(self, rows):
+        self.players = {}
+        for user_id, username, level, xp, balance, wins in rows:
+            self.players[user_id] = [level, xp, username, balance, wins or 0]
+        self.player_order = self._sorted_players()
+
+    def _sorted_players(self):
+        return sorted((-p[0], -p[1], user_id) for user_id, p in self.players.items())
+
+    def _sorted_quiz(self):
+        return sorted((-q[0], user_id) for user_id, q in self.quiz.items())
+
+    def load_quiz(self, rows, last_score_id):
+        self.quiz = {user_id: [score, games, correct, total] for user_id, score, games, correct, total in rows}
+        self.quiz_order = self._sorted_quiz()
+        self.quiz_dirty.clear()
+        self.quiz_last_score_id = last_score_id
+
+    # The dicts are authoritative. If the sorted list no longer holds old_key
+    # (it diverged from the dict, e.g. while a reload is in flight), it is
+    # rebuilt instead of dropping whichever entry sits at that position.
+    def _move(self, order, old_key, new_key, rebuild):
+        if old_key == new_key:
+            return
+        i = bisect.bisect_left(order, old_key)
+        if i < len(order) and order[i] == old_key:
+            del order[i]
+            bisect.insort(order, new_key)
+        else:
+            order[:] = rebuild()
+
+    def upsert_player(self, user):
+        player = self.players.get(user['user_id'])
+        if player is None:
+            self.players[user['user_id']] = [user['level'], user['xp'], user['username'], user['balance'], user['wins']]
+            bisect.insort(self.player_order, (-user['level'], -user['xp'], user['user_id']))
+        else:
+            self.update_player(user['user_id'], level=user['level'], xp=user['xp'], username=user['username'],
+                               balance=user['balance'], wins=user['wins'])
 
-def ensure_user(user: types.User):
+    def update_player(self, user_id, **fields):
+        player = self.players.get(user_id)
+        if player is None:
+            return
+        old_key = (-player[0], -player[1], user_id)
+        player[0] = fields.get('level', player[0])
+        player[1] = fields.get('xp', player[1])
+        player[2] = fields.get('username', player[2])
+        player[3] = fields.get('balance', player[3])
+        player[4] = fields.get('wins', player[4])
+        self._move(self.player_order, old_key, (-player[0], -player[1], user_id), self._sorted_players)
+
+    def adjust_player(self, user_id, balance=0, wins=0, **_):
+        player = self.players.get(user_id)
+        if player is not None:
+            player[3] += balance
+            player[4] += wins
+
+    def add_player_xp(self, user_id, xp_gain):
+        player = self.players.get(user_id)
+        if player is None:
+            return
+        total = player[1] + xp_gain
+        self.update_player(user_id, xp=total % LEVEL_XP, level=player[0] + total // LEVEL_XP)
+
+    def add_quiz_result(self, score_id, user_id, score, correct, total):
+        entry = self.quiz.get(user_id)
+        if entry is None:
+            entry = self.quiz[user_id] = [0, 0, 0, 0]
+            bisect.insort(self.quiz_order, (0, user_id))
+        old_key = (-entry[0], user_id)
+        entry[0] += score
+        entry[1] += 1
+        entry[2] += correct
+        entry[3] += total
+        self._move(self.quiz_order, old_key, (-entry[0], user_id), self._sorted_quiz)
+        self.quiz_dirty.add(user_id)
+        self.quiz_last_score_id = max(self.quiz_last_score_id, score_id)
+
+    def top_players(self, limit=10):
+        return [(user_id, *self.players[user_id]) for _, _, user_id in self.player_order[:limit]]
+
+    def top_quiz(self, limit=10):
+        return [(user_id, *self.quiz[user_id]) for _, user_id in self.quiz_order[:limit]]
+
+leaderboard = Leaderboard()
+
+def apply_user_delta(user_id, **deltas):
+    user_cache.adjust(user_id, **deltas)
+    leaderboard.adjust_player(user_id, **deltas)
+
+def apply_user_fields(user_id, **fields):
+    user_cache.update(user_id, **fields)
+    leaderboard.update_player(user_id, **fields)
+
+def apply_user_xp(user_id, xp_gain):
+    user_cache.add_xp(user_id, xp_gain)
+    leaderboard.add_player_xp(user_id, xp_gain)
+
+async def ensure_user(user: types.User):
     username = user.username if user.username else user.first_name
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
-    if cursor.fetchone() is None:
-        cursor.execute(
-            "INSERT INTO users(user_id, username, balance, xp, level) VALUES (?, ?, ?, ?, ?)",
-            (user.id, username, START_BALANCE, 0, 1)
-        )
-        conn.commit()
-    else:
-        cursor.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user.id))
-        conn.commit()
-
-def ensure_user_by_id(user_id, username="unknown"):
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-    if cursor.fetchone() is None:
-        cursor.execute(
-            "INSERT INTO users(user_id, username, balance, xp, level) VALUES (?, ?, ?, ?, ?)",
-            (user_id, username, START_BALANCE, 0, 1)
+    cached = user_cache.get(user.id)
+    if cached is not None:
+        if cached['username'] != username:
+            await db_execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user.id))
+            apply_user_fields(user.id, username=username)
+        return
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT user_id, username, balance, xp, level, wins, losses, games_played, last_daily FROM users WHERE user_id = ?", (user.id,)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            await tx.execute(
+                "INSERT INTO users(user_id, username, balance, xp, level) VALUES (?, ?, ?, ?, ?)",
+                (user.id, username, START_BALANCE, 0, 1)
+            )
+            row = (user.id, username, START_BALANCE, 0, 1, 0, 0, 0, 0)
+        elif row[1] != username:
+            await tx.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user.id))
+            row = (row[0], username) + tuple(row[2:])
+    user_cache.put(user.id, _user_from_row(row))
+    leaderboard.upsert_player(_user_from_row(row))
+
+async def ensure_user_by_id(user_id, username="unknown"):
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            await tx.execute(
+                "INSERT INTO users(user_id, username, balance, xp, level) VALUES (?, ?, ?, ?, ?)",
+                (user_id, username, START_BALANCE, 0, 1)
+            )
+        else:
+            await tx.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
+    apply_user_fields(user_id, username=username)
+    if row is None:
+        leaderboard.upsert_player(_user_from_row((user_id, username, START_BALANCE, 0, 1, 0, 0, 0, 0)))
+
+async def get_user(user_id):
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    user_cache.begin_load(user_id)
+    user = None
+    try:
+        row = await db_fetchone("SELECT user_id, username, balance, xp, level, wins, losses, games_played, last_daily FROM users WHERE user_id = ?", (user_id,))
+        if row:
+            user = _user_from_row(row)
+    finally:
+        user_cache.end_load(user_id, user)
+    return dict(user) if user else None
+
+def _user_from_row(row):
+    return {
+        "user_id": row[0], 
+        "username": row[1], 
+        "balance": row[2], 
+        "xp": row[3], 
+        "level": row[4],
+        "wins": row[5] or 0,
+        "losses": row[6] or 0,
+        "games_played": row[7] or 0,
+        "last_daily": row[8] or 0
+    }
+
+# Ledger rows are written in the same savepoint as the balance change they
+# describe, so a rolled-back batch takes its history with it. They reach
+# disk with the rest of the group commit.
+async def ledger_record(tx, user_id, delta, reason):
+    if delta:
+        await tx.execute(
+            "INSERT INTO ledger(user_id, delta, reason, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, delta, reason, int(time.time()))
         )
-        conn.commit()
-    else:
-        cursor.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
-        conn.commit()
 
-def get_user(user_id):
-    cursor.execute("SELECT user_id, username, balance, xp, level, wins, losses, games_played, last_daily FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    if row:
-        return {
-            "user_id": row[0], 
-            "username": row[1], 
-            "balance": row[2], 
-            "xp": row[3], 
-            "level": row[4],
-            "wins": row[5] or 0,
-            "losses": row[6] or 0,
-            "games_played": row[7] or 0,
-            "last_daily": row[8] or 0
-        }
-    return None
-
-def update_balance(user_id, delta):
-    cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (delta, user_id))
-    conn.commit()
-
-def add_xp(user_id, xp_gain):
-    cursor.execute("SELECT xp, level FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    if not row: return
-    xp, lvl = row
-    xp += xp_gain
-    leveled = 0
-    while xp >= LEVEL_XP:
-        xp -= LEVEL_XP
-        lvl += 1
-        leveled += 1
-    cursor.execute("UPDATE users SET xp = ?, level = ? WHERE user_id = ?", (xp, lvl, user_id))
-    conn.commit()
+async def update_balance(user_id, delta, reason="adjust"):
+    async with db_transaction() as tx:
+        await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (delta, user_id))
+        await ledger_record(tx, user_id, delta, reason)
+    apply_user_delta(user_id, balance=delta)
+
+async def add_xp(user_id, xp_gain):
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT xp, level FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if not row: return
+        xp, lvl = row
+        xp += xp_gain
+        leveled = 0
+        while xp >= LEVEL_XP:
+            xp -= LEVEL_XP
+            lvl += 1
+            leveled += 1
+        await tx.execute("UPDATE users SET xp = ?, level = ? WHERE user_id = ?", (xp, lvl, user_id))
+    apply_user_fields(user_id, xp=xp, level=lvl)
     return leveled
 
-def remove_xp(user_id, xp_loss):
-    cursor.execute("SELECT xp, level FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    if not row:
-        return 0
-    xp, lvl = row
-    xp -= xp_loss
-    while xp < 0 and lvl > 1:
-        xp += LEVEL_XP
-        lvl -= 1
-    if xp < 0:
-        xp = 0
-    cursor.execute("UPDATE users SET xp = ?, level = ? WHERE user_id = ?", (xp, lvl, user_id))
-    conn.commit()
+async def remove_xp(user_id, xp_loss):
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT xp, level FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return 0
+        xp, lvl = row
+        xp -= xp_loss
+        while xp < 0 and lvl > 1:
+            xp += LEVEL_XP
+            lvl -= 1
+        if xp < 0:
+            xp = 0
+        await tx.execute("UPDATE users SET xp = ?, level = ? WHERE user_id = ?", (xp, lvl, user_id))
+    apply_user_fields(user_id, xp=xp, level=lvl)
     return lvl
 
-def get_items():
-    cursor.execute("SELECT item_id, name, type, power, price FROM items")
-    return cursor.fetchall()
+async def get_items():
+    return await db_fetchall("SELECT item_id, name, type, power, price FROM items")
 
-def get_item(item_id):
-    cursor.execute("SELECT item_id, name, type, power, price FROM items WHERE item_id = ?", (item_id,))
-    return cursor.fetchone()
-
-def add_item_to_user(user_id, item_id, qty=1):
-    cursor.execute("SELECT qty FROM inventory WHERE user_id = ? AND item_id = ?", (user_id, item_id))
-    row = cursor.fetchone()
-    if row:
-        cursor.execute("UPDATE inventory SET qty = qty + ? WHERE user_id = ? AND item_id = ?", (qty, user_id, item_id))
-    else:
-        cursor.execute("INSERT INTO inventory(user_id, item_id, qty) VALUES (?, ?, ?)", (user_id, item_id, qty))
-    conn.commit()
+async def get_item(item_id):
+    return await db_fetchone("SELECT item_id, name, type, power, price FROM items WHERE item_id = ?", (item_id,))
 
-def remove_item_from_user(user_id, item_id, qty=1):
-    cursor.execute("SELECT qty FROM inventory WHERE user_id = ? AND item_id = ?", (user_id, item_id))
-    row = cursor.fetchone()
-    if not row:
-        return False
-    current_qty = row[0]
-    if current_qty <= qty:
-        cursor.execute("DELETE FROM inventory WHERE user_id = ? AND item_id = ?", (user_id, item_id))
-    else:
-        cursor.execute("UPDATE inventory SET qty = qty - ? WHERE user_id = ? AND item_id = ?", (qty, user_id, item_id))
-    conn.commit()
+async def add_item_to_user(user_id, item_id, qty=1):
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT qty FROM inventory WHERE user_id = ? AND item_id = ?", (user_id, item_id)) as cur:
+            row = await cur.fetchone()
+        if row:
+            await tx.execute("UPDATE inventory SET qty = qty + ? WHERE user_id = ? AND item_id = ?", (qty, user_id, item_id))
+        else:
+            await tx.execute("INSERT INTO inventory(user_id, item_id, qty) VALUES (?, ?, ?)", (user_id, item_id, qty))
+
+async def remove_item_from_user(user_id, item_id, qty=1):
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT qty FROM inventory WHERE user_id = ? AND item_id = ?", (user_id, item_id)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return False
+        current_qty = row[0]
+        if current_qty <= qty:
+            await tx.execute("DELETE FROM inventory WHERE user_id = ? AND item_id = ?", (user_id, item_id))
+        else:
+            await tx.execute("UPDATE inventory SET qty = qty - ? WHERE user_id = ? AND item_id = ?", (qty, user_id, item_id))
     return True
 
-def get_user_inventory(user_id):
-    cursor.execute("""
+async def get_user_inventory(user_id):
+    return await db_fetchall("""
     SELECT i.item_id, it.name, it.type, it.power, it.price, i.qty
     FROM inventory i
     JOIN items it ON i.item_id = it.item_id
     WHERE i.user_id = ?
     """, (user_id,))
-    return cursor.fetchall()
 
-def create_loan(user_id, amount):
+async def create_loan(user_id, amount):
     created_at = int(time.time())
-    cursor.execute("INSERT INTO loans(user_id, amount, created_at) VALUES (?, ?, ?)", (user_id, amount, created_at))
-    conn.commit()
+    await db_execute("INSERT INTO loans(user_id, amount, created_at) VALUES (?, ?, ?)", (user_id, amount, created_at))
 
-def get_user_loans(user_id):
-    cursor.execute("SELECT loan_id, amount, created_at FROM loans WHERE user_id = ?", (user_id,))
-    return cursor.fetchall()
+async def get_user_loans(user_id):
+    return await db_fetchall("SELECT loan_id, amount, created_at FROM loans WHERE user_id = ?", (user_id,))
 
-def delete_loan(loan_id):
-    cursor.execute("DELETE FROM loans WHERE loan_id = ?", (loan_id,))
-    conn.commit()
+async def delete_loan(loan_id):
+    await db_execute("DELETE FROM loans WHERE loan_id = ?", (loan_id,))
 
 def calculate_loan_debt(amount, created_at):
     days_passed = (int(time.time()) - created_at) / 86400
@@ -516,16 +2143,14 @@ async def resolve_user_identifier(identifier, bot_instance):
     identifier = identifier.strip()
     if identifier.startswith('@'):
         username = identifier[1:]
-        cursor.execute("SELECT user_id, username FROM users WHERE username = ?", (username,))
-        row = cursor.fetchone()
+        row = await db_fetchone("SELECT user_id, username FROM users WHERE username = ?", (username,))
         if row:
             return row[0], row[1]
         return None, None
     else:
         try:
             user_id = int(identifier)
-            cursor.execute("SELECT user_id, username FROM users WHERE user_id = ?", (user_id,))
-            row = cursor.fetchone()
+            row = await db_fetchone("SELECT user_id, username FROM users WHERE user_id = ?", (user_id,))
             if row:
                 return row[0], row[1]
             try:
@@ -552,8 +2177,8 @@ def attack_range(level):
     base_max = 20 + (level - 1) * 3
     return base_min, base_max
 
-def get_equipment_effects(user_id):
-    inv = get_user_inventory(user_id)
+async def get_equipment_effects(user_id):
+    inv = await get_user_inventory(user_id)
     weapon_power = 0
     armor_percent = 0
     potion_power = 0
@@ -569,12 +2194,139 @@ def get_equipment_effects(user_id):
     
     return {"weapon_power": weapon_power, "armor_percent": armor_percent, "potion_power": potion_power}
 
-def update_game_stats(user_id, won):
+async def update_game_stats(user_id, won):
     if won:
-        cursor.execute("UPDATE users SET games_played = games_played + 1, wins = wins + 1 WHERE user_id = ?", (user_id,))
+        await db_execute("UPDATE users SET games_played = games_played + 1, wins = wins + 1 WHERE user_id = ?", (user_id,))
+        apply_user_delta(user_id, games_played=1, wins=1)
+    else:
+        await db_execute("UPDATE users SET games_played = games_played + 1, losses = losses + 1 WHERE user_id = ?", (user_id,))
+        apply_user_delta(user_id, games_played=1, losses=1)
+
+async def try_debit(user_id, amount, reason):
+    async with db_transaction() as tx:
+        cur = await tx.execute(
+            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+            (amount, user_id, amount)
+        )
+        if cur.rowcount == 0:
+            return False
+        await ledger_record(tx, user_id, -amount, reason)
+    apply_user_delta(user_id, balance=-amount)
+    return True
+
+async def transfer_balance(from_id, to_id, amount):
+    async with db_transaction() as tx:
+        cur = await tx.execute(
+            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+            (amount, from_id, amount)
+        )
+        if cur.rowcount == 0:
+            return False
+        await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, to_id))
+        await ledger_record(tx, from_id, -amount, "transfer")
+        await ledger_record(tx, to_id, amount, "transfer")
+    apply_user_delta(from_id, balance=-amount)
+    apply_user_delta(to_id, balance=amount)
+    return True
+
+async def buy_item(user_id, item_id, price, qty=1):
+    async with db_transaction() as tx:
+        cur = await tx.execute(
+            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+            (price, user_id, price)
+        )
+        if cur.rowcount == 0:
+            return False
+        await tx.execute(
+            """INSERT INTO inventory(user_id, item_id, qty) VALUES (?, ?, ?)
+               ON CONFLICT(user_id, item_id) DO UPDATE SET qty = qty + excluded.qty""",
+            (user_id, item_id, qty)
+        )
+        await ledger_record(tx, user_id, -price, "buy")
+    apply_user_delta(user_id, balance=-price)
+    return True
+
+async def grant_loan(user_id, amount):
+    async with db_transaction() as tx:
+        await tx.execute(
+            "INSERT INTO loans(user_id, amount, created_at) VALUES (?, ?, ?)",
+            (user_id, amount, int(time.time()))
+        )
+        await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+        await ledger_record(tx, user_id, amount, "loan")
+    apply_user_delta(user_id, balance=amount)
+
+async def repay_loan(user_id, loan_id, debt):
+    async with db_transaction() as tx:
+        cur = await tx.execute(
+            """UPDATE users SET balance = balance - ?
+               WHERE user_id = ? AND balance >= ?
+                 AND EXISTS (SELECT 1 FROM loans WHERE loan_id = ? AND user_id = ?)""",
+            (debt, user_id, debt, loan_id, user_id)
+        )
+        if cur.rowcount == 0:
+            return False
+        await tx.execute("DELETE FROM loans WHERE loan_id = ?", (loan_id,))
+        await ledger_record(tx, user_id, -debt, "loan")
+    apply_user_delta(user_id, balance=-debt)
+    return True
+
+# The cooldown check and the payout are one conditional UPDATE, so two
+# concurrent /daily calls cannot both claim the bonus.
+DAILY_COOLDOWN = 86400
+
+async def claim_daily(user_id, now, xp_gain):
+    async with db_transaction() as tx:
+        async with tx.execute("SELECT level FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        reward = 50 + row[0] * 10
+        cur = await tx.execute(
+            """UPDATE users SET balance = balance + ?,
+                                 xp = (xp + ?) % ?,
+                                 level = level + (xp + ?) / ?,
+                                 last_daily = ?
+                WHERE user_id = ? AND COALESCE(last_daily, 0) <= ?""",
+            (reward, xp_gain, LEVEL_XP, xp_gain, LEVEL_XP, now, user_id, now - DAILY_COOLDOWN)
+        )
+        if cur.rowcount == 0:
+            return None
+        await ledger_record(tx, user_id, reward, "daily")
+    apply_user_delta(user_id, balance=reward)
+    apply_user_xp(user_id, xp_gain)
+    apply_user_fields(user_id, last_daily=now)
+    return reward
+
+async def settle_game(user_id, reason, stake=0, payout=0, xp_gain=0, won=None):
+    if won is None:
+        stats_sql = ""
+    elif won:
+        stats_sql = ", games_played = games_played + 1, wins = wins + 1"
     else:
-        cursor.execute("UPDATE users SET games_played = games_played + 1, losses = losses + 1 WHERE user_id = ?", (user_id,))
-    conn.commit()
+        stats_sql = ", games_played = games_played + 1, losses = losses + 1"
+    params = [stake, payout, xp_gain, LEVEL_XP, xp_gain, LEVEL_XP, user_id]
+    guard_sql = ""
+    if stake:
+        guard_sql = " AND balance >= ?"
+        params.append(stake)
+    async with db_transaction() as tx:
+        cur = await tx.execute(
+            f"""UPDATE users SET balance = balance - ? + ?,
+                                 xp = (xp + ?) % ?,
+                                 level = level + (xp + ?) / ?{stats_sql}
+                WHERE user_id = ?{guard_sql}""",
+            params
+        )
+        if cur.rowcount == 0:
+            return False
+        await ledger_record(tx, user_id, payout - stake, reason)
+    apply_user_delta(user_id, balance=payout - stake)
+    if xp_gain:
+        apply_user_xp(user_id, xp_gain)
+    if won is not None:
+        apply_user_delta(user_id, games_played=1, **({"wins": 1} if won else {"losses": 1}))
+    return True
 
 async def safe_send_message(chat_id, text=None, thread_id=None, parse_mode=None, **kwargs):
     try:
@@ -593,32 +2345,71 @@ async def safe_send_message(chat_id, text=None, thread_id=None, parse_mode=None,
         else:
             raise Exception(f"Ошибка отправки: {error_msg}")
 
-async def cleanup_expired_apk():
-    await asyncio.sleep(10)
+async def expire_apk_uploads(upload_ids):
+    now = int(time.time())
+    rows = []
+    for i in range(0, len(upload_ids), 500):
+        chunk = upload_ids[i:i + 500]
+        rows += await db_fetchall(
+            f"SELECT upload_id, file_path, decompiled_path FROM apk_uploads WHERE upload_id IN ({','.join('?' * len(chunk))}) AND expires_at <= ?",
+            (*chunk, now)
+        )
+    if rows:
+        await delete_apk_uploads(rows)
+        await gc_apk_blobs()
+
+apk_expiry = ExpiryScheduler("APK", expire_apk_uploads)
+
+async def start_expiry_schedulers():
+    for upload_id, expires_at in await db_fetchall("SELECT upload_id, expires_at FROM apk_uploads"):
+        apk_expiry.schedule(upload_id, expires_at)
+    asyncio.create_task(apk_expiry.run())
+    for store in session_stores.values():
+        asyncio.create_task(store.expiry.run())
+
+async def compact_ledger():
+    cutoff = int(time.time()) - LEDGER_RETENTION_DAYS * 86400
+    row = await db_fetchone("SELECT MIN(entry_id), MAX(entry_id) FROM ledger WHERE created_at < ?", (cutoff,))
+    if not row or row[0] is None:
+        return 0
+    first_id, last_id = row
+    folded = 0
+    while first_id <= last_id:
+        upper = min(last_id, first_id + LEDGER_COMPACT_BATCH - 1)
+        async with db_transaction() as tx:
+            await tx.execute(
+                """INSERT INTO ledger_snapshots(user_id, balance_delta, entries, last_entry_id, updated_at)
+                   SELECT user_id, SUM(delta), COUNT(*), MAX(entry_id), ? FROM ledger
+                   WHERE entry_id <= ?
+                   GROUP BY user_id
+                   ON CONFLICT(user_id) DO UPDATE SET
+                       balance_delta = balance_delta + excluded.balance_delta,
+                       entries = entries + excluded.entries,
+                       last_entry_id = excluded.last_entry_id,
+                       updated_at = excluded.updated_at""",
+                (int(time.time()), upper)
+            )
+            cur = await tx.execute("DELETE FROM ledger WHERE entry_id <= ?", (upper,))
+            folded += cur.rowcount
+        await db_sync()
+        first_id = upper + 1
+    return folded
+
+async def ledger_compaction_loop():
+    await asyncio.sleep(60)
     while True:
         try:
-            current_time = int(time.time())
-            cursor.execute("SELECT upload_id, file_path, decompiled_path FROM apk_uploads WHERE expires_at <= ?", (current_time,))
-            expired = cursor.fetchall()
-            
-            for upload_id, file_path, decompiled_path in expired:
-                try:
-                    if file_path and os.path.exists(file_path):
-                        os.remove(file_path)
-                    if decompiled_path and os.path.exists(decompiled_path):
-                        shutil.rmtree(decompiled_path, ignore_errors=True)
-                    cursor.execute("DELETE FROM apk_uploads WHERE upload_id = ?", (upload_id,))
-                    conn.commit()
-                except Exception as e:
-                    print(f"Cleanup error for upload {upload_id}: {e}")
+            folded = await compact_ledger()
+            if folded:
+                print(f"Ledger compaction: folded {folded} entries")
         except Exception as e:
-            print(f"APK cleanup error: {e}")
+            print(f"Ledger compaction error: {e}")
         
-        await asyncio.sleep(3600)
+        await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
 
 @dp.message_handler(commands=["start"])
 async def cmd_start(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     welcome_text = f"""
 Привет, @{msg.from_user.username}!
 
@@ -697,6 +2488,8 @@ async def cmd_help(msg: types.Message):
 /apk_decompile - разобрать APK (админ)
 /apk_compile <id> - собрать APK обратно (админ)
 /apk_analyze <id> - анализ APK (админ)
+/apk_extract <id> [путь] - распаковать APK на диск (админ)
+/apk_search <id> <запрос> - поиск по содержимому APK (админ)
 /apk_list - список загруженных APK (админ)
 /apk_edit <id> <путь> - редактировать файл в APK (админ)
 
@@ -722,8 +2515,8 @@ async def cmd_help(msg: types.Message):
 
 @dp.message_handler(commands=["profile"])
 async def cmd_profile(msg: types.Message):
-    ensure_user(msg.from_user)
-    u = get_user(msg.from_user.id)
+    await ensure_user(msg.from_user)
+    u = await get_user(msg.from_user.id)
     
     wins = u.get('wins', 0)
     losses = u.get('losses', 0)
@@ -747,21 +2540,21 @@ XP: {u['xp']}/{LEVEL_XP}
 
 @dp.message_handler(commands=["balance"])
 async def cmd_balance(msg: types.Message):
-    ensure_user(msg.from_user)
-    u = get_user(msg.from_user.id)
+    await ensure_user(msg.from_user)
+    u = await get_user(msg.from_user.id)
     await msg.reply(f"Твой баланс: {u['balance']} EcsCoin")
 
 @dp.message_handler(commands=["myid"])
 async def cmd_myid(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     reply_user = msg.reply_to_message.from_user if msg.reply_to_message else msg.from_user
-    ensure_user(reply_user)
+    await ensure_user(reply_user)
     await msg.reply(f"Telegram ID @{reply_user.username}: `{reply_user.id}`\n\nИспользуй этот ID для команд типа /duel {reply_user.id} <ставка>")
 
 @dp.message_handler(commands=["shop"])
 async def cmd_shop(msg: types.Message):
-    ensure_user(msg.from_user)
-    items = get_items()
+    await ensure_user(msg.from_user)
+    items = await get_items()
     lines = ["**Магазин предметов:**\n"]
     items_list = []
     
@@ -780,8 +2573,7 @@ async def cmd_shop(msg: types.Message):
         lines.append("**Предметы:**")
         lines.extend(items_list)
     
-    cursor.execute("SELECT box_id, name, price FROM loot_boxes")
-    boxes = cursor.fetchall()
+    boxes = await db_fetchall("SELECT box_id, name, price FROM loot_boxes")
     
     if boxes:
         lines.append("\n**Ящики:**")
@@ -794,7 +2586,7 @@ async def cmd_shop(msg: types.Message):
 
 @dp.message_handler(commands=["buy"])
 async def cmd_buy(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     parts = msg.text.split()
     if len(parts) < 2:
         await msg.reply("Использование: /buy <item_id>")
@@ -804,7 +2596,7 @@ async def cmd_buy(msg: types.Message):
     except:
         await msg.reply("Неверный id предмета.")
         return
-    item = get_item(item_id)
+    item = await get_item(item_id)
     if not item:
         await msg.reply("Такого предмета нет.")
         return
@@ -812,18 +2604,15 @@ async def cmd_buy(msg: types.Message):
     if price <= 0:
         await msg.reply("Этот предмет нельзя купить в магазине.")
         return
-    user = get_user(msg.from_user.id)
-    if user['balance'] < price:
+    if not await buy_item(msg.from_user.id, item_id, price):
         await msg.reply("Недостаточно средств.")
         return
-    update_balance(msg.from_user.id, -price)
-    add_item_to_user(msg.from_user.id, item_id, 1)
     await msg.reply(f"Ты купил {name} за {price} монет. /inventory")
 
 @dp.message_handler(commands=["inventory"])
 async def cmd_inventory(msg: types.Message):
-    ensure_user(msg.from_user)
-    inv = get_user_inventory(msg.from_user.id)
+    await ensure_user(msg.from_user)
+    inv = await get_user_inventory(msg.from_user.id)
     if not inv:
         await msg.reply("Инвентарь пуст.")
         return
@@ -835,8 +2624,8 @@ async def cmd_inventory(msg: types.Message):
 
 @dp.message_handler(commands=["stats"])
 async def cmd_stats(msg: types.Message):
-    ensure_user(msg.from_user)
-    u = get_user(msg.from_user.id)
+    await ensure_user(msg.from_user)
+    u = await get_user(msg.from_user.id)
     
     wins = u.get('wins', 0)
     losses = u.get('losses', 0)
@@ -859,8 +2648,7 @@ XP: {u['xp']}/{LEVEL_XP}
 
 @dp.message_handler(commands=["leaderboard"])
 async def cmd_leaderboard(msg: types.Message):
-    cursor.execute("SELECT username, level, balance, wins, xp FROM users ORDER BY level DESC, xp DESC LIMIT 10")
-    top_users = cursor.fetchall()
+    top_users = [(username, level, balance, wins, xp) for _, level, xp, username, balance, wins in leaderboard.top_players(10)]
     
     if not top_users:
         await msg.reply("Таблица лидеров пуста.")
@@ -877,35 +2665,25 @@ async def cmd_leaderboard(msg: types.Message):
 
 @dp.message_handler(commands=["daily"])
 async def cmd_daily(msg: types.Message):
-    ensure_user(msg.from_user)
-    u = get_user(msg.from_user.id)
+    await ensure_user(msg.from_user)
     
     current_time = int(time.time())
-    last_daily = u.get('last_daily', 0)
-    
-    day_seconds = 86400
-    time_diff = current_time - last_daily
+    daily_xp = 20
     
-    if time_diff < day_seconds:
-        hours_left = (day_seconds - time_diff) // 3600
-        minutes_left = ((day_seconds - time_diff) % 3600) // 60
+    daily_reward = await claim_daily(msg.from_user.id, current_time, daily_xp)
+    if daily_reward is None:
+        u = await get_user(msg.from_user.id)
+        time_left = max(DAILY_COOLDOWN - (current_time - u.get('last_daily', 0)), 0)
+        hours_left = time_left // 3600
+        minutes_left = (time_left % 3600) // 60
         await msg.reply(f"Ежедневный бонус уже получен!\nСледующий бонус через: {hours_left}ч {minutes_left}м")
         return
     
-    daily_reward = 50 + (u['level'] * 10)
-    daily_xp = 20
-    
-    update_balance(msg.from_user.id, daily_reward)
-    add_xp(msg.from_user.id, daily_xp)
-    
-    cursor.execute("UPDATE users SET last_daily = ? WHERE user_id = ?", (current_time, msg.from_user.id))
-    conn.commit()
-    
     await msg.reply(f"Ежедневный бонус получен!\n+{daily_reward} EcsCoin\n+{daily_xp} XP")
 
 @dp.message_handler(commands=["transfer"])
 async def cmd_transfer(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     parts = msg.text.split()
     
     if len(parts) < 3:
@@ -929,20 +2707,16 @@ async def cmd_transfer(msg: types.Message):
         await msg.reply("Не могу найти пользователя.")
         return
     
-    sender = get_user(msg.from_user.id)
-    
-    if sender['balance'] < amount:
-        await msg.reply(f"Недостаточно средств! Твой баланс: {sender['balance']} EcsCoin")
-        return
-    
     if msg.from_user.id == target_id:
         await msg.reply("Нельзя переводить монеты самому себе!")
         return
     
-    ensure_user_by_id(target_id, target_name)
+    await ensure_user_by_id(target_id, target_name)
     
-    update_balance(msg.from_user.id, -amount)
-    update_balance(target_id, amount)
+    if not await transfer_balance(msg.from_user.id, target_id, amount):
+        sender = await get_user(msg.from_user.id)
+        await msg.reply(f"Недостаточно средств! Твой баланс: {sender['balance']} EcsCoin")
+        return
     
     await msg.reply(f"Переведено {amount} EcsCoin пользователю {target_identifier}")
     
@@ -953,7 +2727,7 @@ async def cmd_transfer(msg: types.Message):
 
 @dp.message_handler(commands=["loan"])
 async def cmd_loan(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     parts = msg.text.split()
     
     if len(parts) < 2:
@@ -974,15 +2748,14 @@ async def cmd_loan(msg: types.Message):
         await msg.reply("Максимальная сумма кредита - 1000 EcsCoin")
         return
     
-    create_loan(msg.from_user.id, amount)
-    update_balance(msg.from_user.id, amount)
+    await grant_loan(msg.from_user.id, amount)
     
     await msg.reply(f"Кредит на {amount} EcsCoin выдан!\nПроцентная ставка: 7% в сутки\n\nИспользуй /myloans чтобы посмотреть свои кредиты")
 
 @dp.message_handler(commands=["myloans"])
 async def cmd_myloans(msg: types.Message):
-    ensure_user(msg.from_user)
-    loans = get_user_loans(msg.from_user.id)
+    await ensure_user(msg.from_user)
+    loans = await get_user_loans(msg.from_user.id)
     
     if not loans:
         await msg.reply("У тебя нет активных кредитов.")
@@ -1007,7 +2780,7 @@ async def cmd_myloans(msg: types.Message):
 
 @dp.message_handler(commands=["payloan"])
 async def cmd_payloan(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     parts = msg.text.split()
     
     if len(parts) < 2:
@@ -1020,7 +2793,7 @@ async def cmd_payloan(msg: types.Message):
         await msg.reply("Неверный ID кредита.")
         return
     
-    loans = get_user_loans(msg.from_user.id)
+    loans = await get_user_loans(msg.from_user.id)
     loan_found = None
     
     for l_id, amount, created_at in loans:
@@ -1035,14 +2808,11 @@ async def cmd_payloan(msg: types.Message):
     _, amount, created_at = loan_found
     debt = calculate_loan_debt(amount, created_at)
     
-    user = get_user(msg.from_user.id)
-    if user['balance'] < debt:
+    if not await repay_loan(msg.from_user.id, loan_id, debt):
+        user = await get_user(msg.from_user.id)
         await msg.reply(f"Недостаточно средств!\nНужно: {debt} EcsCoin\nТвой баланс: {user['balance']} EcsCoin")
         return
     
-    update_balance(msg.from_user.id, -debt)
-    delete_loan(loan_id)
-    
     await msg.reply(f"Кредит #{loan_id} погашен!\nСписано: {debt} EcsCoin")
 
 
@@ -1112,14 +2882,13 @@ HANGMAN_STAGES = [
     """
 ]
 
-def get_random_word():
-    cursor.execute("SELECT word FROM word_list WHERE language = 'ru' ORDER BY RANDOM() LIMIT 1")
-    row = cursor.fetchone()
+async def get_random_word():
+    row = await db_fetchone("SELECT word FROM word_list WHERE language = 'ru' ORDER BY RANDOM() LIMIT 1")
     return row[0] if row else "программа"
 
 @dp.message_handler(commands=["hangman"])
 async def cmd_hangman(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     chat_id = msg.chat.id
     user_id = msg.from_user.id
     
@@ -1127,22 +2896,16 @@ async def cmd_hangman(msg: types.Message):
         await msg.reply("Игра уже идёт! Используй /hangman_stop чтобы остановить")
         return
     
-    word = get_random_word().lower()
-    hangman_games[chat_id] = {
-        'word': word,
-        'guessed': set(),
-        'attempts': 0,
-        'max_attempts': 6,
-        'creator': user_id
-    }
+    word = (await get_random_word()).lower()
+    game = hangman_games[chat_id] = HangmanSession(word, user_id)
     
-    masked = ' '.join('_' if c not in hangman_games[chat_id]['guessed'] else c for c in word)
+    masked = ' '.join('_' if c not in game.guessed else c for c in word)
     
     await msg.reply(f"""
 **ВИСЕЛИЦА**
 
 Слово: `{masked}`
-Попытки: {hangman_games[chat_id]['attempts']}/{hangman_games[chat_id]['max_attempts']}
+Попытки: {game.attempts}/{game.max_attempts}
 
 Угадывай по одной букве! Например: а
 Или угадай всё слово целиком!
@@ -1156,36 +2919,34 @@ async def hangman_guess_letter(msg: types.Message):
     letter = msg.text.strip().lower()
     game = hangman_games[chat_id]
     
-    if letter in game['guessed']:
+    if letter in game.guessed:
         await msg.reply("Эта буква уже была!")
         return
     
-    game['guessed'].add(letter)
+    game.guessed.add(letter)
     
-    if letter not in game['word']:
-        game['attempts'] += 1
+    if letter not in game.word:
+        game.attempts += 1
         
-        if game['attempts'] >= game['max_attempts']:
+        if game.attempts >= game.max_attempts:
             del hangman_games[chat_id]
-            update_game_stats(msg.from_user.id, False)
-            await msg.reply(f"Проигрыш! Слово было: **{game['word']}**\n\n```{HANGMAN_STAGES[6]}```")
+            await settle_game(msg.from_user.id, "hangman", won=False)
+            await msg.reply(f"Проигрыш! Слово было: **{game.word}**\n\n```{HANGMAN_STAGES[6]}```")
             return
         
-        masked = ' '.join('_' if c not in game['guessed'] else c for c in game['word'])
-        await msg.reply(f"Нет такой буквы!\n\n```{HANGMAN_STAGES[game['attempts']]}```\n\nСлово: `{masked}`\nПопытки: {game['attempts']}/{game['max_attempts']}")
+        masked = ' '.join('_' if c not in game.guessed else c for c in game.word)
+        await msg.reply(f"Нет такой буквы!\n\n```{HANGMAN_STAGES[game.attempts]}```\n\nСлово: `{masked}`\nПопытки: {game.attempts}/{game.max_attempts}")
     else:
-        masked = ' '.join('_' if c not in game['guessed'] else c for c in game['word'])
+        masked = ' '.join('_' if c not in game.guessed else c for c in game.word)
         
         if '_' not in masked:
             reward = 100
             xp = 30
-            update_balance(msg.from_user.id, reward)
-            add_xp(msg.from_user.id, xp)
-            update_game_stats(msg.from_user.id, True)
             del hangman_games[chat_id]
-            await msg.reply(f"Победа! Слово: **{game['word']}**\n\n+{reward} EcsCoin\n+{xp} XP")
+            await settle_game(msg.from_user.id, "hangman", payout=reward, xp_gain=xp, won=True)
+            await msg.reply(f"Победа! Слово: **{game.word}**\n\n+{reward} EcsCoin\n+{xp} XP")
         else:
-            await msg.reply(f"Есть такая буква!\n\n```{HANGMAN_STAGES[game['attempts']]}```\n\nСлово: `{masked}`\nПопытки: {game['attempts']}/{game['max_attempts']}")
+            await msg.reply(f"Есть такая буква!\n\n```{HANGMAN_STAGES[game.attempts]}```\n\nСлово: `{masked}`\nПопытки: {game.attempts}/{game.max_attempts}")
 
 @dp.message_handler(lambda msg: msg.chat.id in hangman_games and len(msg.text.strip()) > 1 and msg.text.strip().isalpha())
 async def hangman_guess_word(msg: types.Message):
@@ -1193,23 +2954,21 @@ async def hangman_guess_word(msg: types.Message):
     guess = msg.text.strip().lower()
     game = hangman_games[chat_id]
     
-    if guess == game['word']:
+    if guess == game.word:
         reward = 150
         xp = 50
-        update_balance(msg.from_user.id, reward)
-        add_xp(msg.from_user.id, xp)
-        update_game_stats(msg.from_user.id, True)
         del hangman_games[chat_id]
-        await msg.reply(f"Угадал всё слово! **{game['word']}**\n\n+{reward} EcsCoin\n+{xp} XP")
+        await settle_game(msg.from_user.id, "hangman", payout=reward, xp_gain=xp, won=True)
+        await msg.reply(f"Угадал всё слово! **{game.word}**\n\n+{reward} EcsCoin\n+{xp} XP")
     else:
-        game['attempts'] += 1
-        if game['attempts'] >= game['max_attempts']:
+        game.attempts += 1
+        if game.attempts >= game.max_attempts:
             del hangman_games[chat_id]
-            update_game_stats(msg.from_user.id, False)
-            await msg.reply(f"Проигрыш! Слово было: **{game['word']}**\n\n```{HANGMAN_STAGES[6]}```")
+            await settle_game(msg.from_user.id, "hangman", won=False)
+            await msg.reply(f"Проигрыш! Слово было: **{game.word}**\n\n```{HANGMAN_STAGES[6]}```")
         else:
-            masked = ' '.join('_' if c not in game['guessed'] else c for c in game['word'])
-            await msg.reply(f"Неверно!\n\n```{HANGMAN_STAGES[game['attempts']]}```\n\nСлово: `{masked}`\nПопытки: {game['attempts']}/{game['max_attempts']}")
+            masked = ' '.join('_' if c not in game.guessed else c for c in game.word)
+            await msg.reply(f"Неверно!\n\n```{HANGMAN_STAGES[game.attempts]}```\n\nСлово: `{masked}`\nПопытки: {game.attempts}/{game.max_attempts}")
 
 @dp.message_handler(commands=["hangman_stop"])
 async def cmd_hangman_stop(msg: types.Message):
@@ -1218,38 +2977,70 @@ async def cmd_hangman_stop(msg: types.Message):
         await msg.reply("Нет активной игры в виселицу!")
         return
     
-    word = hangman_games[chat_id]['word']
-    del hangman_games[chat_id]
+    word = hangman_games.pop(chat_id).word
     await msg.reply(f"Игра остановлена! Слово было: **{word}**")
 
 
-def create_deck():
-    suits = ['S', 'H', 'D', 'C']
-    ranks = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
-    return [{'rank': r, 'suit': s} for s in suits for r in ranks]
-
-def card_value(card):
-    if card['rank'] in ['J', 'Q', 'K']:
-        return 10
-    elif card['rank'] == 'A':
-        return 11
-    else:
-        return int(card['rank'])
-
-def hand_value(hand):
-    value = sum(card_value(c) for c in hand)
-    aces = sum(1 for c in hand if c['rank'] == 'A')
-    while value > 21 and aces:
-        value -= 10
-        aces -= 1
-    return value
+# Cards are ints 0-51 (suit * 13 + rank, rank 12 is the ace), decks are
+# bytearrays, and hands keep their total and the number of aces still
+# counted as 11 up to date as cards are added.
+CARD_SUITS = ['S', 'H', 'D', 'C']
+CARD_RANKS = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A']
+CARD_VALUES = bytes(min(rank + 2, 10) if rank < 12 else 11 for _ in CARD_SUITS for rank in range(13))
+CARD_NAMES = tuple(rank + suit for suit in CARD_SUITS for rank in CARD_RANKS)
+FULL_DECK = bytes(range(52))
+BJ_NATURAL_PAYOUT = 2.5
+BJ_WIN_PAYOUT = 2
+BJ_DEALER_STANDS = 17
+
+class BlackjackHand:
+    __slots__ = ('cards', 'total', 'soft_aces', '_text')
+
+    def __init__(self, cards=b""):
+        self.cards = bytearray()
+        self.total = 0
+        self.soft_aces = 0
+        self._text = None
+        for card in cards:
+            self.add(card)
+
+    def add(self, card):
+        self.cards.append(card)
+        self.total += CARD_VALUES[card]
+        if card % 13 == 12:
+            self.soft_aces += 1
+        while self.total > 21 and self.soft_aces:
+            self.total -= 10
+            self.soft_aces -= 1
+        self._text = None
+
+    def text(self):
+        if self._text is None:
+            self._text = ' '.join(CARD_NAMES[card] for card in self.cards)
+        return self._text
+
+def new_deck():
+    deck = bytearray(FULL_DECK)
+    random.shuffle(deck)
+    return deck
+
+# Buttons carry the hand's nonce, so a button left over from an earlier
+# hand can never act on the current one.
+def bj_keyboard(game):
+    return InlineKeyboardMarkup(row_width=2).add(
+        InlineKeyboardButton("Взять карту", callback_data=f"bj_hit:{game.nonce}"),
+        InlineKeyboardButton("Стоп", callback_data=f"bj_stand:{game.nonce}")
+    )
 
-def card_str(card):
-    return f"{card['rank']}{card['suit']}"
+def bj_callback_game(callback):
+    game = blackjack_games.get(callback.from_user.id)
+    if game is None or callback.data.partition(":")[2] != str(game.nonce):
+        return None
+    return game
 
 @dp.message_handler(commands=["blackjack"])
 async def cmd_blackjack(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     user_id = msg.from_user.id
     
     parts = msg.text.split()
@@ -1267,147 +3058,141 @@ async def cmd_blackjack(msg: types.Message):
         await msg.reply("Ставка должна быть положительной!")
         return
     
-    user = get_user(user_id)
-    if user['balance'] < bet:
-        await msg.reply(f"Недостаточно средств! Твой баланс: {user['balance']} EcsCoin")
-        return
-    
-    if user_id in blackjack_games:
+    if user_id in blackjack_games or user_id in blackjack_starting:
         await msg.reply("У тебя уже есть активная игра! Используй кнопки")
         return
     
-    update_balance(user_id, -bet)
+    deck = new_deck()
     
-    deck = create_deck()
-    random.shuffle(deck)
-    
-    player_hand = [deck.pop(), deck.pop()]
-    dealer_hand = [deck.pop(), deck.pop()]
+    player_hand = BlackjackHand((deck.pop(), deck.pop()))
+    dealer_hand = BlackjackHand((deck.pop(), deck.pop()))
+    game = BlackjackSession(deck, player_hand, dealer_hand, bet, msg.chat.id)
     
-    blackjack_games[user_id] = {
-        'deck': deck,
-        'player_hand': player_hand,
-        'dealer_hand': dealer_hand,
-        'bet': bet,
-        'chat_id': msg.chat.id
-    }
+    player_val = player_hand.total
+    dealer_visible = CARD_NAMES[dealer_hand.cards[0]]
     
-    player_val = hand_value(player_hand)
-    dealer_visible = card_str(dealer_hand[0])
+    # The hand only becomes playable once the stake is debited and escrowed;
+    # blackjack_starting keeps a second /blackjack out in the meantime.
+    blackjack_starting.add(user_id)
+    try:
+        if player_val == 21:
+            reward = int(bet * BJ_NATURAL_PAYOUT)
+            settled = await settle_game(user_id, "bj", stake=bet, payout=reward, xp_gain=40, won=True)
+        else:
+            settled = await try_debit(user_id, bet, "bj")
+            if settled:
+                await escrow_open(user_id, "bj", bet, msg.chat.id, game.nonce)
+                blackjack_games[user_id] = game
+    finally:
+        blackjack_starting.discard(user_id)
     
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        InlineKeyboardButton("Взять карту", callback_data="bj_hit"),
-        InlineKeyboardButton("Стоп", callback_data="bj_stand")
-    )
+    if not settled:
+        user = await get_user(user_id)
+        await msg.reply(f"Недостаточно средств! Твой баланс: {user['balance']} EcsCoin")
+        return
     
     if player_val == 21:
-        reward = int(bet * 2.5)
-        update_balance(user_id, reward)
-        add_xp(user_id, 40)
-        update_game_stats(user_id, True)
-        del blackjack_games[user_id]
-        await msg.reply(f"**БЛЭКДЖЕК!**\n\nТвои карты: {' '.join(card_str(c) for c in player_hand)} = {player_val}\n\nПобеда! +{reward} EcsCoin")
+        await msg.reply(f"**БЛЭКДЖЕК!**\n\nТвои карты: {player_hand.text()} = {player_val}\n\nПобеда! +{reward} EcsCoin")
     else:
         await msg.reply(
             f"**БЛЭКДЖЕК**\n\n"
-            f"Твои карты: {' '.join(card_str(c) for c in player_hand)} = {player_val}\n"
+            f"Твои карты: {player_hand.text()} = {player_val}\n"
             f"Дилер: {dealer_visible} ?\n\n"
             f"Ставка: {bet} EcsCoin",
-            reply_markup=keyboard
+            reply_markup=bj_keyboard(game)
         )
 
-@dp.callback_query_handler(lambda c: c.data == "bj_hit")
+@dp.callback_query_handler(lambda c: c.data.partition(":")[0] == "bj_hit")
 async def bj_hit(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
-    if user_id not in blackjack_games:
+    game = bj_callback_game(callback)
+    if game is None:
         await callback.answer("Игра не найдена!")
         return
     
-    game = blackjack_games[user_id]
-    card = game['deck'].pop()
-    game['player_hand'].append(card)
-    
-    player_val = hand_value(game['player_hand'])
-    dealer_visible = card_str(game['dealer_hand'][0])
+    game.player_hand.add(game.deck.pop())
     
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        InlineKeyboardButton("Взять карту", callback_data="bj_hit"),
-        InlineKeyboardButton("Стоп", callback_data="bj_stand")
-    )
+    player_val = game.player_hand.total
+    dealer_visible = CARD_NAMES[game.dealer_hand.cards[0]]
     
     if player_val > 21:
-        update_game_stats(user_id, False)
         del blackjack_games[user_id]
+        await escrow_close(user_id, "bj")
+        await settle_game(user_id, "bj", won=False)
         await callback.message.edit_text(
             f"**БЛЭКДЖЕК**\n\n"
-            f"Твои карты: {' '.join(card_str(c) for c in game['player_hand'])} = {player_val}\n"
+            f"Твои карты: {game.player_hand.text()} = {player_val}\n"
             f"Дилер: {dealer_visible} ?\n\n"
             f"Перебор! Проигрыш!"
         )
     else:
         await callback.message.edit_text(
             f"**БЛЭКДЖЕК**\n\n"
-            f"Твои карты: {' '.join(card_str(c) for c in game['player_hand'])} = {player_val}\n"
+            f"Твои карты: {game.player_hand.text()} = {player_val}\n"
             f"Дилер: {dealer_visible} ?\n\n"
-            f"Ставка: {game['bet']} EcsCoin",
-            reply_markup=keyboard
+            f"Ставка: {game.bet} EcsCoin",
+            reply_markup=bj_keyboard(game)
         )
     
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "bj_stand")
+@dp.callback_query_handler(lambda c: c.data.partition(":")[0] == "bj_stand")
 async def bj_stand(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
-    if user_id not in blackjack_games:
+    game = bj_callback_game(callback)
+    if game is None:
         await callback.answer("Игра не найдена!")
         return
+    blackjack_games.pop(user_id, None)
+    await escrow_close(user_id, "bj")
     
-    game = blackjack_games[user_id]
-    player_val = hand_value(game['player_hand'])
+    player_val = game.player_hand.total
     
-    while hand_value(game['dealer_hand']) < 17:
-        game['dealer_hand'].append(game['deck'].pop())
+    while game.dealer_hand.total < BJ_DEALER_STANDS:
+        game.dealer_hand.add(game.deck.pop())
     
-    dealer_val = hand_value(game['dealer_hand'])
+    dealer_val = game.dealer_hand.total
     
     result_text = ""
     if dealer_val > 21:
-        reward = game['bet'] * 2
-        update_balance(user_id, reward)
-        add_xp(user_id, 30)
-        update_game_stats(user_id, True)
+        reward = game.bet * BJ_WIN_PAYOUT
+        await settle_game(user_id, "bj", payout=reward, xp_gain=30, won=True)
         result_text = f"Дилер перебрал! Победа! +{reward} EcsCoin"
     elif player_val > dealer_val:
-        reward = game['bet'] * 2
-        update_balance(user_id, reward)
-        add_xp(user_id, 30)
-        update_game_stats(user_id, True)
+        reward = game.bet * BJ_WIN_PAYOUT
+        await settle_game(user_id, "bj", payout=reward, xp_gain=30, won=True)
         result_text = f"Победа! +{reward} EcsCoin"
     elif player_val < dealer_val:
-        update_game_stats(user_id, False)
-        result_text = f"Проигрыш! -{game['bet']} EcsCoin"
+        await settle_game(user_id, "bj", won=False)
+        result_text = f"Проигрыш! -{game.bet} EcsCoin"
     else:
-        update_balance(user_id, game['bet'])
+        await settle_game(user_id, "bj", payout=game.bet)
         result_text = f"Ничья! Ставка возвращена"
     
-    del blackjack_games[user_id]
-    
     await callback.message.edit_text(
         f"**БЛЭКДЖЕК**\n\n"
-        f"Твои карты: {' '.join(card_str(c) for c in game['player_hand'])} = {player_val}\n"
-        f"Дилер: {' '.join(card_str(c) for c in game['dealer_hand'])} = {dealer_val}\n\n"
+        f"Твои карты: {game.player_hand.text()} = {player_val}\n"
+        f"Дилер: {game.dealer_hand.text()} = {dealer_val}\n\n"
         f"{result_text}"
     )
     await callback.answer()
 
 
+# Slot paytable: each reel stops on a symbol with the given weight, three of
+# a kind pays the symbol's multiplier and any pair pays SLOT_PAIR_MULTIPLIER.
+# Multipliers are the total return including the stake. A pair comes up on
+# almost half of all spins, so it only returns the stake; the table works out
+# to an RTP of about 95.8% (see slot_rtp_exact and tests/test_rtp.py).
+SLOT_SYMBOLS = ['A', 'B', 'C', 'D', 'E', 'F', '7']
+SLOT_WEIGHTS = [30, 25, 20, 15, 5, 3, 2]
+SLOT_TRIPLE_MULTIPLIERS = [5, 10, 12, 20, 40, 100, 200]
+SLOT_PAIR_MULTIPLIER = 1
+
 @dp.message_handler(commands=["slots"])
 async def cmd_slots(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
     parts = msg.text.split()
     if len(parts) < 2:
@@ -1424,58 +3209,136 @@ async def cmd_slots(msg: types.Message):
         await msg.reply("Ставка должна быть положительной!")
         return
     
-    user = get_user(msg.from_user.id)
-    if user['balance'] < bet:
-        await msg.reply(f"Недостаточно средств! Твой баланс: {user['balance']} EcsCoin")
-        return
-    
-    update_balance(msg.from_user.id, -bet)
-    
-    symbols = ['A', 'B', 'C', 'D', 'E', 'F', '7']
-    weights = [30, 25, 20, 15, 5, 3, 2]
-    
-    reel1 = random.choices(symbols, weights=weights)[0]
-    reel2 = random.choices(symbols, weights=weights)[0]
-    reel3 = random.choices(symbols, weights=weights)[0]
+    reel1, reel2, reel3 = random.choices(SLOT_SYMBOLS, weights=SLOT_WEIGHTS, k=3)
     
     reward = 0
     multiplier = 0
+    xp_gain = 0
+    won = False
     
     if reel1 == reel2 == reel3:
-        if reel1 == '7':
-            multiplier = 100
-        elif reel1 == 'F':
-            multiplier = 50
-        elif reel1 == 'E':
-            multiplier = 20
-        elif reel1 == 'D':
-            multiplier = 10
-        elif reel1 == 'C':
-            multiplier = 7
-        elif reel1 == 'B':
-            multiplier = 5
-        else:
-            multiplier = 3
-        
+        multiplier = SLOT_TRIPLE_MULTIPLIERS[SLOT_SYMBOLS.index(reel1)]
         reward = bet * multiplier
-        update_balance(msg.from_user.id, reward)
-        add_xp(msg.from_user.id, 25)
-        update_game_stats(msg.from_user.id, True)
-        await msg.reply(f"**СЛОТЫ**\n\n[ {reel1} | {reel2} | {reel3} ]\n\nДЖЕКПОТ x{multiplier}!\n+{reward} EcsCoin")
+        xp_gain = 25
+        won = True
     elif reel1 == reel2 or reel2 == reel3 or reel1 == reel3:
-        multiplier = 2
+        multiplier = SLOT_PAIR_MULTIPLIER
         reward = bet * multiplier
-        update_balance(msg.from_user.id, reward)
-        add_xp(msg.from_user.id, 10)
-        await msg.reply(f"**СЛОТЫ**\n\n[ {reel1} | {reel2} | {reel3} ]\n\nПара! x{multiplier}\n+{reward} EcsCoin")
+        xp_gain = 10
+        won = None
+    
+    if not await settle_game(msg.from_user.id, "slots", stake=bet, payout=reward, xp_gain=xp_gain, won=won):
+        user = await get_user(msg.from_user.id)
+        await msg.reply(f"Недостаточно средств! Твой баланс: {user['balance']} EcsCoin")
+        return
+    
+    if won:
+        await msg.reply(f"**СЛОТЫ**\n\n[ {reel1} | {reel2} | {reel3} ]\n\nДЖЕКПОТ x{multiplier}!\n+{reward} EcsCoin")
+    elif multiplier:
+        await msg.reply(f"**СЛОТЫ**\n\n[ {reel1} | {reel2} | {reel3} ]\n\nПара! x{multiplier}\nВыплата: {reward} EcsCoin (ставка {bet})")
     else:
-        update_game_stats(msg.from_user.id, False)
         await msg.reply(f"**СЛОТЫ**\n\n[ {reel1} | {reel2} | {reel3} ]\n\nПроигрыш! -{bet} EcsCoin")
 
 
+# Return-to-player model for /slots and /blackjack, built on the same paytable
+# and rule constants as the handlers. Slots have a closed form; both games are
+# also simulated in vectorized chunks, blackjack with a player who hits below
+# RTP_PLAYER_STANDS.
+RTP_CHUNK = 1 << 18
+
+def slot_rtp_exact():
+    total = sum(SLOT_WEIGHTS)
+    rtp = 0.0
+    for weight, multiplier in zip(SLOT_WEIGHTS, SLOT_TRIPLE_MULTIPLIERS):
+        p = weight / total
+        rtp += p ** 3 * multiplier + 3 * p * p * (1 - p) * SLOT_PAIR_MULTIPLIER
+    return rtp
+
+def _rtp_chunks(rounds):
+    while rounds > 0:
+        n = min(rounds, RTP_CHUNK)
+        rounds -= n
+        yield n
+
+def _rtp_estimate(payout_sum, payout_sq, rounds):
+    mean = payout_sum / rounds
+    return mean, math.sqrt(max(payout_sq / rounds - mean * mean, 0.0) / rounds)
+
+def simulate_slots(rounds, rng):
+    bounds = np.cumsum(SLOT_WEIGHTS)
+    triples = np.asarray(SLOT_TRIPLE_MULTIPLIERS, dtype=np.float64)
+    payout_sum = payout_sq = 0.0
+    for n in _rtp_chunks(rounds):
+        a, b, c = np.searchsorted(bounds, rng.integers(0, bounds[-1], size=(3, n)), side='right')
+        pair = (a == b) | (b == c) | (a == c)
+        payout = np.where((a == b) & (b == c), triples[a], np.where(pair, float(SLOT_PAIR_MULTIPLIER), 0.0))
+        payout_sum += payout.sum()
+        payout_sq += np.dot(payout, payout)
+    return _rtp_estimate(payout_sum, payout_sq, rounds)
+
+def _bj_deal(hand, rows, decks, pos, rng, tables):
+    # Partial Fisher-Yates: swap a random undealt card into each row's next
+    # position, so only the cards a round actually uses are shuffled.
+    values, aces = tables
+    total, soft = hand
+    p = pos[rows]
+    j = p + (rng.random(rows.size) * (52 - p)).astype(np.intp)
+    cards = decks[rows, j]
+    decks[rows, j] = decks[rows, p]
+    pos[rows] = p + 1
+    t = total[rows] + values[cards]
+    s = soft[rows] + aces[cards]
+    for _ in range(2):
+        fix = (t > 21) & (s > 0)
+        t -= 10 * fix
+        s -= fix
+    total[rows] = t
+    soft[rows] = s
+
+def _bj_draw_to(hand, rows, stands, decks, pos, rng, tables):
+    rows = rows[hand[0][rows] < stands]
+    while rows.size:
+        _bj_deal(hand, rows, decks, pos, rng, tables)
+        rows = rows[hand[0][rows] < stands]
+
+def simulate_blackjack(rounds, rng, player_stands=RTP_PLAYER_STANDS):
+    tables = (np.frombuffer(CARD_VALUES, dtype=np.uint8).astype(np.int16), (np.arange(52) % 13 == 12).astype(np.int16))
+    full_deck = np.frombuffer(FULL_DECK, dtype=np.uint8)
+    payout_sum = payout_sq = 0.0
+    for n in _rtp_chunks(rounds):
+        decks = np.tile(full_deck, (n, 1))
+        pos = np.zeros(n, dtype=np.intp)
+        everyone = np.arange(n)
+        player = (np.zeros(n, dtype=np.int16), np.zeros(n, dtype=np.int16))
+        dealer = (np.zeros(n, dtype=np.int16), np.zeros(n, dtype=np.int16))
+        for hand in (player, player, dealer, dealer):
+            _bj_deal(hand, everyone, decks, pos, rng, tables)
+        player_total, dealer_total = player[0], dealer[0]
+        natural = player_total == 21
+        _bj_draw_to(player, np.flatnonzero(~natural), player_stands, decks, pos, rng, tables)
+        _bj_draw_to(dealer, np.flatnonzero(~natural & (player_total <= 21)), BJ_DEALER_STANDS, decks, pos, rng, tables)
+        payout = np.select(
+            [natural, player_total > 21, dealer_total > 21, player_total > dealer_total, player_total == dealer_total],
+            [BJ_NATURAL_PAYOUT, 0.0, float(BJ_WIN_PAYOUT), float(BJ_WIN_PAYOUT), 1.0],
+            0.0
+        )
+        payout_sum += payout.sum()
+        payout_sq += np.dot(payout, payout)
+    return _rtp_estimate(payout_sum, payout_sq, rounds)
+
+def rtp_report(rounds=RTP_SIM_ROUNDS, seed=None):
+    rng = np.random.default_rng(seed)
+    report = []
+    for name, simulate, band in (("slots", simulate_slots, SLOTS_RTP_BAND), ("blackjack", simulate_blackjack, BLACKJACK_RTP_BAND)):
+        started = time.perf_counter()
+        rtp, stderr = simulate(rounds, rng)
+        report.append((name, rtp, stderr, rounds / (time.perf_counter() - started), band))
+    return report
+
+
 @dp.message_handler(commands=["quiz_create"])
 async def cmd_quiz_create(msg: types.Message, state: FSMContext):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
     await state.update_data(questions=[])
     await QuizCreation.waiting_for_name.set()
@@ -1610,26 +3473,26 @@ async def quiz_finish(callback: types.CallbackQuery, state: FSMContext):
         return
     
     created_at = int(time.time())
-    cursor.execute(
-        "INSERT INTO quizzes(name, creator_id, created_at) VALUES (?, ?, ?)",
-        (name, callback.from_user.id, created_at)
-    )
-    quiz_id = cursor.lastrowid
-    
-    for q in questions:
-        answers = q['answers']
-        option_a = answers[0] if len(answers) > 0 else ""
-        option_b = answers[1] if len(answers) > 1 else ""
-        option_c = answers[2] if len(answers) > 2 else None
-        option_d = answers[3] if len(answers) > 3 else None
-        
-        cursor.execute(
-            """INSERT INTO quiz_questions(quiz_id, question_text, option_a, option_b, option_c, option_d, correct_option)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (quiz_id, q['question'], option_a, option_b, option_c, option_d, q['correct'])
+    async with db_transaction() as tx:
+        cur = await tx.execute(
+            "INSERT INTO quizzes(name, creator_id, created_at) VALUES (?, ?, ?)",
+            (name, callback.from_user.id, created_at)
         )
+        quiz_id = cur.lastrowid
+        
+        for q in questions:
+            answers = q['answers']
+            option_a = answers[0] if len(answers) > 0 else ""
+            option_b = answers[1] if len(answers) > 1 else ""
+            option_c = answers[2] if len(answers) > 2 else None
+            option_d = answers[3] if len(answers) > 3 else None
+            
+            await tx.execute(
+                """INSERT INTO quiz_questions(quiz_id, question_text, option_a, option_b, option_c, option_d, correct_option)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (quiz_id, q['question'], option_a, option_b, option_c, option_d, q['correct'])
+            )
     
-    conn.commit()
     await state.finish()
     
     await callback.message.edit_text(
@@ -1642,7 +3505,7 @@ async def quiz_finish(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message_handler(commands=["quiz_list"])
 async def cmd_quiz_list(msg: types.Message):
-    cursor.execute(
+    quizzes = await db_report(
         """SELECT q.quiz_id, q.name, u.username, q.times_played,
                   (SELECT COUNT(*) FROM quiz_questions WHERE quiz_id = q.quiz_id) as q_count
            FROM quizzes q
@@ -1651,7 +3514,6 @@ async def cmd_quiz_list(msg: types.Message):
            ORDER BY q.times_played DESC
            LIMIT 20"""
     )
-    quizzes = cursor.fetchall()
     
     if not quizzes:
         await msg.reply("Пока нет доступных викторин. Создай первую: /quiz_create")
@@ -1667,7 +3529,7 @@ async def cmd_quiz_list(msg: types.Message):
 
 @dp.message_handler(commands=["quiz_play"])
 async def cmd_quiz_play(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     parts = msg.text.split()
     
     if len(parts) < 2:
@@ -1680,8 +3542,7 @@ async def cmd_quiz_play(msg: types.Message):
         await msg.reply("Неверный ID викторины.")
         return
     
-    cursor.execute("SELECT name, reward, xp_reward FROM quizzes WHERE quiz_id = ?", (quiz_id,))
-    quiz = cursor.fetchone()
+    quiz = await db_fetchone("SELECT name, reward, xp_reward FROM quizzes WHERE quiz_id = ?", (quiz_id,))
     
     if not quiz:
         await msg.reply("Викторина не найдена.")
@@ -1689,29 +3550,17 @@ async def cmd_quiz_play(msg: types.Message):
     
     quiz_name, reward, xp_reward = quiz
     
-    cursor.execute(
+    questions = await db_fetchall(
         "SELECT question_id, question_text, option_a, option_b, option_c, option_d, correct_option FROM quiz_questions WHERE quiz_id = ?",
         (quiz_id,)
     )
-    questions = cursor.fetchall()
     
     if not questions:
         await msg.reply("В этой викторине нет вопросов.")
         return
     
     user_id = msg.from_user.id
-    quiz_sessions[user_id] = {
-        'quiz_id': quiz_id,
-        'quiz_name': quiz_name,
-        'questions': questions,
-        'current': 0,
-        'score': 0,
-        'correct_count': 0,
-        'start_time': time.time(),
-        'chat_id': msg.chat.id,
-        'reward': reward,
-        'xp_reward': xp_reward
-    }
+    quiz_sessions[user_id] = QuizSession(quiz_id, quiz_name, questions, msg.chat.id, reward, xp_reward)
     
     await send_quiz_question(msg.chat.id, user_id)
 
@@ -1720,8 +3569,8 @@ async def send_quiz_question(chat_id, user_id):
     if not session:
         return
     
-    current = session['current']
-    questions = session['questions']
+    current = session.current
+    questions = session.questions
     
     if current >= len(questions):
         await finish_quiz(chat_id, user_id)
@@ -1744,7 +3593,7 @@ async def send_quiz_question(chat_id, user_id):
     
     await bot.send_message(
         chat_id,
-        f"**{session['quiz_name']}**\n\n"
+        f"**{session.quiz_name}**\n\n"
         f"Вопрос {current + 1}/{len(questions)}:\n\n"
         f"**{q_text}**",
         reply_markup=keyboard
@@ -1760,15 +3609,15 @@ async def quiz_answer(callback: types.CallbackQuery):
         return
     
     answer = callback.data.split("_")[2]
-    current = session['current']
-    questions = session['questions']
+    current = session.current
+    questions = session.questions
     
     q = questions[current]
     correct = q[6]
     
     if answer == correct:
-        session['score'] += 10
-        session['correct_count'] += 1
+        session.score += 10
+        session.correct_count += 1
         await callback.message.edit_text(
             f"{callback.message.text}\n\n"
             f"Правильно! Ответ: {correct}"
@@ -1779,7 +3628,7 @@ async def quiz_answer(callback: types.CallbackQuery):
             f"Неправильно! Правильный ответ: {correct}"
         )
     
-    session['current'] += 1
+    session.current += 1
     await callback.answer()
     
     await asyncio.sleep(1)
@@ -1790,27 +3639,27 @@ async def finish_quiz(chat_id, user_id):
     if not session:
         return
     
-    time_taken = int(time.time() - session['start_time'])
-    correct_count = session['correct_count']
-    total = len(session['questions'])
-    score = session['score']
+    time_taken = int(time.time() - session.start_time)
+    correct_count = session.correct_count
+    total = len(session.questions)
+    score = session.score
     
     percentage = (correct_count / total * 100) if total > 0 else 0
     
-    cursor.execute("UPDATE quizzes SET times_played = times_played + 1 WHERE quiz_id = ?", (session['quiz_id'],))
-    
-    cursor.execute(
-        """INSERT INTO quiz_scores(quiz_id, user_id, score, correct_answers, total_questions, completed_at, time_taken)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (session['quiz_id'], user_id, score, correct_count, total, int(time.time()), time_taken)
-    )
-    conn.commit()
+    async with db_transaction() as tx:
+        await tx.execute("UPDATE quizzes SET times_played = times_played + 1 WHERE quiz_id = ?", (session.quiz_id,))
+        
+        cur = await tx.execute(
+            """INSERT INTO quiz_scores(quiz_id, user_id, score, correct_answers, total_questions, completed_at, time_taken)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (session.quiz_id, user_id, score, correct_count, total, int(time.time()), time_taken)
+        )
+        leaderboard.add_quiz_result(cur.lastrowid, user_id, score, correct_count, total)
     
     if percentage >= 70:
-        reward = session['reward']
-        xp = session['xp_reward']
-        update_balance(user_id, reward)
-        add_xp(user_id, xp)
+        reward = session.reward
+        xp = session.xp_reward
+        await settle_game(user_id, "quiz", payout=reward, xp_gain=xp)
         reward_text = f"\n\nНаграда: +{reward} EcsCoin, +{xp} XP"
     else:
         reward_text = "\n\nНабери 70%+ правильных ответов для награды!"
@@ -1827,16 +3676,15 @@ async def finish_quiz(chat_id, user_id):
 
 @dp.message_handler(commands=["quiz_my"])
 async def cmd_quiz_my(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
-    cursor.execute(
+    quizzes = await db_report(
         """SELECT quiz_id, name, times_played,
                   (SELECT COUNT(*) FROM quiz_questions WHERE quiz_id = q.quiz_id) as q_count
            FROM quizzes q
            WHERE creator_id = ?""",
         (msg.from_user.id,)
     )
-    quizzes = cursor.fetchall()
     
     if not quizzes:
         await msg.reply("У тебя пока нет созданных викторин. Создай первую: /quiz_create")
@@ -1852,7 +3700,7 @@ async def cmd_quiz_my(msg: types.Message):
 
 @dp.message_handler(commands=["quiz_delete"])
 async def cmd_quiz_delete(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     parts = msg.text.split()
     
     if len(parts) < 2:
@@ -1865,8 +3713,7 @@ async def cmd_quiz_delete(msg: types.Message):
         await msg.reply("Неверный ID викторины.")
         return
     
-    cursor.execute("SELECT creator_id FROM quizzes WHERE quiz_id = ?", (quiz_id,))
-    row = cursor.fetchone()
+    row = await db_fetchone("SELECT creator_id FROM quizzes WHERE quiz_id = ?", (quiz_id,))
     
     if not row:
         await msg.reply("Викторина не найдена.")
@@ -1876,25 +3723,20 @@ async def cmd_quiz_delete(msg: types.Message):
         await msg.reply("Ты не можешь удалить эту викторину.")
         return
     
-    cursor.execute("DELETE FROM quiz_questions WHERE quiz_id = ?", (quiz_id,))
-    cursor.execute("DELETE FROM quiz_scores WHERE quiz_id = ?", (quiz_id,))
-    cursor.execute("DELETE FROM quizzes WHERE quiz_id = ?", (quiz_id,))
-    conn.commit()
+    async with db_transaction() as tx:
+        await tx.execute("DELETE FROM quiz_questions WHERE quiz_id = ?", (quiz_id,))
+        await tx.execute("DELETE FROM quiz_scores WHERE quiz_id = ?", (quiz_id,))
+        await tx.execute("DELETE FROM quizzes WHERE quiz_id = ?", (quiz_id,))
+    await rebuild_quiz_leaderboard()
     
     await msg.reply(f"Викторина #{quiz_id} удалена.")
 
 @dp.message_handler(commands=["quiz_top"])
 async def cmd_quiz_top(msg: types.Message):
-    cursor.execute(
-        """SELECT u.username, SUM(qs.score) as total_score, COUNT(*) as games,
-                  SUM(qs.correct_answers) as correct, SUM(qs.total_questions) as total
-           FROM quiz_scores qs
-           JOIN users u ON qs.user_id = u.user_id
-           GROUP BY qs.user_id
-           ORDER BY total_score DESC
-           LIMIT 10"""
-    )
-    top = cursor.fetchall()
+    top = [
+        (leaderboard.players[user_id][2] if user_id in leaderboard.players else user_id, score, games, correct, total)
+        for user_id, score, games, correct, total in leaderboard.top_quiz(10)
+    ]
     
     if not top:
         await msg.reply("Пока никто не играл в викторины.")
@@ -1912,24 +3754,353 @@ async def cmd_quiz_top(msg: types.Message):
 SUPPORTED_LANGUAGES = {
     'python': {'extension': '.py', 'cmd': 'python3'},
     'py': {'extension': '.py', 'cmd': 'python3'},
-    'javascript': {'extension': '.js', 'cmd': 'node'},
-    'js': {'extension': '.js', 'cmd': 'node'},
+    'javascript': {'extension': '.js', 'cmd': 'node', 'memory_mb': 2048},
+    'js': {'extension': '.js', 'cmd': 'node', 'memory_mb': 2048},
     'bash': {'extension': '.sh', 'cmd': 'bash'},
     'sh': {'extension': '.sh', 'cmd': 'bash'},
 }
 
-@dp.message_handler(commands=["run_code"])
-async def cmd_run_code(msg: types.Message):
-    if msg.from_user.id not in ADMINS:
-        await msg.reply("Эта команда только для администраторов.")
-        return
-    ensure_user(msg.from_user)
-    parts = msg.text.split(maxsplit=1)
-    
-    if len(parts) < 2:
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            InlineKeyboardButton("Python", callback_data="code_lang_python"),
+# preexec_fn is unsafe once the bot has threads (aiosqlite, to_thread, the
+# APK progress pump), so limits are set by a small exec shim instead: it
+# applies the rlimits to itself and then execs the real command.
+CODE_RUN_LIMITS_SHIM = r"""
+import os, resource, sys
+for spec in sys.argv[1].split(","):
+    name, soft, hard = spec.split(":")
+    resource.setrlimit(getattr(resource, name), (int(soft), int(hard)))
+try:
+    os.execvp(sys.argv[2], sys.argv[2:])
+except OSError as e:
+    sys.stderr.write(f"{sys.argv[2]}: {e.strerror}\n")
+    os._exit(127)
+"""
+
+def _code_run_limited(argv, memory_mb, cpu=True):
+    memory = memory_mb * 1024 * 1024
+    limits = [
+        ("RLIMIT_AS", memory, memory),
+        ("RLIMIT_FSIZE", CODE_RUN_OUTPUT_BYTES, CODE_RUN_OUTPUT_BYTES),
+        ("RLIMIT_CORE", 0, 0),
+    ]
+    if cpu:
+        limits.append(("RLIMIT_CPU", CODE_RUN_TIMEOUT, CODE_RUN_TIMEOUT + 1))
+    spec = ",".join(f"{name}:{soft}:{hard}" for name, soft, hard in limits)
+    return [sys.executable, "-I", "-S", "-c", CODE_RUN_LIMITS_SHIM, spec, *argv]
+
+def _kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def _read_capped(stream, proc, result, key):
+    buf = bytearray()
+    total = 0
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        total += len(chunk)
+        if len(buf) < CODE_RUN_CAPTURE_BYTES:
+            buf += chunk[:CODE_RUN_CAPTURE_BYTES - len(buf)]
+        if total > CODE_RUN_OUTPUT_BYTES and not result['truncated']:
+            result['truncated'] = True
+            _kill_process_group(proc)
+    result[key] = buf.decode('utf-8', errors='replace')
+
+async def run_sandboxed(argv, cwd, memory_mb=CODE_RUN_MEMORY_MB, timeout=CODE_RUN_TIMEOUT):
+    result = {'stdout': "", 'stderr': "", 'returncode': None, 'timed_out': False, 'truncated': False}
+    start_time = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        *_code_run_limited(argv, memory_mb),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+        start_new_session=True
+    )
+    readers = [
+        asyncio.create_task(_read_capped(proc.stdout, proc, result, 'stdout')),
+        asyncio.create_task(_read_capped(proc.stderr, proc, result, 'stderr')),
+    ]
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        result['timed_out'] = True
+    finally:
+        # The session leader may be gone while its children still hold the pipes open.
+        _kill_process_group(proc)
+        await proc.wait()
+        await asyncio.gather(*readers)
+    result['returncode'] = proc.returncode
+    result['execution_time'] = time.perf_counter() - start_time
+    return result
+
+# Runs inside a warm worker, which acts as a zygote: it pre-imports the
+# interpreter and common modules once, then forks a fresh child per job in
+# its own temp directory. Monkeypatches, files and globals die with the child.
+# The protocol uses private copies of fds 0/1 that the child closes before
+# running user code; the zygote reads the child's stdout/stderr through
+# pipes and enforces the output cap and timeout itself.
+PY_WORKER_SOURCE = r"""
+import builtins, io, json, os, resource, select, shutil, signal, struct, sys, tempfile, time, traceback, types
+import math, random, re, string, itertools, functools, collections, heapq, bisect, datetime, decimal, fractions, statistics
+capture_bytes, output_bytes, timeout = map(int, sys.argv[1:4])
+work_dir = os.getcwd()
+proto_in = os.fdopen(os.dup(0), "rb", buffering=0)
+proto_out = os.fdopen(os.dup(1), "wb", buffering=0)
+devnull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devnull, 0)
+os.dup2(devnull, 1)
+os.dup2(devnull, 2)
+
+def read_exact(size):
+    data = b""
+    while len(data) < size:
+        chunk = proto_in.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def run_child(code, filename, job_dir, out_w, err_w, closed_fds):
+    os.setpgid(0, 0)
+    for fd in closed_fds:
+        os.close(fd)
+    os.dup2(out_w, 1)
+    os.dup2(err_w, 2)
+    os.close(out_w)
+    os.close(err_w)
+    os.chdir(job_dir)
+    resource.setrlimit(resource.RLIMIT_CPU, (timeout + 1, timeout + 2))
+    random.seed()
+    sys.stdout = open(1, "w", encoding="utf-8", errors="replace", closefd=False)
+    sys.stderr = open(2, "w", encoding="utf-8", errors="replace", closefd=False)
+    sys.argv = [filename]
+    main = types.ModuleType("__main__")
+    main.__builtins__ = builtins
+    sys.modules["__main__"] = main
+    status = 0
+    try:
+        exec(compile(code, filename, "exec"), main.__dict__)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        status = 1
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next)
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(status & 0xff)
+
+def kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def run_job(job):
+    job_dir = tempfile.mkdtemp(dir=work_dir)
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        run_child(job["code"], job["filename"], job_dir, out_w, err_w,
+                  (out_r, err_r, proto_in.fileno(), proto_out.fileno()))
+    os.close(out_w)
+    os.close(err_w)
+    buffers = {out_r: bytearray(), err_r: bytearray()}
+    open_fds = [out_r, err_r]
+    total = 0
+    status = None
+    result = {"timed_out": False, "truncated": False}
+    while open_fds:
+        remaining = start + timeout - time.perf_counter()
+        if remaining <= 0:
+            result["timed_out"] = True
+            kill_group(pid)
+            break
+        ready, _, _ = select.select(open_fds, [], [], min(remaining, 0.05))
+        for fd in ready:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                open_fds.remove(fd)
+                continue
+            total += len(chunk)
+            buf = buffers[fd]
+            if len(buf) < capture_bytes:
+                buf += chunk[:capture_bytes - len(buf)]
+            if total > output_bytes and not result["truncated"]:
+                result["truncated"] = True
+                kill_group(pid)
+        if status is None:
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+            if not reaped:
+                status = None
+            else:
+                # The child is gone; anything it left behind may still hold the pipes.
+                kill_group(pid)
+    kill_group(pid)
+    if status is None:
+        status = os.waitpid(pid, 0)[1]
+    result["execution_time"] = time.perf_counter() - start
+    result["returncode"] = None if result["timed_out"] else os.waitstatus_to_exitcode(status)
+    result["stdout"] = buffers[out_r].decode("utf-8", errors="replace")
+    result["stderr"] = buffers[err_r].decode("utf-8", errors="replace")
+    os.close(out_r)
+    os.close(err_r)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    return result
+
+while True:
+    header = read_exact(4)
+    if header is None:
+        break
+    result = run_job(json.loads(read_exact(struct.unpack(">I", header)[0])))
+    payload = json.dumps(result).encode()
+    proto_out.write(struct.pack(">I", len(payload)) + payload)
+"""
+
+class PythonWorker:
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+        self.work_dir = None
+        self.runs = 0
+
+    async def start(self):
+        self.work_dir = tempfile.mkdtemp(prefix="py_worker_")
+        argv = [self.cmd, "-I", "-c", PY_WORKER_SOURCE,
+                str(CODE_RUN_CAPTURE_BYTES), str(CODE_RUN_OUTPUT_BYTES), str(CODE_RUN_TIMEOUT)]
+        self.proc = await asyncio.create_subprocess_exec(
+            *_code_run_limited(argv, CODE_RUN_MEMORY_MB, cpu=False),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=self.work_dir,
+            start_new_session=True
+        )
+        return self
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def run(self, code, timeout=CODE_RUN_TIMEOUT):
+        self.runs += 1
+        payload = json.dumps({"code": code, "filename": "main.py"}).encode()
+        start_time = time.perf_counter()
+        try:
+            self.proc.stdin.write(len(payload).to_bytes(4, "big") + payload)
+            await self.proc.stdin.drain()
+            header = await asyncio.wait_for(self.proc.stdout.readexactly(4), timeout + 5)
+            return json.loads(await self.proc.stdout.readexactly(int.from_bytes(header, "big")))
+        except asyncio.TimeoutError:
+            await self.close()
+            return {'stdout': "", 'stderr': "", 'returncode': None, 'timed_out': True, 'truncated': False, 'execution_time': timeout}
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            await self.close()
+            return {'stdout': "", 'stderr': "", 'returncode': self.proc.returncode, 'timed_out': False, 'truncated': False,
+                    'execution_time': time.perf_counter() - start_time}
+
+    async def close(self):
+        if self.proc is not None:
+            _kill_process_group(self.proc)
+            await self.proc.wait()
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+
+class PythonWorkerPool:
+    def __init__(self, size, max_runs, cmd="python3"):
+        self.size = size
+        self.max_runs = max_runs
+        self.cmd = cmd
+        self.idle = []
+        self.refilling = False
+        self.spawned = 0
+        self.recycled = 0
+
+    async def _spawn(self):
+        self.spawned += 1
+        return await PythonWorker(self.cmd).start()
+
+    async def _refill(self):
+        if self.refilling:
+            return
+        self.refilling = True
+        try:
+            while len(self.idle) < self.size:
+                self.idle.append(await self._spawn())
+        except Exception as e:
+            print(f"Python worker spawn error: {e}")
+        finally:
+            self.refilling = False
+
+    async def warm(self):
+        await self._refill()
+
+    async def _acquire(self):
+        while self.idle:
+            worker = self.idle.pop()
+            if worker.alive:
+                return worker
+            await worker.close()
+        return await self._spawn()
+
+    async def run(self, code):
+        worker = await self._acquire()
+        try:
+            result = await worker.run(code)
+        except BaseException:
+            await worker.close()
+            raise
+        if worker.alive and worker.runs < self.max_runs:
+            self.idle.append(worker)
+        else:
+            self.recycled += 1
+            await worker.close()
+            asyncio.create_task(self._refill())
+        result.setdefault('timed_out', False)
+        return result
+
+    async def close(self):
+        workers, self.idle = self.idle, []
+        for worker in workers:
+            await worker.close()
+
+python_pool = PythonWorkerPool(PY_POOL_SIZE, PY_WORKER_MAX_RUNS)
+
+async def run_code_job(user_id, job):
+    if code_run_queued.get(user_id, 0) >= CODE_RUN_USER_QUEUE:
+        return None
+    code_run_queued[user_id] = code_run_queued.get(user_id, 0) + 1
+    lock = code_run_locks.setdefault(user_id, asyncio.Lock())
+    try:
+        async with lock:
+            async with code_run_slots:
+                return await job()
+    finally:
+        code_run_queued[user_id] -= 1
+        if not code_run_queued[user_id]:
+            del code_run_queued[user_id]
+            code_run_locks.pop(user_id, None)
+
+@dp.message_handler(commands=["run_code"])
+async def cmd_run_code(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    await ensure_user(msg.from_user)
+    parts = msg.text.split(maxsplit=1)
+    
+    if len(parts) < 2:
+        keyboard = InlineKeyboardMarkup(row_width=2)
+        keyboard.add(
+            InlineKeyboardButton("Python", callback_data="code_lang_python"),
             InlineKeyboardButton("JavaScript", callback_data="code_lang_javascript"),
             InlineKeyboardButton("Bash", callback_data="code_lang_bash"),
         )
@@ -1949,11 +4120,7 @@ async def cmd_run_code(msg: types.Message):
         await msg.reply(f"Язык '{lang}' не поддерживается.\nПоддерживаемые: {', '.join(SUPPORTED_LANGUAGES.keys())}")
         return
     
-    code_compile_sessions[msg.from_user.id] = {
-        'language': lang,
-        'waiting_for_code': True,
-        'chat_id': msg.chat.id
-    }
+    code_compile_sessions[msg.from_user.id] = CodeSession(lang, msg.chat.id)
     
     await msg.reply(f"Язык: **{lang}**\n\nТеперь отправь код для выполнения:")
 
@@ -1964,16 +4131,12 @@ async def code_lang_selected(callback: types.CallbackQuery):
         return
     lang = callback.data.split("_")[2]
     
-    code_compile_sessions[callback.from_user.id] = {
-        'language': lang,
-        'waiting_for_code': True,
-        'chat_id': callback.message.chat.id
-    }
+    code_compile_sessions[callback.from_user.id] = CodeSession(lang, callback.message.chat.id)
     
     await callback.message.edit_text(f"Язык: **{lang}**\n\nТеперь отправь код для выполнения:")
     await callback.answer()
 
-@dp.message_handler(lambda msg: msg.from_user.id in code_compile_sessions and code_compile_sessions[msg.from_user.id].get('waiting_for_code'))
+@dp.message_handler(lambda msg: msg.from_user.id in code_compile_sessions)
 async def execute_code(msg: types.Message):
     if msg.from_user.id not in ADMINS:
         if msg.from_user.id in code_compile_sessions:
@@ -1990,7 +4153,7 @@ async def execute_code(msg: types.Message):
         if code.endswith('```'):
             code = code[:-3]
     
-    lang = session['language']
+    lang = session.language
     lang_info = SUPPORTED_LANGUAGES.get(lang)
     
     if not lang_info:
@@ -2000,33 +4163,45 @@ async def execute_code(msg: types.Message):
     
     del code_compile_sessions[msg.from_user.id]
     
-    await msg.reply("Выполняю код...")
+    if code_run_queued.get(msg.from_user.id, 0) >= CODE_RUN_USER_QUEUE:
+        await msg.reply(f"У тебя уже {CODE_RUN_USER_QUEUE} задачи в очереди. Дождись их завершения.")
+        return
+    
+    await msg.reply("Выполняю код..." if not code_run_slots.locked() else "Все исполнители заняты, код поставлен в очередь...")
     
+    work_dir = None
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix=lang_info['extension'], delete=False) as f:
-            f.write(code)
-            temp_file = f.name
-        
-        start_time = time.time()
+        if lang_info['cmd'] == python_pool.cmd:
+            job = lambda: python_pool.run(code)
+        else:
+            work_dir = tempfile.mkdtemp(prefix="run_code_")
+            temp_file = os.path.join(work_dir, "main" + lang_info['extension'])
+            with open(temp_file, 'w') as f:
+                f.write(code)
+            job = lambda: run_sandboxed([lang_info['cmd'], temp_file], work_dir, lang_info.get('memory_mb', CODE_RUN_MEMORY_MB))
         
-        result = subprocess.run(
-            [lang_info['cmd'], temp_file],
-            capture_output=True,
-            text=True,
-            timeout=10,
-            cwd=tempfile.gettempdir()
-        )
+        result = await run_code_job(msg.from_user.id, job)
+        if result is None:
+            await msg.reply(f"У тебя уже {CODE_RUN_USER_QUEUE} задачи в очереди. Дождись их завершения.")
+            return
         
-        execution_time = time.time() - start_time
+        if result['timed_out']:
+            await msg.reply(f"Время выполнения истекло (лимит {CODE_RUN_TIMEOUT} секунд).")
+            return
         
-        output = result.stdout[:1500] if result.stdout else ""
-        error = result.stderr[:1500] if result.stderr else ""
+        execution_time = result['execution_time']
+        output = result['stdout'][:1500]
+        error = result['stderr'][:1500]
+        if result['truncated']:
+            error += f"\n[Вывод превысил {CODE_RUN_OUTPUT_BYTES} байт, процесс остановлен]"
+        elif result['returncode'] is not None and result['returncode'] < 0:
+            error += f"\n[Процесс завершён сигналом {-result['returncode']}]"
+        error = error.strip()
         
-        cursor.execute(
+        await db_execute(
             "INSERT INTO code_executions(user_id, language, code, output, error, execution_time, executed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
             (msg.from_user.id, lang, code[:2000], output, error, execution_time, int(time.time()))
         )
-        conn.commit()
         
         response = f"**Результат выполнения ({lang})**\n\n"
         
@@ -2039,24 +4214,25 @@ async def execute_code(msg: types.Message):
         if not output and not error:
             response += "Код выполнен без вывода.\n"
         
-        response += f"\nВремя: {execution_time:.3f} сек"
+        if execution_time < 1:
+            response += f"\nВремя: {execution_time * 1000:.2f} мс"
+        else:
+            response += f"\nВремя: {execution_time:.3f} сек"
         
         await msg.reply(response)
         
-    except subprocess.TimeoutExpired:
-        await msg.reply("Время выполнения истекло (лимит 10 секунд).")
     except Exception as e:
         await msg.reply(f"Ошибка выполнения: {str(e)[:500]}")
     finally:
-        if 'temp_file' in locals() and os.path.exists(temp_file):
-            os.remove(temp_file)
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
 @dp.message_handler(commands=["compile"])
 async def cmd_compile(msg: types.Message):
     if msg.from_user.id not in ADMINS:
         await msg.reply("Эта команда только для администраторов.")
         return
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
     if not msg.reply_to_message or not msg.reply_to_message.text:
         await msg.reply(
@@ -2105,7 +4281,7 @@ async def cmd_decompile(msg: types.Message):
     if msg.from_user.id not in ADMINS:
         await msg.reply("Эта команда только для администраторов.")
         return
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
     if not msg.reply_to_message or not msg.reply_to_message.text:
         await msg.reply(
@@ -2164,7 +4340,7 @@ async def cmd_decompile(msg: types.Message):
 
 @dp.message_handler(commands=["minify"])
 async def cmd_minify(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
     if not msg.reply_to_message or not msg.reply_to_message.text:
         await msg.reply("Ответь на сообщение с кодом командой /minify")
@@ -2184,14 +4360,12 @@ async def cmd_minify(msg: types.Message):
     try:
         if lang in ['js', 'javascript']:
             try:
-                import jsbeautifier
                 opts = jsbeautifier.default_options()
                 minified = code.replace('\n', ' ').replace('  ', ' ')
             except ImportError:
                 minified = code.replace('\n', ' ').replace('  ', ' ')
         else:
             try:
-                import python_minifier
                 minified = python_minifier.minify(code, remove_literal_statements=True)
             except ImportError:
                 lines = code.split('\n')
@@ -2214,7 +4388,7 @@ async def cmd_minify(msg: types.Message):
 
 @dp.message_handler(commands=["beautify"])
 async def cmd_beautify(msg: types.Message):
-    ensure_user(msg.from_user)
+    await ensure_user(msg.from_user)
     
     if not msg.reply_to_message or not msg.reply_to_message.text:
         await msg.reply("Ответь на сообщение с кодом командой /beautify")
@@ -2234,13 +4408,11 @@ async def cmd_beautify(msg: types.Message):
     try:
         if lang in ['js', 'javascript']:
             try:
-                import jsbeautifier
                 beautified = jsbeautifier.beautify(code)
             except ImportError:
                 beautified = code
         elif lang == 'css':
             try:
-                import cssbeautifier
                 beautified = cssbeautifier.beautify(code)
             except ImportError:
                 beautified = code
@@ -2257,7 +4429,830 @@ async def cmd_beautify(msg: types.Message):
 
 
 APK_STORAGE = "apk_storage"
-os.makedirs(APK_STORAGE, exist_ok=True)
+APK_BLOBS = os.path.join(APK_STORAGE, "blobs")
+
+# APK work runs in a process pool so large archives never block the event
+# loop. Workers push (job_id, done, total) byte counts onto a shared queue;
+# apk_progress_pump() mirrors them into apk_job_progress for the handlers.
+# The pump is a daemon thread polling with a timeout, so it stops on
+# apk_progress_stop and can never hold up interpreter exit.
+APK_PROGRESS_POLL = 0.5
+apk_job_pool = None
+apk_job_slots = asyncio.Semaphore(APK_JOB_WORKERS)
+apk_progress_queue = None
+apk_progress_stop = threading.Event()
+apk_job_progress = {}
+_apk_worker_progress = None
+
+def _apk_worker_init(queue):
+    global _apk_worker_progress
+    _apk_worker_progress = queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class _ApkProgress:
+    def __init__(self, job_id, total):
+        self.job_id = job_id
+        self.total = total
+        self.done = 0
+        self.reported = 0
+        self.report()
+
+    def add(self, amount):
+        self.done += amount
+        if self.done - self.reported >= max(self.total // 100, 1) or self.done >= self.total:
+            self.report()
+
+    def report(self):
+        self.reported = self.done
+        if _apk_worker_progress is not None:
+            _apk_worker_progress.put((self.job_id, self.done, self.total))
+
+def apk_entry_kind(name):
+    if name.endswith('.dex'):
+        return 'dex'
+    if name == 'AndroidManifest.xml':
+        return 'manifest'
+    if name == 'resources.arsc':
+        return 'arsc'
+    for prefix, kind in (('res/', 'res'), ('assets/', 'assets'), ('lib/', 'lib'), ('META-INF/', 'meta')):
+        if name.startswith(prefix):
+            return kind
+    return 'other'
+
+def apk_index_job(job_id, file_path):
+    entries = []
+    manifest_info = ""
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            entries.append((
+                info.filename, info.file_size, info.compress_size, info.CRC, info.header_offset, info.compress_type,
+                apk_entry_kind(info.filename)
+            ))
+            if info.filename == 'AndroidManifest.xml':
+                try:
+                    if b'package=' in zip_ref.read(info):
+                        manifest_info = "AndroidManifest.xml найден (бинарный формат)"
+                    else:
+                        manifest_info = "AndroidManifest.xml найден"
+                except Exception:
+                    manifest_info = "AndroidManifest.xml найден"
+    return {'entries': entries, 'manifest_info': manifest_info}
+
+def _dex_class_names(data, limit):
+    names = []
+    if len(data) < 0x70 or data[:4] != b'dex\n':
+        return names
+    try:
+        string_ids_size, string_ids_off, type_ids_size, type_ids_off = struct.unpack_from('<4I', data, 0x38)
+        class_defs_size, class_defs_off = struct.unpack_from('<2I', data, 0x60)
+        for i in range(min(class_defs_size, limit)):
+            class_idx = struct.unpack_from('<I', data, class_defs_off + i * 32)[0]
+            if class_idx >= type_ids_size:
+                continue
+            descriptor_idx = struct.unpack_from('<I', data, type_ids_off + class_idx * 4)[0]
+            if descriptor_idx >= string_ids_size:
+                continue
+            offset = struct.unpack_from('<I', data, string_ids_off + descriptor_idx * 4)[0]
+            while data[offset] & 0x80:
+                offset += 1
+            offset += 1
+            descriptor = data[offset:data.index(b'\0', offset)].decode('utf-8', errors='replace')
+            if descriptor.startswith('L') and descriptor.endswith(';'):
+                names.append(descriptor[1:-1].replace('/', '.'))
+    except (struct.error, IndexError, ValueError):
+        pass
+    return names
+
+def _res_string_pool(data, start, limit):
+    header_size = struct.unpack_from('<H', data, start + 2)[0]
+    count, _, flags, strings_start = struct.unpack_from('<4I', data, start + 8)
+    base = start + strings_start
+    strings = []
+    for i in range(min(count, limit)):
+        pos = base + struct.unpack_from('<I', data, start + header_size + i * 4)[0]
+        if flags & 0x100:
+            pos += 2 if data[pos] & 0x80 else 1
+            length = data[pos]
+            if length & 0x80:
+                length = ((length & 0x7f) << 8) | data[pos + 1]
+                pos += 2
+            else:
+                pos += 1
+            strings.append(data[pos:pos + length].decode('utf-8', errors='replace'))
+        else:
+            length = struct.unpack_from('<H', data, pos)[0]
+            pos += 2
+            if length & 0x8000:
+                length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, pos)[0]
+                pos += 2
+            strings.append(data[pos:pos + length * 2].decode('utf-16-le', errors='replace'))
+    return strings
+
+def _res_walk_chunks(data, start, end, strings, limit):
+    pos = start
+    while pos + 8 <= end and len(strings) < limit:
+        chunk_type, header_size, size = struct.unpack_from('<HHI', data, pos)
+        if size < 8:
+            break
+        if chunk_type == 0x0001:
+            strings.extend(_res_string_pool(data, pos, limit - len(strings)))
+        elif chunk_type == 0x0200:
+            _res_walk_chunks(data, pos + header_size, min(pos + size, end), strings, limit)
+        pos += size
+
+def _res_strings(data, limit):
+    strings = []
+    try:
+        root_type, root_header, root_size = struct.unpack_from('<HHI', data, 0)
+        if root_type in (0x0002, 0x0003):
+            _res_walk_chunks(data, root_header, min(root_size, len(data)), strings, limit)
+    except (struct.error, IndexError):
+        pass
+    return strings
+
+def apk_content_job(job_id, file_path):
+    terms = {}
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+        parsed = [info for info in infos if apk_entry_kind(info.filename) in ('dex', 'manifest', 'arsc')]
+        progress = _ApkProgress(job_id, sum(info.file_size for info in parsed))
+        for info in infos:
+            terms.setdefault(('file', info.filename), None)
+        for info in parsed:
+            budget = APK_INDEX_MAX_TERMS - len(terms)
+            if budget <= 0:
+                break
+            data = zip_ref.read(info)
+            kind = apk_entry_kind(info.filename)
+            if kind == 'dex':
+                found = [('class', name) for name in _dex_class_names(data, budget)]
+            else:
+                source = 'manifest' if kind == 'manifest' else 'resource'
+                found = [(source, text) for text in _res_strings(data, budget) if text.strip()]
+            for term in found:
+                terms.setdefault(term, None)
+            progress.add(info.file_size)
+    return list(terms)[:APK_INDEX_MAX_TERMS]
+
+# Content-addressed storage: uploads and extracted members of at least
+# APK_BLOB_MIN_SIZE bytes live once under blobs/<sha[:2]>/<sha> as
+# read-only files. Extracted trees are editable, so they never share an
+# inode with a blob: members are reflinked (copy-on-write) from the blob.
+# Without reflink support a blob would only add a second full copy of each
+# member, so extracted members are then left out of the store entirely. An
+# existing blob is only reused after its hash checks out. apk_blobs counts
+# the database references, and gc_apk_blobs() removes a blob only when
+# that count is zero and no hardlink to it remains on disk.
+FICLONE = 0x40049409
+
+def apk_blob_path(sha256):
+    return os.path.join(APK_BLOBS, sha256[:2], sha256)
+
+def _apk_reflink(source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(target)
+    return False
+
+apk_reflink_ok = None
+
+def apk_reflink_supported():
+    global apk_reflink_ok
+    if apk_reflink_ok is None:
+        probe = os.path.join(APK_BLOBS, f".reflink.{os.getpid()}")
+        with open(probe, 'wb') as f:
+            f.write(b"\0" * 4096)
+        apk_reflink_ok = _apk_reflink(probe, probe + ".clone")
+        for path in (probe, probe + ".clone"):
+            if os.path.exists(path):
+                os.remove(path)
+    return apk_reflink_ok
+
+def _apk_copy(source, target):
+    if not _apk_reflink(source, target):
+        shutil.copyfile(source, target)
+
+def _apk_store_blob(path, sha256):
+    blob = apk_blob_path(sha256)
+    if os.path.exists(blob) and _sha256_file(blob) == sha256:
+        tmp = path + ".blob"
+        if _apk_reflink(blob, tmp):
+            os.replace(tmp, path)
+        return
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    tmp = f"{blob}.{os.getpid()}.tmp"
+    _apk_copy(path, tmp)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, blob)
+
+def apk_extract_job(job_id, file_path, decompiled_path, names=None):
+    os.makedirs(decompiled_path, exist_ok=True)
+    manifest = []
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        infos = [zip_ref.getinfo(name) for name in names] if names else zip_ref.infolist()
+        progress = _ApkProgress(job_id, sum(info.file_size for info in infos))
+        for info in infos:
+            target = apk_local_path(decompiled_path, info.filename)
+            if info.is_dir() or target is None:
+                progress.add(info.file_size)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.exists(target):
+                os.remove(target)
+            digest = hashlib.sha256()
+            with zip_ref.open(info) as source, open(target, 'wb') as output:
+                while True:
+                    chunk = source.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    output.write(chunk)
+            sha256 = None
+            if info.file_size >= APK_BLOB_MIN_SIZE and apk_reflink_supported():
+                sha256 = digest.hexdigest()
+                _apk_store_blob(target, sha256)
+            stat = os.stat(target)
+            manifest.append((stat.st_mtime_ns, stat.st_size, sha256, info.filename))
+            progress.add(info.file_size)
+    return manifest
+
+# Incremental rebuild: members whose extracted copy is missing or unchanged
+# (same mtime/size as at extraction, or same size and CRC) are copied as raw
+# compressed bytes from the original APK. Only edited or new files are
+# compressed again. STORED members are page-aligned for .so files and
+# 4-byte aligned otherwise, like zipalign does, by padding the local
+# header's extra field.
+APK_STORED_SUFFIXES = ('.so', 'resources.arsc')
+
+def _apk_file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+def _apk_align_extra(offset, name_len, method, name):
+    if method != zipfile.ZIP_STORED:
+        return b""
+    alignment = 4096 if name.endswith('.so') else 4
+    data_offset = offset + 30 + name_len + 6
+    padding = (alignment - data_offset % alignment) % alignment
+    return struct.pack('<HHH', 0xD935, 2 + padding, alignment) + b"\0" * padding
+
+class _ApkZipWriter:
+    def __init__(self, output):
+        self.output = output
+        self.central = []
+
+    def _local_header(self, name, flags, method, mod_time, mod_date, crc, compress_size, file_size):
+        offset = self.output.tell()
+        encoded = name.encode('utf-8')
+        extra = _apk_align_extra(offset, len(encoded), method, name)
+        self.output.write(struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', 20, flags, method, mod_time, mod_date,
+            crc, compress_size, file_size, len(encoded), len(extra)
+        ) + encoded + extra)
+        return offset
+
+    def _add_central(self, name, flags, method, mod_time, mod_date, crc, compress_size, file_size, offset):
+        if max(compress_size, file_size, offset) >= 0xFFFFFFFF:
+            raise ValueError("ZIP64 не поддерживается")
+        self.central.append((name, flags, method, mod_time, mod_date, crc, compress_size, file_size, offset))
+
+    def copy_raw(self, source, header_offset, compress_size, file_size, crc, name):
+        source.seek(header_offset)
+        header = source.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise ValueError(f"повреждённый локальный заголовок: {name}")
+        _, _, flags, method, mod_time, mod_date, _, _, _, name_len, extra_len = struct.unpack('<4s5H3L2H', header)
+        flags &= ~0x08
+        offset = self._local_header(name, flags, method, mod_time, mod_date, crc, compress_size, file_size)
+        source.seek(header_offset + 30 + name_len + extra_len)
+        remaining = compress_size
+        while remaining:
+            chunk = source.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise ValueError(f"обрезанные данные: {name}")
+            self.output.write(chunk)
+            remaining -= len(chunk)
+        self._add_central(name, flags, method, mod_time, mod_date, crc, compress_size, file_size, offset)
+
+    def add_file(self, path, name, method):
+        date_time = time.localtime(os.path.getmtime(path))
+        mod_time = (date_time.tm_hour << 11) | (date_time.tm_min << 5) | (date_time.tm_sec // 2)
+        mod_date = (max(date_time.tm_year - 1980, 0) << 9) | (date_time.tm_mon << 5) | date_time.tm_mday
+        flags = 0x800 if not name.isascii() else 0
+        offset = self._local_header(name, flags, method, mod_time, mod_date, 0, 0, 0)
+        crc = file_size = compress_size = 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if method == zipfile.ZIP_DEFLATED else None
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                data = compressor.compress(chunk) if compressor else chunk
+                compress_size += len(data)
+                self.output.write(data)
+        if compressor:
+            data = compressor.flush()
+            compress_size += len(data)
+            self.output.write(data)
+        end = self.output.tell()
+        self.output.seek(offset + 14)
+        self.output.write(struct.pack('<3L', crc, compress_size, file_size))
+        self.output.seek(end)
+        self._add_central(name, flags, method, mod_time, mod_date, crc, compress_size, file_size, offset)
+
+    def close(self):
+        start = self.output.tell()
+        for name, flags, method, mod_time, mod_date, crc, compress_size, file_size, offset in self.central:
+            encoded = name.encode('utf-8')
+            self.output.write(struct.pack(
+                '<4s6H3L5H2L', b'PK\x01\x02', 20, 20, flags, method, mod_time, mod_date,
+                crc, compress_size, file_size, len(encoded), 0, 0, 0, 0, 0o644 << 16, offset
+            ) + encoded)
+        size = self.output.tell() - start
+        self.output.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(self.central), len(self.central), size, start, 0))
+
+def apk_rebuild_job(job_id, file_path, decompiled_path, entries, fully_extracted, output_path):
+    known = set()
+    plan = []
+    for name, file_size, compress_size, crc, header_offset, compress_type, extracted_mtime, extracted_size in entries:
+        known.add(name)
+        local = apk_local_path(decompiled_path, name)
+        if not local or not os.path.isfile(local):
+            if extracted_mtime is not None or fully_extracted:
+                continue
+            plan.append(('copy', name, file_size, (header_offset, compress_size, file_size, crc)))
+            continue
+        stat = os.stat(local)
+        unchanged = (stat.st_mtime_ns, stat.st_size) == (extracted_mtime, extracted_size)
+        if not unchanged and stat.st_size == file_size:
+            unchanged = _apk_file_crc(local) == crc
+        if unchanged:
+            plan.append(('copy', name, file_size, (header_offset, compress_size, file_size, crc)))
+        else:
+            stored = compress_type == zipfile.ZIP_STORED or name.endswith(APK_STORED_SUFFIXES)
+            plan.append(('add', name, stat.st_size, (local, zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)))
+    
+    if os.path.isdir(decompiled_path):
+        for root, dirs, files in os.walk(decompiled_path):
+            dirs.sort()
+            for file in sorted(files):
+                local = os.path.join(root, file)
+                name = os.path.relpath(local, decompiled_path).replace(os.sep, '/')
+                if name not in known:
+                    method = zipfile.ZIP_STORED if name.endswith(APK_STORED_SUFFIXES) else zipfile.ZIP_DEFLATED
+                    plan.append(('add', name, os.path.getsize(local), (local, method)))
+    
+    progress = _ApkProgress(job_id, sum(size for _, _, size, _ in plan))
+    changed = 0
+    with open(file_path, 'rb') as source, open(output_path, 'wb') as output:
+        writer = _ApkZipWriter(output)
+        for action, name, size, args in plan:
+            if action == 'copy':
+                writer.copy_raw(source, args[0], args[1], args[2], args[3], name)
+            else:
+                writer.add_file(args[0], name, args[1])
+                changed += 1
+            progress.add(size)
+        writer.close()
+    return {'size': os.path.getsize(output_path), 'changed': changed, 'total': len(plan)}
+
+# Workers come from a forkserver rather than a plain fork of this process,
+# which already runs aiosqlite and executor threads whose locks a forked
+# child could inherit mid-operation.
+def get_apk_pool():
+    global apk_job_pool, apk_progress_queue
+    if apk_job_pool is None:
+        context = multiprocessing.get_context("forkserver")
+        apk_progress_queue = context.Queue()
+        apk_job_pool = ProcessPoolExecutor(
+            max_workers=APK_JOB_WORKERS,
+            mp_context=context,
+            initializer=_apk_worker_init,
+            initargs=(apk_progress_queue,)
+        )
+        apk_progress_stop.clear()
+        threading.Thread(
+            target=apk_progress_pump, args=(apk_progress_queue, asyncio.get_running_loop()),
+            name="apk-progress", daemon=True
+        ).start()
+    return apk_job_pool
+
+def apk_progress_pump(queue, loop):
+    while not apk_progress_stop.is_set():
+        try:
+            item = queue.get(timeout=APK_PROGRESS_POLL)
+        except Empty:
+            continue
+        except (EOFError, OSError):
+            break
+        try:
+            loop.call_soon_threadsafe(_apk_progress_update, *item)
+        except RuntimeError:
+            break
+
+def _apk_progress_update(job_id, done, total):
+    if job_id in apk_job_progress:
+        apk_job_progress[job_id] = (done, total)
+
+async def _apk_progress_updater(job_id, progress_msg, label):
+    shown = None
+    while True:
+        await asyncio.sleep(APK_PROGRESS_INTERVAL)
+        done, total = apk_job_progress.get(job_id, (0, 0))
+        if not total or (done, total) == shown:
+            continue
+        shown = (done, total)
+        try:
+            await progress_msg.edit_text(
+                f"{label}: {done * 100 // total}% ({done / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f} MB)"
+            )
+        except Exception:
+            pass
+
+async def run_apk_job(user_id, upload_id, kind, label, progress_msg, func, *args):
+    cur = await db_execute(
+        "INSERT INTO apk_jobs(upload_id, user_id, kind, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+        (upload_id, user_id, kind, int(time.time()))
+    )
+    job_id = cur.lastrowid
+    
+    if apk_job_slots.locked() and progress_msg:
+        try:
+            await progress_msg.edit_text(f"{label}: в очереди...")
+        except Exception:
+            pass
+    
+    async with apk_job_slots:
+        await db_execute("UPDATE apk_jobs SET status = 'running', started_at = ? WHERE job_id = ?", (int(time.time()), job_id))
+        apk_job_progress[job_id] = (0, 0)
+        updater = asyncio.create_task(_apk_progress_updater(job_id, progress_msg, label)) if progress_msg else None
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(get_apk_pool(), func, job_id, *args)
+        except Exception as e:
+            await db_execute(
+                "UPDATE apk_jobs SET status = 'failed', finished_at = ?, error = ? WHERE job_id = ?",
+                (int(time.time()), str(e)[:500], job_id)
+            )
+            raise
+        finally:
+            if updater:
+                updater.cancel()
+            apk_job_progress.pop(job_id, None)
+        await db_execute("UPDATE apk_jobs SET status = 'done', finished_at = ? WHERE job_id = ?", (int(time.time()), job_id))
+    return result
+
+# Central directory index: every member's sizes, CRC and local header offset
+# live in apk_entries, so listings and single-file reads never touch the
+# rest of the archive and nothing has to be extracted up front.
+async def index_apk_upload(user_id, upload_id, file_path, progress_msg=None):
+    index = await run_apk_job(user_id, upload_id, "index", "Индексация", progress_msg, apk_index_job, file_path)
+    async with db_transaction() as tx:
+        await tx.execute("DELETE FROM apk_entries WHERE upload_id = ?", (upload_id,))
+        await tx.executemany(
+            """INSERT OR REPLACE INTO apk_entries(upload_id, name, file_size, compress_size, crc, header_offset, compress_type, kind)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            [(upload_id, *entry) for entry in index['entries']]
+        )
+        await tx.execute("UPDATE apk_uploads SET indexed_at = ?, summary = NULL WHERE upload_id = ?", (int(time.time()), upload_id))
+    schedule_apk_content_index(user_id, upload_id, file_path)
+    return index
+
+# Content index: file names, DEX class names and the AXML/ARSC string pools
+# of each upload go into the apk_search FTS5 table under a contiguous rowid
+# range recorded on the upload, so lookups and deletes are range-bounded.
+apk_content_indexing = set()
+apk_search_lock = asyncio.Lock()
+
+def schedule_apk_content_index(user_id, upload_id, file_path):
+    if upload_id in apk_content_indexing:
+        return
+    apk_content_indexing.add(upload_id)
+    asyncio.create_task(build_apk_content_index(user_id, upload_id, file_path))
+
+# The upload may expire or be deleted while its terms are inserted in
+# batches. Each batch checks that it still exists, and rows that end up not
+# recorded on the upload (gone, or a failed batch) are deleted again, since
+# forget_apk_uploads() only knows the recorded range.
+async def build_apk_content_index(user_id, upload_id, file_path):
+    first = inserted = 0
+    recorded = False
+    try:
+        terms = await run_apk_job(user_id, upload_id, "content", "Индекс содержимого", None, apk_content_job, file_path)
+        async with apk_search_lock:
+            async with db_transaction() as tx:
+                async with tx.execute("SELECT search_first, search_last FROM apk_uploads WHERE upload_id = ?", (upload_id,)) as cur:
+                    row = await cur.fetchone()
+                if row is None:
+                    return
+                if row[0] is not None:
+                    await tx.execute("DELETE FROM apk_search WHERE rowid BETWEEN ? AND ?", (row[0], row[1]))
+                    await tx.execute("UPDATE apk_uploads SET search_first = NULL, search_last = NULL WHERE upload_id = ?", (upload_id,))
+                async with tx.execute("SELECT COALESCE(MAX(rowid), 0) FROM apk_search") as cur:
+                    first = (await cur.fetchone())[0] + 1
+            for i in range(0, len(terms), 5000):
+                async with db_transaction() as tx:
+                    async with tx.execute("SELECT 1 FROM apk_uploads WHERE upload_id = ?", (upload_id,)) as cur:
+                        if await cur.fetchone() is None:
+                            break
+                    batch = terms[i:i + 5000]
+                    await tx.executemany(
+                        "INSERT INTO apk_search(rowid, source, text) VALUES (?, ?, ?)",
+                        [(first + i + j, source, text) for j, (source, text) in enumerate(batch)]
+                    )
+                    inserted = i + len(batch)
+            else:
+                async with db_transaction() as tx:
+                    cur = await tx.execute(
+                        """UPDATE apk_uploads SET search_first = ?, search_last = ?, content_indexed_at = ?, summary = NULL
+                           WHERE upload_id = ?""",
+                        (first, first + len(terms) - 1, int(time.time()), upload_id)
+                    )
+                    recorded = cur.rowcount > 0
+    except Exception as e:
+        print(f"APK content index error for upload {upload_id}: {e}")
+    finally:
+        apk_content_indexing.discard(upload_id)
+        if inserted and not recorded:
+            try:
+                await db_execute("DELETE FROM apk_search WHERE rowid BETWEEN ? AND ?", (first, first + inserted - 1))
+            except Exception as e:
+                print(f"APK content index cleanup error for upload {upload_id}: {e}")
+
+async def ensure_apk_index(user_id, upload_id):
+    row = await db_fetchone("SELECT file_path, indexed_at, content_indexed_at FROM apk_uploads WHERE upload_id = ?", (upload_id,))
+    if not row or not row[0] or not os.path.exists(row[0]):
+        return
+    if row[1] is None:
+        await index_apk_upload(user_id, upload_id, row[0])
+    elif row[2] is None:
+        schedule_apk_content_index(user_id, upload_id, row[0])
+
+def apk_listing_from_names(names):
+    folders = sorted({name.rsplit('/', 1)[0] for name in names if '/' in name})
+    return folders, names
+
+async def apk_analysis_from_index(upload_id):
+    row = await db_fetchone("SELECT summary, search_first, search_last FROM apk_uploads WHERE upload_id = ?", (upload_id,))
+    if row and row[0]:
+        return json.loads(row[0])
+    
+    counts = dict(await db_report(
+        "SELECT kind, COUNT(*) FROM apk_entries WHERE upload_id = ? GROUP BY kind", (upload_id,)
+    ))
+    total_files, total_size = (await db_report(
+        "SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM apk_entries WHERE upload_id = ?", (upload_id,)
+    ))[0]
+    dex_files = [r[0] for r in await db_report(
+        "SELECT name FROM apk_entries WHERE upload_id = ? AND kind = 'dex' ORDER BY name", (upload_id,)
+    )]
+    libs = [r[0] for r in await db_report(
+        "SELECT name FROM apk_entries WHERE upload_id = ? AND kind = 'lib' ORDER BY name", (upload_id,)
+    )]
+    analysis = {
+        'dex_files': dex_files,
+        'libs': libs,
+        'resources': counts.get('res', 0),
+        'assets': counts.get('assets', 0),
+        'total_files': total_files,
+        'total_size': total_size
+    }
+    if row and row[1] is not None:
+        analysis['terms'] = dict(await db_report(
+            "SELECT source, COUNT(*) FROM apk_search WHERE rowid BETWEEN ? AND ? GROUP BY source", (row[1], row[2])
+        ))
+    
+    await db_execute("UPDATE apk_uploads SET summary = ? WHERE upload_id = ?", (json.dumps(analysis), upload_id))
+    return analysis
+
+def read_apk_member(file_path, header_offset, compress_size, compress_type, limit):
+    with open(file_path, 'rb') as f:
+        f.seek(header_offset)
+        header = f.read(30)
+        if len(header) != 30 or header[:4] != b'PK\x03\x04':
+            raise ValueError("повреждённый локальный заголовок")
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(header_offset + 30 + name_len + extra_len)
+        if compress_type == zipfile.ZIP_STORED:
+            return f.read(min(compress_size, limit))
+        if compress_type != zipfile.ZIP_DEFLATED:
+            raise ValueError(f"неподдерживаемое сжатие {compress_type}")
+        decompressor = zlib.decompressobj(-15)
+        content = b""
+        remaining = compress_size
+        while remaining and len(content) < limit:
+            chunk = f.read(min(remaining, 65536))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            content += decompressor.decompress(chunk, limit - len(content))
+        return content
+
+def apk_local_path(decompiled_path, name):
+    target = os.path.normpath(os.path.join(decompiled_path, name))
+    if not target.startswith(os.path.normpath(decompiled_path) + os.sep):
+        return None
+    return target
+
+apk_blob_lock = asyncio.Lock()
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+# Download sink for APK uploads: hashes while writing, enforces the size cap
+# on every chunk and rejects anything that doesn't start like a ZIP, so bad
+# uploads are dropped mid-transfer. Only the tail that can hold the EOCD
+# record is kept in memory for the final check.
+class ApkUploadSink(io.RawIOBase):
+    EOCD_WINDOW = 22 + 65535
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.file = open(path, 'wb')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.tail = b""
+
+    def writable(self):
+        return True
+
+    def write(self, chunk):
+        if self.size + len(chunk) > self.limit:
+            raise ValueError(f"файл больше {self.limit // (1024 * 1024)} MB")
+        if len(self.head) < 4:
+            self.head += bytes(chunk[:4 - len(self.head)])
+            if len(self.head) == 4 and self.head != b'PK\x03\x04':
+                raise ValueError("файл не является ZIP/APK архивом")
+        self.file.write(chunk)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        self.tail = (self.tail + bytes(chunk))[-self.EOCD_WINDOW:]
+        return len(chunk)
+
+    def finish(self):
+        self.file.close()
+        eocd = self.tail.rfind(b'PK\x05\x06')
+        while eocd >= 0 and len(self.tail) - eocd < 22:
+            eocd = self.tail.rfind(b'PK\x05\x06', 0, eocd)
+        if eocd < 0:
+            raise ValueError("не найден конец центрального каталога ZIP")
+        entries, cd_size, cd_offset, comment_len = struct.unpack_from('<HII H', self.tail, eocd + 10)
+        if eocd + 22 + comment_len != len(self.tail):
+            raise ValueError("повреждённый конец центрального каталога ZIP")
+        if cd_offset != 0xFFFFFFFF and cd_offset + cd_size > self.size - (len(self.tail) - eocd):
+            raise ValueError("центральный каталог ZIP выходит за пределы файла")
+        if entries == 0:
+            raise ValueError("пустой архив")
+        return self.digest.hexdigest()
+
+    def discard(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+async def download_apk_upload(doc, path):
+    limit = APK_MAX_UPLOAD_MB * 1024 * 1024
+    if doc.file_size and doc.file_size > limit:
+        raise ValueError(f"файл больше {APK_MAX_UPLOAD_MB} MB")
+    file_info = await bot.get_file(doc.file_id)
+    sink = ApkUploadSink(path, limit)
+    try:
+        await bot.download_file(file_info.file_path, sink, seek=False)
+        return sink.finish()
+    except BaseException:
+        sink.discard()
+        raise
+
+async def _apk_blob_refs(tx, blobs, delta):
+    now = int(time.time())
+    await tx.executemany(
+        """INSERT INTO apk_blobs(sha256, size, refcount, created_at) VALUES (?, ?, ?, ?)
+           ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + excluded.refcount""",
+        [(sha256, size, delta, now) for sha256, size in blobs]
+    )
+
+async def adopt_apk_blob(path, sha256=None):
+    if sha256 is None:
+        sha256 = await asyncio.to_thread(_sha256_file, path)
+    blob = apk_blob_path(sha256)
+    async with apk_blob_lock:
+        if os.path.exists(blob) and await asyncio.to_thread(_sha256_file, blob) == sha256:
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(path, blob)
+            os.chmod(blob, 0o444)
+        async with db_transaction() as tx:
+            await _apk_blob_refs(tx, [(sha256, os.path.getsize(blob))], 1)
+    return sha256, blob
+
+async def gc_apk_blobs():
+    removed = freed = 0
+    async with apk_blob_lock:
+        rows = await db_fetchall("SELECT sha256, size FROM apk_blobs WHERE refcount <= 0")
+        gone = []
+        for sha256, size in rows:
+            blob = apk_blob_path(sha256)
+            try:
+                if os.stat(blob).st_nlink > 1:
+                    continue
+                os.remove(blob)
+            except FileNotFoundError:
+                pass
+            gone.append((sha256,))
+            removed += 1
+            freed += size
+        if gone:
+            async with db_transaction() as tx:
+                await tx.executemany("DELETE FROM apk_blobs WHERE sha256 = ? AND refcount <= 0", gone)
+    return removed, freed
+
+def _remove_apk_files(rows):
+    for upload_id, file_path, decompiled_path in rows:
+        try:
+            if file_path and os.path.exists(file_path) and not file_path.startswith(APK_BLOBS + os.sep):
+                os.remove(file_path)
+            if decompiled_path and os.path.exists(decompiled_path):
+                shutil.rmtree(decompiled_path, ignore_errors=True)
+        except Exception as e:
+            print(f"Cleanup error for upload {upload_id}: {e}")
+
+async def delete_apk_uploads(rows):
+    for upload_id, _, _ in rows:
+        apk_expiry.cancel(upload_id)
+    await asyncio.to_thread(_remove_apk_files, rows)
+    await forget_apk_uploads([row[0] for row in rows])
+
+async def extract_apk_upload(user_id, upload_id, file_path, decompiled_path, progress_msg=None, names=None):
+    manifest = await run_apk_job(
+        user_id, upload_id, "extract", "Распаковка", progress_msg,
+        apk_extract_job, file_path, decompiled_path, names
+    )
+    async with apk_blob_lock, db_transaction() as tx:
+        extracted = {name for _, _, _, name in manifest}
+        async with tx.execute(
+            "SELECT name, blob_sha256 FROM apk_entries WHERE upload_id = ? AND blob_sha256 IS NOT NULL", (upload_id,)
+        ) as cur:
+            previous = [(sha256, 0) for name, sha256 in await cur.fetchall() if name in extracted]
+        await _apk_blob_refs(tx, previous, -1)
+        await _apk_blob_refs(tx, [(sha256, size) for _, size, sha256, _ in manifest if sha256], 1)
+        await tx.executemany(
+            "UPDATE apk_entries SET extracted_mtime = ?, extracted_size = ?, blob_sha256 = ? WHERE upload_id = ? AND name = ?",
+            [(mtime, size, sha256, upload_id, name) for mtime, size, sha256, name in manifest]
+        )
+        if not names:
+            await tx.execute("UPDATE apk_uploads SET status = 'decompiled' WHERE upload_id = ?", (upload_id,))
+    return len(manifest)
+
+async def forget_apk_uploads(upload_ids):
+    async with apk_blob_lock, db_transaction() as tx:
+        for upload_id in upload_ids:
+            async with tx.execute("SELECT search_first, search_last, blob_sha256 FROM apk_uploads WHERE upload_id = ?", (upload_id,)) as cur:
+                row = await cur.fetchone()
+            if row and row[0] is not None:
+                await tx.execute("DELETE FROM apk_search WHERE rowid BETWEEN ? AND ?", (row[0], row[1]))
+            async with tx.execute(
+                "SELECT blob_sha256 FROM apk_entries WHERE upload_id = ? AND blob_sha256 IS NOT NULL", (upload_id,)
+            ) as cur:
+                blobs = [(sha256, 0) for (sha256,) in await cur.fetchall()]
+            if row and row[2]:
+                blobs.append((row[2], 0))
+            await _apk_blob_refs(tx, blobs, -1)
+            await tx.execute("DELETE FROM apk_entries WHERE upload_id = ?", (upload_id,))
+            await tx.execute("DELETE FROM apk_uploads WHERE upload_id = ?", (upload_id,))
+
+async def apk_jobs_startup():
+    os.makedirs(APK_BLOBS, exist_ok=True)
+    await db_execute(
+        "UPDATE apk_jobs SET status = 'failed', finished_at = ?, error = 'interrupted' WHERE status IN ('queued', 'running')",
+        (int(time.time()),)
+    )
+
+def apk_jobs_shutdown():
+    if apk_job_pool is not None:
+        apk_job_pool.shutdown(wait=False, cancel_futures=True)
+    apk_progress_stop.set()
 
 @dp.message_handler(commands=["apk_decompile"])
 async def cmd_apk_decompile(msg: types.Message):
@@ -2279,51 +5274,34 @@ async def cmd_apk_decompile(msg: types.Message):
         await msg.reply("Файл должен быть в формате .apk")
         return
     
-    await msg.reply("Скачиваю и анализирую APK...")
+    progress_msg = await msg.reply("Скачиваю и анализирую APK...")
+    upload_id = None
     
     try:
-        file_info = await bot.get_file(doc.file_id)
-        file_path = os.path.join(APK_STORAGE, f"{msg.from_user.id}_{int(time.time())}_{doc.file_name}")
-        
-        await bot.download_file(file_info.file_path, file_path)
+        upload_name = os.path.join(APK_STORAGE, f"{msg.from_user.id}_{int(time.time())}_{doc.file_name}")
         
-        decompiled_path = file_path.replace('.apk', '_decompiled')
-        os.makedirs(decompiled_path, exist_ok=True)
-        
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(decompiled_path)
+        sha256 = await download_apk_upload(doc, upload_name)
+        sha256, file_path = await adopt_apk_blob(upload_name, sha256)
         
+        decompiled_path = upload_name.replace('.apk', '_decompiled')
         expires_at = int(time.time()) + 86400
         
-        cursor.execute(
-            """INSERT INTO apk_uploads(user_id, file_id, file_name, file_path, decompiled_path, uploaded_at, expires_at, status)
-               VALUES (?, ?, ?, ?, ?, ?, ?, 'decompiled')""",
-            (msg.from_user.id, doc.file_id, doc.file_name, file_path, decompiled_path, int(time.time()), expires_at)
-        )
-        upload_id = cursor.lastrowid
-        conn.commit()
-        
-        files = []
-        folders = []
-        for root, dirs, filenames in os.walk(decompiled_path):
-            rel_root = os.path.relpath(root, decompiled_path)
-            for d in dirs[:10]:
-                folders.append(os.path.join(rel_root, d) if rel_root != '.' else d)
-            for f in filenames[:20]:
-                files.append(os.path.join(rel_root, f) if rel_root != '.' else f)
+        async with db_transaction() as tx:
+            cur = await tx.execute(
+                """INSERT INTO apk_uploads(user_id, file_id, file_name, file_path, decompiled_path, uploaded_at, expires_at, status, blob_sha256)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, 'processing', ?)""",
+                (msg.from_user.id, doc.file_id, doc.file_name, file_path, decompiled_path, int(time.time()), expires_at, sha256)
+            )
+            upload_id = cur.lastrowid
+        apk_expiry.schedule(upload_id, expires_at)
         
-        manifest_path = os.path.join(decompiled_path, 'AndroidManifest.xml')
-        manifest_info = ""
-        if os.path.exists(manifest_path):
-            try:
-                with open(manifest_path, 'rb') as f:
-                    content = f.read()
-                    if b'package=' in content:
-                        manifest_info = "AndroidManifest.xml найден (бинарный формат)"
-                    else:
-                        manifest_info = "AndroidManifest.xml найден"
-            except:
-                manifest_info = "AndroidManifest.xml найден"
+        index = await index_apk_upload(msg.from_user.id, upload_id, file_path, progress_msg)
+        if APK_LAZY:
+            await db_execute("UPDATE apk_uploads SET status = 'indexed' WHERE upload_id = ?", (upload_id,))
+        else:
+            await extract_apk_upload(msg.from_user.id, upload_id, file_path, decompiled_path, progress_msg)
+        folders, files = apk_listing_from_names([entry[0] for entry in index['entries']])
+        manifest_info = index['manifest_info']
         
         result = f"**APK Декомпилирован!**\n\n"
         result += f"ID: {upload_id}\n"
@@ -2342,11 +5320,15 @@ async def cmd_apk_decompile(msg: types.Message):
         result += f"Команды:\n"
         result += f"/apk_analyze {upload_id} - подробный анализ\n"
         result += f"/apk_view {upload_id} <путь> - просмотр файла\n"
+        result += f"/apk_search {upload_id} <запрос> - поиск по файлам, классам и строкам\n"
+        result += f"/apk_extract {upload_id} [путь] - распаковать на диск\n"
         result += f"/apk_compile {upload_id} - собрать обратно"
         
         await msg.reply(result)
         
     except Exception as e:
+        if upload_id is not None:
+            await db_execute("UPDATE apk_uploads SET status = 'failed' WHERE upload_id = ?", (upload_id,))
         await msg.reply(f"Ошибка декомпиляции: {str(e)[:500]}")
 
 @dp.message_handler(commands=["apk_analyze"])
@@ -2366,46 +5348,21 @@ async def cmd_apk_analyze(msg: types.Message):
         await msg.reply("Неверный ID.")
         return
     
-    cursor.execute("SELECT file_name, decompiled_path FROM apk_uploads WHERE upload_id = ?", (upload_id,))
-    row = cursor.fetchone()
+    row = await db_fetchone("SELECT file_name FROM apk_uploads WHERE upload_id = ?", (upload_id,))
     
     if not row:
         await msg.reply("APK не найден.")
         return
     
-    file_name, decompiled_path = row
+    file_name = row[0]
     
-    if not os.path.exists(decompiled_path):
-        await msg.reply("Декомпилированные файлы не найдены.")
+    try:
+        await ensure_apk_index(msg.from_user.id, upload_id)
+        analysis = await apk_analysis_from_index(upload_id)
+    except Exception as e:
+        await msg.reply(f"Ошибка анализа: {str(e)[:500]}")
         return
     
-    analysis = {
-        'dex_files': [],
-        'resources': [],
-        'assets': [],
-        'libs': [],
-        'total_files': 0,
-        'total_size': 0
-    }
-    
-    for root, dirs, files in os.walk(decompiled_path):
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, decompiled_path)
-            file_size = os.path.getsize(full_path)
-            
-            analysis['total_files'] += 1
-            analysis['total_size'] += file_size
-            
-            if f.endswith('.dex'):
-                analysis['dex_files'].append(rel_path)
-            elif rel_path.startswith('res/'):
-                analysis['resources'].append(rel_path)
-            elif rel_path.startswith('assets/'):
-                analysis['assets'].append(rel_path)
-            elif rel_path.startswith('lib/'):
-                analysis['libs'].append(rel_path)
-    
     result = f"**Анализ APK: {file_name}**\n\n"
     result += f"Всего файлов: {analysis['total_files']}\n"
     result += f"Общий размер: {analysis['total_size'] / 1024 / 1024:.2f} MB\n\n"
@@ -2418,8 +5375,14 @@ async def cmd_apk_analyze(msg: types.Message):
         result += f"**Нативные библиотеки ({len(analysis['libs'])}):**\n"
         result += '\n'.join(analysis['libs'][:10]) + "\n\n"
     
-    result += f"Ресурсов: {len(analysis['resources'])}\n"
-    result += f"Assets: {len(analysis['assets'])}"
+    result += f"Ресурсов: {analysis['resources']}\n"
+    result += f"Assets: {analysis['assets']}"
+    
+    if 'terms' in analysis:
+        result += f"\n\nКлассов: {analysis['terms'].get('class', 0)}\n"
+        result += f"Строк манифеста: {analysis['terms'].get('manifest', 0)}\n"
+        result += f"Строк ресурсов: {analysis['terms'].get('resource', 0)}\n"
+        result += f"/apk_search {upload_id} <запрос> - поиск"
     
     await msg.reply(result)
 
@@ -2442,33 +5405,42 @@ async def cmd_apk_view(msg: types.Message):
     
     file_to_view = parts[2]
     
-    cursor.execute("SELECT decompiled_path FROM apk_uploads WHERE upload_id = ?", (upload_id,))
-    row = cursor.fetchone()
+    row = await db_fetchone("SELECT file_path, decompiled_path FROM apk_uploads WHERE upload_id = ?", (upload_id,))
     
     if not row:
         await msg.reply("APK не найден.")
         return
     
-    decompiled_path = row[0]
-    target_file = os.path.join(decompiled_path, file_to_view)
-    
-    if not os.path.exists(target_file):
-        await msg.reply("Файл не найден.")
-        return
-    
-    if not os.path.isfile(target_file):
-        await msg.reply("Это папка, не файл.")
-        return
+    file_path, decompiled_path = row
+    target_file = apk_local_path(decompiled_path, file_to_view)
     
     try:
-        file_size = os.path.getsize(target_file)
-        
-        if file_size > 50000:
-            await msg.reply(f"Файл слишком большой ({file_size} байт). Максимум 50KB.")
-            return
-        
-        with open(target_file, 'rb') as f:
-            content = f.read()
+        if target_file and os.path.isfile(target_file):
+            file_size = os.path.getsize(target_file)
+            if file_size > APK_VIEW_LIMIT:
+                await msg.reply(f"Файл слишком большой ({file_size} байт). Максимум 50KB.")
+                return
+            with open(target_file, 'rb') as f:
+                content = f.read(APK_VIEW_LIMIT)
+        else:
+            await ensure_apk_index(msg.from_user.id, upload_id)
+            entry = await db_fetchone(
+                "SELECT file_size, compress_size, compress_type, header_offset FROM apk_entries WHERE upload_id = ? AND name = ?",
+                (upload_id, file_to_view)
+            )
+            if not entry:
+                prefix = file_to_view.rstrip('/') + '/'
+                is_folder = await db_fetchone(
+                    "SELECT 1 FROM apk_entries WHERE upload_id = ? AND name >= ? AND name < ? LIMIT 1",
+                    (upload_id, prefix, prefix[:-1] + '0')
+                )
+                await msg.reply("Это папка, не файл." if is_folder else "Файл не найден.")
+                return
+            file_size, compress_size, compress_type, header_offset = entry
+            if file_size > APK_VIEW_LIMIT:
+                await msg.reply(f"Файл слишком большой ({file_size} байт). Максимум 50KB.")
+                return
+            content = await asyncio.to_thread(read_apk_member, file_path, header_offset, compress_size, compress_type, APK_VIEW_LIMIT)
         
         try:
             text_content = content.decode('utf-8')
@@ -2480,6 +5452,106 @@ async def cmd_apk_view(msg: types.Message):
     except Exception as e:
         await msg.reply(f"Ошибка чтения: {e}")
 
+@dp.message_handler(commands=["apk_search"])
+async def cmd_apk_search(msg: types.Message):
+    if not await is_requester_admin(msg) and msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    parts = msg.text.split(maxsplit=2)
+    if len(parts) < 3:
+        await msg.reply("Использование: /apk_search <upload_id> <запрос>")
+        return
+    
+    try:
+        upload_id = int(parts[1])
+    except:
+        await msg.reply("Неверный ID.")
+        return
+    
+    row = await db_fetchone(
+        "SELECT file_name, search_first, search_last, content_indexed_at FROM apk_uploads WHERE upload_id = ?", (upload_id,)
+    )
+    
+    if not row:
+        await msg.reply("APK не найден.")
+        return
+    
+    file_name, search_first, search_last, content_indexed_at = row
+    if content_indexed_at is None:
+        await ensure_apk_index(msg.from_user.id, upload_id)
+        await msg.reply("Индекс содержимого ещё строится, попробуй через несколько секунд.")
+        return
+    
+    query = " ".join('"' + token.replace('"', '""') + '"*' for token in parts[2].split())
+    start_time = time.perf_counter()
+    try:
+        matches = await db_report(
+            """SELECT source, text FROM apk_search
+               WHERE apk_search MATCH ? AND rowid BETWEEN ? AND ?
+               ORDER BY rank
+               LIMIT 20""",
+            (query, search_first, search_last)
+        )
+    except Exception as e:
+        await msg.reply(f"Ошибка поиска: {str(e)[:300]}")
+        return
+    elapsed = (time.perf_counter() - start_time) * 1000
+    
+    if not matches:
+        await msg.reply(f"Ничего не найдено ({elapsed:.1f} мс).")
+        return
+    
+    labels = {'file': "файл", 'class': "класс", 'manifest': "манифест", 'resource': "ресурс"}
+    lines = [f"**Поиск в {file_name}:** {parts[2]}\n"]
+    for source, text in matches:
+        lines.append(f"[{labels.get(source, source)}] {text[:200]}")
+    lines.append(f"\nНайдено за {elapsed:.1f} мс")
+    
+    await msg.reply("\n".join(lines))
+
+@dp.message_handler(commands=["apk_extract"])
+async def cmd_apk_extract(msg: types.Message):
+    if not await is_requester_admin(msg) and msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    parts = msg.text.split(maxsplit=2)
+    if len(parts) < 2:
+        await msg.reply("Использование: /apk_extract <upload_id> [путь к файлу]")
+        return
+    
+    try:
+        upload_id = int(parts[1])
+    except:
+        await msg.reply("Неверный ID.")
+        return
+    
+    row = await db_fetchone("SELECT file_path, decompiled_path, status FROM apk_uploads WHERE upload_id = ?", (upload_id,))
+    
+    if not row or not row[0] or not os.path.exists(row[0]):
+        await msg.reply("APK не найден.")
+        return
+    
+    file_path, decompiled_path, status = row
+    names = None
+    if len(parts) > 2:
+        await ensure_apk_index(msg.from_user.id, upload_id)
+        if not await db_fetchone("SELECT 1 FROM apk_entries WHERE upload_id = ? AND name = ?", (upload_id, parts[2])):
+            await msg.reply("Файл не найден.")
+            return
+        names = [parts[2]]
+    elif status == 'decompiled':
+        await msg.reply("APK уже распакован.")
+        return
+    
+    progress_msg = await msg.reply("Распаковываю...")
+    try:
+        count = await extract_apk_upload(msg.from_user.id, upload_id, file_path, decompiled_path, progress_msg, names)
+        await msg.reply(f"Распаковано файлов: {count}")
+    except Exception as e:
+        await msg.reply(f"Ошибка распаковки: {str(e)[:500]}")
+
 @dp.message_handler(commands=["apk_compile"])
 async def cmd_apk_compile(msg: types.Message):
     if not await is_requester_admin(msg) and msg.from_user.id not in ADMINS:
@@ -2497,38 +5569,41 @@ async def cmd_apk_compile(msg: types.Message):
         await msg.reply("Неверный ID.")
         return
     
-    cursor.execute("SELECT file_name, decompiled_path FROM apk_uploads WHERE upload_id = ?", (upload_id,))
-    row = cursor.fetchone()
+    row = await db_fetchone("SELECT file_name, file_path, decompiled_path, status FROM apk_uploads WHERE upload_id = ?", (upload_id,))
     
     if not row:
         await msg.reply("APK не найден.")
         return
     
-    file_name, decompiled_path = row
+    file_name, file_path, decompiled_path, status = row
     
-    if not os.path.exists(decompiled_path):
-        await msg.reply("Декомпилированные файлы не найдены.")
+    if not os.path.exists(file_path or ""):
+        await msg.reply("Исходный APK не найден.")
         return
     
-    await msg.reply("Собираю APK...")
+    progress_msg = await msg.reply("Собираю APK...")
     
     try:
+        await ensure_apk_index(msg.from_user.id, upload_id)
+        entries = await db_fetchall(
+            """SELECT name, file_size, compress_size, crc, header_offset, compress_type, extracted_mtime, extracted_size
+               FROM apk_entries WHERE upload_id = ? ORDER BY header_offset""",
+            (upload_id,)
+        )
         output_path = decompiled_path.replace('_decompiled', '_rebuilt.apk')
         
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(decompiled_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, decompiled_path)
-                    zipf.write(file_path, arcname)
-        
-        file_size = os.path.getsize(output_path) / 1024 / 1024
+        rebuilt = await run_apk_job(
+            msg.from_user.id, upload_id, "rebuild", "Сборка", progress_msg,
+            apk_rebuild_job, file_path, decompiled_path, entries, status == 'decompiled', output_path
+        )
+        file_size = rebuilt['size'] / 1024 / 1024
         
         with open(output_path, 'rb') as f:
             await bot.send_document(
                 msg.chat.id,
                 types.InputFile(f, filename=file_name.replace('.apk', '_rebuilt.apk')),
-                caption=f"Собранный APK\nРазмер: {file_size:.2f} MB\n\nЗамечание: APK не подписан!"
+                caption=f"Собранный APK\nРазмер: {file_size:.2f} MB\n"
+                        f"Изменено файлов: {rebuilt['changed']} из {rebuilt['total']}\n\nЗамечание: APK не подписан!"
             )
         
         os.remove(output_path)
@@ -2536,13 +5611,64 @@ async def cmd_apk_compile(msg: types.Message):
     except Exception as e:
         await msg.reply(f"Ошибка сборки: {str(e)[:500]}")
 
+@dp.message_handler(commands=["apk_jobs"])
+async def cmd_apk_jobs(msg: types.Message):
+    if not await is_requester_admin(msg) and msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    jobs = await db_report(
+        """SELECT job_id, upload_id, kind, status, created_at, started_at, finished_at
+           FROM apk_jobs
+           ORDER BY job_id DESC
+           LIMIT 10"""
+    )
+    
+    if not jobs:
+        await msg.reply("Задач пока не было.")
+        return
+    
+    lines = [f"**APK задачи** (исполнителей: {APK_JOB_WORKERS})\n"]
+    for job_id, upload_id, kind, status, created_at, started_at, finished_at in jobs:
+        line = f"{job_id}. {kind} #{upload_id} - {status}"
+        if job_id in apk_job_progress and apk_job_progress[job_id][1]:
+            done, total = apk_job_progress[job_id]
+            line += f" {done * 100 // total}%"
+        elif finished_at and started_at:
+            line += f" ({finished_at - started_at} сек)"
+        lines.append(line)
+    
+    await msg.reply("\n".join(lines))
+
+@dp.message_handler(commands=["apk_storage"])
+async def cmd_apk_storage(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    blobs, stored, referenced, refs = (await db_report(
+        """SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * MAX(refcount, 0)), 0), COALESCE(SUM(refcount), 0)
+           FROM apk_blobs"""
+    ))[0]
+    unreferenced = (await db_report("SELECT COUNT(*) FROM apk_blobs WHERE refcount <= 0"))[0][0]
+    
+    await msg.reply(
+        f"**Хранилище APK**\n\n"
+        f"Блобов: {blobs} ({stored / 1024 / 1024:.2f} MB)\n"
+        f"Ссылок: {refs}\n"
+        f"Без ссылок: {unreferenced}\n"
+        f"Без дедупликации заняло бы: {referenced / 1024 / 1024:.2f} MB\n"
+        f"Экономия: {max(referenced - stored, 0) / 1024 / 1024:.2f} MB\n"
+        f"Распакованные файлы: {'reflink' if await asyncio.to_thread(apk_reflink_supported) else 'полные копии'}"
+    )
+
 @dp.message_handler(commands=["apk_list"])
 async def cmd_apk_list(msg: types.Message):
     if not await is_requester_admin(msg) and msg.from_user.id not in ADMINS:
         await msg.reply("Эта команда только для администраторов.")
         return
     
-    cursor.execute(
+    uploads = await db_report(
         """SELECT upload_id, file_name, uploaded_at, expires_at, status
            FROM apk_uploads
            WHERE user_id = ?
@@ -2550,7 +5676,6 @@ async def cmd_apk_list(msg: types.Message):
            LIMIT 10""",
         (msg.from_user.id,)
     )
-    uploads = cursor.fetchall()
     
     if not uploads:
         await msg.reply("У тебя нет загруженных APK.")
@@ -2589,9 +5714,8 @@ async def cmd_apk_delete(msg: types.Message):
         await msg.reply("Неверный ID.")
         return
     
-    cursor.execute("SELECT file_path, decompiled_path FROM apk_uploads WHERE upload_id = ? AND user_id = ?", 
-                   (upload_id, msg.from_user.id))
-    row = cursor.fetchone()
+    row = await db_fetchone("SELECT file_path, decompiled_path FROM apk_uploads WHERE upload_id = ? AND user_id = ?", 
+                            (upload_id, msg.from_user.id))
     
     if not row:
         await msg.reply("APK не найден.")
@@ -2600,19 +5724,169 @@ async def cmd_apk_delete(msg: types.Message):
     file_path, decompiled_path = row
     
     try:
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-        if decompiled_path and os.path.exists(decompiled_path):
-            shutil.rmtree(decompiled_path, ignore_errors=True)
-        
-        cursor.execute("DELETE FROM apk_uploads WHERE upload_id = ?", (upload_id,))
-        conn.commit()
+        await delete_apk_uploads([(upload_id, file_path, decompiled_path)])
+        await gc_apk_blobs()
         
         await msg.reply(f"APK #{upload_id} удалён.")
     except Exception as e:
         await msg.reply(f"Ошибка удаления: {e}")
 
 
+@dp.message_handler(commands=["cache_stats"])
+async def cmd_cache_stats(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    stats = user_cache.stats()
+    await msg.reply(
+        f"**Кэш пользователей**\n\n"
+        f"Записей: {stats['size']}/{USER_CACHE_SIZE}\n"
+        f"Попаданий: {stats['hits']}\n"
+        f"Промахов: {stats['misses']}\n"
+        f"Hit rate: {stats['hit_rate'] * 100:.1f}%\n"
+        f"Вытеснено: {stats['evictions']}\n\n"
+        f"**База данных**\n\n"
+        f"Записей: {db_commit_stats['writes']}\n"
+        f"Коммитов: {db_commit_stats['commits']}"
+    )
+
+@dp.message_handler(commands=["query_plans"])
+async def cmd_query_plans(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    if not DEV_MODE:
+        await msg.reply("Анализ запросов доступен только при DEV_MODE=1.")
+        return
+    
+    findings = await explain_registered_queries()
+    if not findings:
+        await msg.reply(f"Проверено запросов: {len(db_query_registry)}. Полных сканов таблиц нет.")
+        return
+    
+    lines = [f"**Полные сканы таблиц** ({len(findings)} из {len(db_query_registry)}):\n"]
+    for shape, scans in findings:
+        lines.append(f"{', '.join(scans)}\n   {shape[:200]}\n")
+    
+    text = "\n".join(lines)
+    for i in range(0, len(text), 4000):
+        await msg.reply(text[i:i + 4000])
+
+@dp.message_handler(commands=["sessions"])
+async def cmd_sessions(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    lines = ["**Игровые сессии**\n"]
+    for name, count, max_size, ttl, memory, expired, evicted in session_gauges():
+        lines.append(
+            f"**{name}**: {count}/{max_size}, {memory / 1024:.1f} KB\n"
+            f"   TTL {ttl // 60} мин, истекло: {expired}, вытеснено: {evicted}"
+        )
+    await msg.reply("\n".join(lines))
+
+@dp.message_handler(commands=["rtp"])
+async def cmd_rtp(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    parts = msg.text.split()
+    try:
+        rounds = min(int(parts[1]), RTP_SIM_MAX_ROUNDS) if len(parts) > 1 else RTP_SIM_ROUNDS
+    except ValueError:
+        await msg.reply("Использование: /rtp [раунды]")
+        return
+    if rounds <= 0:
+        await msg.reply("Число раундов должно быть положительным!")
+        return
+    
+    await msg.reply(f"Симулирую {rounds} раундов...")
+    try:
+        report = await asyncio.to_thread(rtp_report, rounds)
+    except ImportError:
+        await msg.reply("NumPy не установлен, симуляция недоступна.")
+        return
+    
+    exact = slot_rtp_exact()
+    lines = [f"**RTP** ({rounds} раундов)\n", f"Слоты (точно): {exact * 100:.2f}%"]
+    for name, rtp, stderr, rate, (low, high) in report:
+        value = exact if name == "slots" else rtp
+        lines.append(
+            f"**{name}**: {rtp * 100:.2f}% ± {1.96 * stderr * 100:.2f}%\n"
+            f"   {rate / 1e6:.1f}M раундов/с, допустимо {low * 100:.0f}-{high * 100:.0f}%"
+            + ("" if low <= value <= high else " - ВНЕ ДИАПАЗОНА")
+        )
+    lines.append(f"\nИгрок в блэкджеке берёт карту до {RTP_PLAYER_STANDS}.")
+    await msg.reply("\n".join(lines))
+
+async def render_ledger_page(user_id, before_id=None):
+    rows = await db_fetchall(
+        """SELECT entry_id, delta, reason, created_at FROM ledger
+           WHERE user_id = ? AND entry_id < ?
+           ORDER BY entry_id DESC
+           LIMIT ?""",
+        (user_id, before_id if before_id is not None else 2 ** 62, LEDGER_PAGE_SIZE + 1)
+    )
+    has_more = len(rows) > LEDGER_PAGE_SIZE
+    rows = rows[:LEDGER_PAGE_SIZE]
+    
+    lines = [f"**Журнал операций {user_id}:**\n"]
+    for entry_id, delta, reason, created_at in rows:
+        lines.append(f"#{entry_id} {datetime.fromtimestamp(created_at):%d.%m %H:%M} {delta:+d} ({reason})")
+    
+    if not rows:
+        lines.append("Записей нет.")
+    
+    keyboard = None
+    if has_more:
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("Дальше", callback_data=f"ledger_{user_id}_{rows[-1][0]}"))
+    else:
+        snapshot = await db_fetchone(
+            "SELECT balance_delta, entries, last_entry_id FROM ledger_snapshots WHERE user_id = ?",
+            (user_id,)
+        )
+        if snapshot:
+            balance_delta, entries, last_entry_id = snapshot
+            lines.append(f"\nСвёрнуто записей до #{last_entry_id}: {entries}, итого {balance_delta:+d} EcsCoin")
+    
+    return "\n".join(lines), keyboard
+
+@dp.message_handler(commands=["ledger"])
+async def cmd_ledger(msg: types.Message):
+    if msg.from_user.id not in ADMINS:
+        await msg.reply("Эта команда только для администраторов.")
+        return
+    
+    parts = msg.text.split()
+    if len(parts) < 2:
+        await msg.reply("Использование: /ledger @username|ID")
+        return
+    
+    target_id, _ = await resolve_user_identifier(parts[1], bot)
+    if not target_id:
+        await msg.reply("Не могу найти пользователя.")
+        return
+    
+    await db_sync()
+    text, keyboard = await render_ledger_page(target_id)
+    await msg.reply(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("ledger_"))
+async def ledger_next_page(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMINS:
+        await callback.answer("Только для администраторов!")
+        return
+    
+    _, user_id, before_id = callback.data.split("_")
+    text, keyboard = await render_ledger_page(int(user_id), int(before_id))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
 @dp.message_handler(commands=["cancel"], state="*")
 async def cmd_cancel(msg: types.Message, state: FSMContext):
     current_state = await state.get_state()
@@ -2624,9 +5898,115 @@ async def cmd_cancel(msg: types.Message, state: FSMContext):
     await msg.reply("Действие отменено.")
 
 
+class BotWebhookHandler(WebhookRequestHandler):
+    async def post(self):
+        if shutting_down:
+            return web.Response(status=503, text='shutting down')
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403, text='forbidden')
+        return await super().post()
+
+async def healthz(request):
+    status = {
+        'status': 'draining' if shutting_down else 'ok',
+        'mode': BOT_MODE,
+        'db': db is not None,
+        'handlers': len(handler_tasks),
+        'outbound_pending': bot.outbound.pending(),
+    }
+    ok = not shutting_down and db is not None
+    return web.json_response(status, status=200 if ok else 503)
+
+async def register_webhook(dispatcher):
+    if WEBHOOK_HOST:
+        await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None, drop_pending_updates=WEBHOOK_DROP_PENDING)
+        print(f"Webhook set to {WEBHOOK_HOST}{WEBHOOK_PATH}")
+
+def make_webhook_app():
+    app = web.Application()
+    app.router.add_get('/healthz', healthz)
+    app.router.add_route('*', WEBHOOK_PATH, BotWebhookHandler, name='webhook_handler')
+    app[BOT_DISPATCHER_KEY] = dp
+    return app
+
+def start_webhook_server():
+    runner = Executor(dp)
+    runner.on_startup(on_startup)
+    runner.on_startup(register_webhook, polling=False)
+    runner.on_shutdown(on_shutdown)
+    runner.set_webhook(web_app=make_webhook_app())
+    print(f"Webhook server on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    # set_webhook() already ran the executor's startup on runner.loop; serve
+    # on the same loop instead of letting run_app() create a fresh one.
+    runner.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT, loop=runner.loop)
+
+def fake_update(text, user_id, chat_id=None, callback=False):
+    stamp = int(time.time())
+    user = {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"test{user_id}"}
+    chat = {"id": chat_id or user_id, "type": "private" if not chat_id or chat_id > 0 else "supergroup"}
+    if callback:
+        message = {"message_id": 1, "date": stamp, "chat": chat, "text": "..."}
+        return {"update_id": stamp, "callback_query": {"id": str(stamp), "from": user, "chat_instance": "0", "message": message, "data": text}}
+    message = {"message_id": stamp % 1000000, "date": stamp, "chat": chat, "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": stamp, "message": message}
+
+async def post_fake_update(url, update):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    async with ClientSession() as session:
+        async with session.post(url, json=update, headers=headers) as response:
+            print(response.status, await response.text())
+
+async def on_startup(dispatcher):
+    await init_db()
+    await apk_jobs_startup()
+    await start_expiry_schedulers()
+    if isinstance(storage, SQLiteStorage):
+        await storage.startup()
+    await restore_session_snapshot()
+    global session_snapshot_task
+    session_snapshot_task = asyncio.create_task(session_snapshot_loop())
+    asyncio.create_task(ledger_compaction_loop())
+    asyncio.create_task(leaderboard_persist_loop())
+    asyncio.create_task(python_pool.warm())
+
+async def on_shutdown(dispatcher):
+    await drain_handlers()
+    if session_snapshot_task is not None:
+        session_snapshot_task.cancel()
+    try:
+        kept, size = await write_session_snapshot(clean=True)
+        print(f"Session snapshot: {kept} sessions, {size} bytes")
+    except Exception as e:
+        print(f"Session snapshot error: {e}")
+    await python_pool.close()
+    apk_jobs_shutdown()
+    await persist_leaderboard()
+    if DEV_MODE:
+        for shape, scans in await explain_registered_queries():
+            print(f"Query plan: {', '.join(scans)}: {shape}")
+    await bot.outbound.drain()
+    await db_close()
+
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--post-update", metavar="TEXT", help="post a fake update to a running webhook server")
+    parser.add_argument("--callback", action="store_true", help="send --post-update text as callback data")
+    parser.add_argument("--user-id", type=int, default=min(ADMINS))
+    parser.add_argument("--chat-id", type=int)
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    args = parser.parse_args()
+    if args.post_update is not None:
+        asyncio.run(post_fake_update(args.url, fake_update(args.post_update, args.user_id, args.chat_id, args.callback)))
+        sys.exit(0)
     print("ECSP Guard Bot starting...")
     print(f"Admins: {ADMINS}")
-    loop = asyncio.get_event_loop()
-    loop.create_task(cleanup_expired_apk())
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_MODE == "webhook":
+        start_webhook_server()
+    else:
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,27 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_FILE = os.path.join(ROOT, "bot (2).py")
+
+TEST_ENV = {
+    "BOT_TOKEN": "123456:TEST-token",
+    "ADMIN_IDS": "1",
+    "WEBHOOK_SECRET": "test-secret",
+    "BOT_MODE": "webhook",
+}
+
+
+@pytest.fixture(scope="session")
+def bot_module(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("bot")
+    os.environ.update(TEST_ENV)
+    os.environ["DB_PATH"] = str(workdir / "bot.db")
+    spec = importlib.util.spec_from_file_location("bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["bot"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import BOT_FILE, TEST_ENV
+
+IMPORT_BUDGET_MS = int(os.getenv("IMPORT_BUDGET_MS", "800"))
+
+IMPORT_SCRIPT = """
+import importlib.util, json, sys
+spec = importlib.util.spec_from_file_location("bot", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+sys.modules["bot"] = module
+spec.loader.exec_module(module)
+print(json.dumps(sorted(name for name in module.lazy_modules if name in sys.modules)))
+"""
+
+
+def test_import_time_within_budget(tmp_path):
+    env = dict(os.environ, **TEST_ENV, DB_PATH=str(tmp_path / "bot.db"))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT, BOT_FILE],
+        cwd=tmp_path, env=env, capture_output=True, text=True
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+
+    top_level = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            top_level.append((int(cumulative) / 1000, name.strip()))
+    total = sum(ms for ms, _ in top_level)
+    slowest = ", ".join(f"{name} {ms:.0f} ms" for ms, name in sorted(top_level, reverse=True)[:5])
+
+    assert json.loads(proc.stdout.splitlines()[-1]) == []
+    assert total <= IMPORT_BUDGET_MS, f"import took {total:.0f} ms (budget {IMPORT_BUDGET_MS} ms): {slowest}"
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+ROUNDS = int(os.getenv("RTP_TEST_ROUNDS", "500000"))
+
+
+def test_slots_rtp_within_band(bot_module):
+    m = bot_module
+    low, high = m.SLOTS_RTP_BAND
+    exact = m.slot_rtp_exact()
+    assert low <= exact <= high, f"slots RTP {exact:.4f} outside {low:.2f}-{high:.2f}"
+
+    rtp, stderr = m.simulate_slots(ROUNDS, np.random.default_rng(0))
+    assert abs(rtp - exact) <= 4 * stderr, f"simulated {rtp:.4f} disagrees with exact {exact:.4f}"
+
+
+def test_blackjack_rtp_within_band(bot_module):
+    m = bot_module
+    low, high = m.BLACKJACK_RTP_BAND
+    rtp, stderr = m.simulate_blackjack(ROUNDS, np.random.default_rng(0))
+    assert low <= rtp - 4 * stderr and rtp + 4 * stderr <= high, \
+        f"blackjack RTP {rtp:.4f} ± {4 * stderr:.4f} outside {low:.2f}-{high:.2f}"
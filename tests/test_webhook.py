@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiohttp.test_utils import TestClient, TestServer
+
+
+def test_webhook_serves_fake_updates(bot_module, monkeypatch, tmp_path):
+    m = bot_module
+    monkeypatch.chdir(tmp_path)
+    sent = []
+
+    async def fake_request(self, method, data=None, files=None, **kwargs):
+        sent.append((method, dict(data or {})))
+        if method == "sendMessage":
+            return {"message_id": len(sent), "date": int(time.time()),
+                    "chat": {"id": int(data["chat_id"]), "type": "private"}, "text": data.get("text", "")}
+        return True
+
+    monkeypatch.setattr(Bot, "request", fake_request)
+    secret = {"X-Telegram-Bot-Api-Secret-Token": m.WEBHOOK_SECRET}
+    wrong = {"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+
+    async def scenario():
+        await m.on_startup(m.dp)
+        try:
+            async with TestClient(TestServer(m.make_webhook_app())) as client:
+                health = await client.get("/healthz")
+                assert health.status == 200
+                assert (await health.json())["status"] == "ok"
+
+                assert (await client.post(m.WEBHOOK_PATH, json=m.fake_update("/start", 41))).status == 403
+                assert (await client.post(m.WEBHOOK_PATH, json=m.fake_update("/start", 41), headers=wrong)).status == 403
+
+                response = await client.post(m.WEBHOOK_PATH, json=m.fake_update("/start", 42), headers=secret)
+                assert response.status == 200
+                assert await m.db_fetchone("SELECT user_id FROM users WHERE user_id = ?", (42,)) == (42,)
+                assert await m.db_fetchone("SELECT user_id FROM users WHERE user_id = ?", (41,)) is None
+        finally:
+            await m.on_shutdown(m.dp)
+
+    asyncio.run(scenario())
+    replies = [data for method, data in sent if method == "sendMessage"]
+    assert [int(data["chat_id"]) for data in replies] == [42]